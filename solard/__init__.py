@@ -14,43 +14,45 @@
 # limitations under the License.
 
 import argparse
-import collections
-import ctypes
+import asyncio
+import csv
 import enum
+import functools
 import logging
-import math
-import operator
 import os
+import shlex
 import signal
 import sys
-import threading
 import time
-from concurrent import futures
-from subprocess import check_call, list2cmdline
 
-import Xlib.Xatom
-import Xlib.display
-
-
-TRACE = 5
-logging.addLevelName(TRACE, "TRACE")
-
-
-class LoggerAdapter(logging.LoggerAdapter):
-    def trace(self, msg, *args, **kwargs):
-        self.log(TRACE, msg, *args, **kwargs)
-
-
-LOG = LoggerAdapter(logging.getLogger("solard"), {})
+from solard import control
+from solard import curve
+from solard import dbus
+from solard import discovery
+from solard import evdev
+from solard import fade
+from solard import filters
+from solard import history
+from solard import iio
+from solard import metrics
+from solard import outputs
+from solard import power
+from solard import sysfs
+from solard import tracing
+from solard import uevent
+from solard.log import LOG, TRACE
+
+
+# Prefix of all /sys, /proc paths, to run the daemon against a fake tree
+SYSFS_ROOT = "/"
 
 LID_SYSPATH = "/proc/acpi/button/lid/LID/state"
 
 SCREEN_BACKLIGHT_SYSPATH = "/sys/class/backlight/"
-SUPPORTED_SCREEN_BACKLIGHT_MODULES = ["acpi_video0", "intel_backlight"]
 
 ALS_SYSPATH = "/sys/bus/acpi/drivers/%s/ACPI0008:00"
-SUPPORTED_ALS_MODULES = ["acpi_als", "als"]
 
+# Historical sensor names, other sensors are selected by IIO device name
 ALS_INPUT_SYSPATH_MAP = {
     "acpi_als": os.path.join(
         ALS_SYSPATH % "acpi_als", "iio:device0/in_illuminance_input"
@@ -59,102 +61,92 @@ ALS_INPUT_SYSPATH_MAP = {
 }
 
 KEYBOARD_BACKLIGHT_SYSPATH = "/sys/class/leds/%s/brightness"
-SUPPORTED_KEYBOARD_BACKLIGHT_MODULES = ["asus::kbd_backlight"]
 
 _ROOT = os.path.abspath(os.path.dirname(__file__))
 
 
-class XWindowAttributes(ctypes.Structure):
-    _fields_ = [
-        ("x", ctypes.c_int32),
-        ("y", ctypes.c_int32),
-        ("width", ctypes.c_int32),
-        ("height", ctypes.c_int32),
-        ("border_width", ctypes.c_int32),
-        ("depth", ctypes.c_int32),
-        ("visual", ctypes.c_ulong),
-        ("root", ctypes.c_ulong),
-        ("class", ctypes.c_int32),
-        ("bit_gravity", ctypes.c_int32),
-        ("win_gravity", ctypes.c_int32),
-        ("backing_store", ctypes.c_int32),
-        ("backing_planes", ctypes.c_ulong),
-        ("backing_pixel", ctypes.c_ulong),
-        ("save_under", ctypes.c_int32),
-        ("colourmap", ctypes.c_ulong),
-        ("mapinstalled", ctypes.c_uint32),
-        ("map_state", ctypes.c_uint32),
-        ("all_event_masks", ctypes.c_ulong),
-        ("your_event_mask", ctypes.c_ulong),
-        ("do_not_propagate_mask", ctypes.c_ulong),
-        ("override_redirect", ctypes.c_int32),
-        ("screen", ctypes.c_ulong),
-    ]
-
-
-class XScreenSaverInfo(ctypes.Structure):
-    """
-    XScreenSaverInfo typedef.
-
-    typedef struct { ... } XScreenSaverInfo;
-    """
-
-    _fields_ = [
-        ("window", ctypes.c_ulong),  # screen saver window
-        ("state", ctypes.c_int),  # off,on,disabled
-        ("kind", ctypes.c_int),  # blanked,internal,external
-        ("since", ctypes.c_ulong),  # milliseconds
-        ("idle", ctypes.c_ulong),  # milliseconds
-        ("event_mask", ctypes.c_ulong),
-    ]  # events
+def syspath(path):
+    return os.path.join(SYSFS_ROOT, path.lstrip("/"))
+
+
+# Reading a just written keyboard backlight value returns the previous one
+# for a while
+KEYBOARD_BRIGHTNESS_SETTLE_DELAY = 0.1
+
+# Battery profile when none is configured
+DEFAULT_BATTERY_PROFILE = (
+    "--update-interval 5 "
+    "--ambient-light-measures-interval 1 "
+    "--ambient-light-delta-update 6 "
+    "--screen-brightness-time 0 "
+    "--screen-brightness-ceiling 80"
+)
+
+# Options that can't be changed by a configuration reload
+RESTART_OPTIONS = [
+    "screen_backlight",
+    "keyboard_backlight",
+    "ambient_light_sensor",
+    "ambient_light_events",
+    "ambient_light_buffered",
+    "log",
+    "metrics_socket",
+    "metrics_port",
+    "control_socket",
+    "outputs",
+    "all_outputs",
+    "device_cache",
+    "history",
+    "history_size",
+    "idle_backend",
+    "trace",
+    "trace_size",
+    "idle_input_devices",
+]
+# Options that reset the ambient light filter or curve when changed
+FILTER_OPTIONS = [
+    "ambient_light_filter",
+    "ambient_light_measures_number",
+    "ambient_light_kalman_process_noise",
+    "ambient_light_kalman_measurement_noise",
+]
+CURVE_OPTIONS = [
+    "ambient_light_factor",
+    "ambient_light_curve",
+    "ambient_light_calibrate",
+    "ambient_light_calibration_file",
+]
+
+
+def default_config_path():
+    config_dir = os.environ.get("XDG_CONFIG_HOME") or os.path.expanduser("~/.config")
+    return os.path.join(config_dir, "solard", "config")
+
+
+def load_config(path):
+    """Read command line options from a file, eg: "--idle-dim 30" lines"""
+    if not path or not os.path.exists(path):
+        return []
+    try:
+        with open(path) as f:
+            return shlex.split(f.read(), comments=True)
+    except (IOError, ValueError) as e:
+        LOG.error("Fail to load configuration %s: %s", path, e)
+        return []
 
 
-class Display(ctypes.Structure):
-    pass
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError("%s isn't a positive integer" % value)
+    return number
 
 
-xlib = ctypes.cdll.LoadLibrary("libX11.so.6")
-xlib.XOpenDisplay.argtypes = [ctypes.c_char_p]
-xlib.XOpenDisplay.restype = ctypes.POINTER(Display)
-xlib.XDefaultScreen.argtypes = [ctypes.POINTER(Display)]
-xlib.XDefaultScreen.restype = ctypes.c_int
-xlib.XDefaultRootWindow.argtypes = [ctypes.POINTER(Display), ctypes.c_int]
-xlib.XDefaultRootWindow.restype = ctypes.POINTER(XWindowAttributes)
-
-xss = ctypes.cdll.LoadLibrary("libXss.so.1")
-xss.XScreenSaverAllocInfo.restype = ctypes.POINTER(XScreenSaverInfo)
-
-
-class XScreenSaverQuerier(object):
-    # This create two X clients..., but Xlib python binding doesn't have xss
-    # extention
-    def __init__(self):
-        self.dpy = Xlib.display.Display()
-        self.screen = self.dpy.screen()
-        self.root = self.screen.root
-
-        self.c_dpy = xlib.XOpenDisplay(os.environ["DISPLAY"].encode())
-        self.c_screen = xlib.XDefaultScreen(self.c_dpy)
-        self.c_root = xlib.XDefaultRootWindow(self.c_dpy, self.c_screen)
-        self.c_xss_info = xss.XScreenSaverAllocInfo()
-
-    def get_idle(self):
-        active_windows = self.root.get_property(
-            self.dpy.get_atom("_NET_ACTIVE_WINDOW"), Xlib.Xatom.WINDOW, 0, 4
-        ).value
-        if active_windows:
-            win = self.dpy.create_resource_object("window", active_windows[0])
-            size = win.get_geometry()
-            is_fullscreen = (
-                size._data["width"] == self.screen.width_in_pixels
-                and size._data["height"] == self.screen.height_in_pixels
-            )
-            if is_fullscreen:
-                LOG.debug("Fullscreen App detected, no dim")
-                return 0
-
-        xss.XScreenSaverQueryInfo(self.c_dpy, self.c_root, self.c_xss_info)
-        return self.c_xss_info.contents.idle
+def positive_float(value):
+    number = float(value)
+    if not number > 0:
+        raise argparse.ArgumentTypeError("%s isn't a positive number" % value)
+    return number
 
 
 class BacklightsChangedOutside(Exception):
@@ -167,113 +159,620 @@ class State(enum.Enum):
     Closed = 2
 
 
-class LoopThread(threading.Thread):
-    def __init__(self, method, interval):
-        self.method = method
-        self.interval = interval
-        self._shutdown = threading.Event()
-        self._t = threading.Thread(target=self._loop)
-        self._t.start()
-
-    def _loop(self):
-        while not self._shutdown.is_set():
-            try:
-                self.method()
-            except Exception:
-                LOG.exception("Something wrong append, retrying later.")
-            self._shutdown.wait(self.interval)
-
-    def stop(self):
-        self._shutdown.set()
-
-    def wait(self):
-        self._t.join()
-
-
 class Daemon(object):
     def __init__(self, conf):
         self.conf = conf
+        self.screen_brightness_path = syspath(
+            os.path.join(
+                SCREEN_BACKLIGHT_SYSPATH, self.conf.screen_backlight, "brightness"
+            )
+        )
+        if self.conf.keyboard_backlight:
+            self.keyboard_brightness_path = syspath(
+                KEYBOARD_BACKLIGHT_SYSPATH % self.conf.keyboard_backlight
+            )
+        else:
+            self.keyboard_brightness_path = None
+        self.setup_ambient_light_sensor()
         # Set additionnal static configuration
         self.conf.screen_brightness_max = self.get_screen_brightness_max()
+        self.keyboard_brightness_max = self.get_keyboard_brightness_max()
 
-        self.last_screen_brightness = self.get_screen_brightness()
-        self.last_keyboard_brightness = self.get_keyboard_brightness()
+        self.screen_shadow = sysfs.Shadow(self.get_screen_brightness())
+        self.keyboard_shadow = sysfs.Shadow(
+            self.get_keyboard_brightness(), KEYBOARD_BRIGHTNESS_SETTLE_DELAY
+        )
         # Calculate previous value from the screen brightness
         self.ambient_light_last = (
-            self.last_screen_brightness * 100 / self.conf.screen_brightness_max
+            self.screen_shadow.value * 100 / self.conf.screen_brightness_max
         )
         if self.ambient_light_last < self.conf.screen_brightness_min:
             self.ambient_light_last = 0
         self.ambient_light_current = self.ambient_light_last
-        self.ambient_light_values = collections.deque(
-            maxlen=self.conf.ambient_light_measures_number
+        self.ambient_light_filter = filters.build(self.conf)
+        self.ambient_light_curve = curve.build(
+            self.conf, self.load_ambient_light_calibration()
         )
-
-        self.brightnesses_to_set = (0, 0)
-        self.brightnesses_have_to_change = threading.Event()
+        self.keyboard_curve = curve.build_keyboard(self.conf)
+        self.ambient_light_raw_last = None
+        self.ambient_light_events = None
+        self.ambient_light_buffer = None
+        # Kernel timestamp of the last buffered sample, in ns
+        self.ambient_light_timestamp = None
+        self.ambient_light_samples_pending = 0
 
         self.was_already_idle = False
-        self.xscreensaver_querier = XScreenSaverQuerier()
-
-        self._threads = []
-        self._shutdown = threading.Event()
+        # X libraries are only loaded when needed
+        self.xscreensaver_querier = None
+        if self.conf.idle_dim > 0 and self.conf.idle_backend == "x11":
+            self.xscreensaver_querier = self.get_xscreensaver_querier()
+        # Watched X connection socket, polled and reconnected once lost
+        self.x_events_fd = None
+        self.x_connection_lost = False
+        # Created with the event loop
+        self.evdev_idle_monitor = None
+        self.lid_switch = None
+        # /proc/acpi lid state, polled when there is no readable SW_LID
+        self.lid_polled = False
+
+        self.loop = asyncio.new_event_loop()
+        self._event_detection_handle = None
+        self._ambient_light_sampling_handle = None
+        self.ambient_light_sampling_interval = self.conf.ambient_light_measures_interval
+        self.uevent_monitor = None
+        self.sysfs_notifier = None
+        self.screen_changes_notified = False
+        self.metrics = metrics.Metrics()
+        self.metrics_server = None
+        self.control_server = None
+        self.history = None
+        # Session bus connection, opened by the first notification
+        self.notifier = None
+        self.paused = False
+        self.screen_brightness_offset = self.conf.screen_brightness_offset
+        self.frame_clock = fade.FrameClock(self.loop)
+        self.screen_fader = fade.Fader(
+            self.frame_clock,
+            "screen",
+            lambda: self.screen_shadow.value,
+            self.set_screen_brightness,
+        )
+        self.keyboard_fader = fade.Fader(
+            self.frame_clock,
+            "keyboard",
+            lambda: self.keyboard_shadow.value,
+            self.set_keyboard_brightness,
+        )
+        self.outputs = self.setup_outputs()
+        self.faders = [self.screen_fader, self.keyboard_fader] + [
+            output.fader for output in self.outputs
+        ]
 
         self._state = State.Used
 
+    @property
+    def device_index(self):
+        return discovery.get_index(syspath, self.conf.device_cache or None)
+
+    def setup_ambient_light_sensor(self):
+        sensor = self.conf.ambient_light_sensor
+        # Raw values of IIO channels without processed ones are converted to
+        # lux with their scale and offset, None for the historical sensors
+        self.ambient_light_scale = None
+        self.ambient_light_offset = 0.0
+        # Buffered samples are always raw values, whatever attribute is polled
+        self.ambient_light_raw_scale = 1.0
+        self.ambient_light_raw_offset = 0.0
+        self.ambient_light_iio = None
+        if sensor in ALS_INPUT_SYSPATH_MAP:
+            self.ambient_light_path = syspath(ALS_INPUT_SYSPATH_MAP[sensor])
+            if sensor == "acpi_als":
+                self.ambient_light_iio = (
+                    os.path.dirname(self.ambient_light_path),
+                    "in_illuminance",
+                )
+            return
+
+        device = self.device_index.get("als", sensor)
+        if device is None:
+            # Plugged since the index have been built
+            self.device_index.rescan()
+            device = self.device_index.get("als", sensor)
+        if device is None:
+            raise RuntimeError("%s is not an ambient light sensor" % sensor)
+        LOG.debug("Ambient light sensor: %s (%s)", sensor, device["driver"])
+        self.ambient_light_path = syspath(os.path.join(device["path"], device["input"]))
+        self.ambient_light_iio = (syspath(device["path"]), device["channel"])
+        self.ambient_light_raw_scale = device["scale"]
+        self.ambient_light_raw_offset = device["offset"]
+        self.ambient_light_scale = 1.0
+        if device["input"].endswith("_raw"):
+            self.ambient_light_scale = device["scale"]
+            self.ambient_light_offset = device["offset"]
+
+    def output_specs(self):
+        specs = []
+        if self.conf.all_outputs:
+            specs.extend(outputs.discover(self.device_index))
+        specs.extend(self.conf.outputs or [])
+        primary = {
+            (outputs.Backlight, self.conf.screen_backlight),
+            (outputs.Led, self.conf.keyboard_backlight),
+        }
+        return [spec for spec in specs if spec not in primary]
+
+    def setup_outputs(self):
+        """Outputs faded along the screen and keyboard backlights"""
+        result = []
+        for backend, name in self.output_specs():
+            if any(o.kind == backend.kind and o.name == name for o in result):
+                continue
+            output = self.create_output(backend, name)
+            if output is not None:
+                result.append(output)
+        return result
+
+    def create_output(self, backend, name):
+        path = None
+        if backend.SYSPATH is not None:
+            path = syspath(os.path.join(backend.SYSPATH, name))
+        try:
+            output = backend(name, path)
+        except (IOError, OSError, ValueError, TypeError) as e:
+            # TypeError for the user backends not matching the interface
+            LOG.error("Fail to setup %s output %s: %s", backend.kind, name, e)
+            return None
+        output.fader = fade.Fader(
+            self.frame_clock,
+            "%s=%s" % (output.kind, name),
+            lambda: output.shadow.value,
+            functools.partial(self.set_output_brightness, output),
+        )
+        LOG.debug("Output %s (%s) added", output, output.role)
+        return output
+
+    def on_device_uevents(self, uevents):
+        if not any(u.action in ("add", "remove") for u in uevents):
+            return
+        LOG.info("Devices plugged or unplugged, rescanning")
+        self.device_index.rescan()
+
+        specs = self.output_specs()
+        for output in list(self.outputs):
+            if (type(output), output.name) not in specs:
+                LOG.info("Output %s removed", output)
+                output.fader.cancel()
+                self.outputs.remove(output)
+                self.faders.remove(output.fader)
+        for backend, name in specs:
+            if any(o.kind == backend.kind and o.name == name for o in self.outputs):
+                continue
+            output = self.create_output(backend, name)
+            if output is not None:
+                LOG.info("Output %s plugged", output)
+                self.outputs.append(output)
+                self.faders.append(output.fader)
+                if self._state == State.Used and not self.paused:
+                    self.apply_ambient_light()
+
+    @staticmethod
+    def get_xscreensaver_querier():
+        from solard import xscreensaver
+
+        return xscreensaver.XScreenSaverQuerier()
+
     def idle(self):
         if self.conf.idle_dim <= 0:
             return False
-        return self.xscreensaver_querier.get_idle() > self.conf.idle_dim * 1000
+        timeout = int(self.conf.idle_dim * 1000)
+        if self.evdev_idle_monitor is not None:
+            return self.evdev_idle_monitor.is_idle(timeout)
+        if self.xscreensaver_querier is None and self.x_connection_lost:
+            self.reconnect_x()
+        querier = self.xscreensaver_querier
+        if querier is None:
+            return False
+        try:
+            with tracing.span("idle"):
+                idle = querier.is_idle(timeout)
+            if self.x_events_fd is not None and querier.pending_events():
+                # Queued by the round trips, the socket won't wake us up
+                self.loop.call_soon(self.on_x_events)
+        except querier.ConnectionClosedError as e:
+            self.on_x_connection_lost(e)
+            return False
+        return idle
+
+    def setup_idle_backend(self):
+        if self.conf.idle_dim <= 0:
+            return
+        if self.conf.idle_backend == "evdev":
+            self.setup_evdev_idle_monitor()
+        else:
+            self.setup_idle_alarms()
 
-    def _spawn(self, method, interval):
-        self._threads.append(LoopThread(method, interval))
+    def idle_input_devices(self):
+        return self.conf.idle_input_devices or evdev.activity_devices(syspath)
+
+    def setup_evdev_idle_monitor(self):
+        if self.evdev_idle_monitor is not None:
+            return
+        self.evdev_idle_monitor = evdev.IdleMonitor(
+            self.loop,
+            self.idle_input_devices(),
+            int(self.conf.idle_dim * 1000),
+            self.event_detection,
+        )
+        if self.uevent_monitor is not None and not self.conf.idle_input_devices:
+            self.uevent_monitor.subscribe("input", self.on_input_uevents)
+
+    def on_input_uevents(self, uevents):
+        if any(u.action in ("add", "remove") for u in uevents):
+            self.evdev_idle_monitor.rescan(self.idle_input_devices())
+
+    def setup_idle_alarms(self):
+        querier = self.xscreensaver_querier
+        if querier is None or querier.idle_alarms is not None:
+            return
+        try:
+            querier.enable_idle_alarms(int(self.conf.idle_dim * 1000))
+        except Exception as e:
+            LOG.debug("XSync idle alarms not available (%s), fallback to polling", e)
+            return
+        self.x_events_fd = querier.fileno()
+        self.loop.add_reader(self.x_events_fd, self.on_x_events)
+
+    def on_x_events(self):
+        querier = self.xscreensaver_querier
+        if querier is None:
+            return
+        try:
+            changed = querier.process_events()
+        except querier.ConnectionClosedError as e:
+            self.on_x_connection_lost(e)
+            return
+        if changed:
+            # React to the user return, or to a fullscreen window leaving
+            # while the user is idle, now, not at the next detection tick
+            self.event_detection()
+
+    def on_x_connection_lost(self, error):
+        LOG.error("X connection lost, fallback to polling: %s", error)
+        if self.x_events_fd is not None:
+            self.loop.remove_reader(self.x_events_fd)
+            self.x_events_fd = None
+        self.xscreensaver_querier = None
+        self.x_connection_lost = True
+        self.schedule_event_detection()
+
+    def reconnect_x(self):
+        try:
+            self.xscreensaver_querier = self.get_xscreensaver_querier()
+        except Exception as e:
+            LOG.debug("Fail to reconnect to the X server: %s", e)
+            return
+        LOG.info("X connection restored")
+        self.x_connection_lost = False
+        self.setup_idle_alarms()
 
     def run(self):
-        def stop(signum, stack):
-            self._shutdown.set()
-
-        signal.signal(signal.SIGINT, stop)
-        signal.signal(signal.SIGTERM, stop)
-
-        self._spawn(self.event_detection_thread, self.conf.update_interval)
-        self._spawn(self.brightness_update_thread, 0)
-
-        # .wait() won't work well with signal...
-        while not self._shutdown.is_set():
-            time.sleep(0.5)
-
-        LOG.debug("Exiting...")
-        for t in self._threads:
-            t.stop()
-        for t in self._threads:
-            t.wait()
-
-        if self.conf.show_notifications:
-            notify_disabled = [
-                "notify-send",
-                "-c",
-                "device",
-                "-i",
-                _ROOT + "/inactive.svg",
-                "Ambient Light Sensor",
-                "Disabled",
-            ]
-            LOG.trace(list2cmdline(notify_disabled))
-            check_call(notify_disabled)
-
-    def event_detection_thread(self):
-        if self.lid_is_closed():
+        asyncio.set_event_loop(self.loop)
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            self.loop.add_signal_handler(signum, self.stop)
+        self.loop.add_signal_handler(signal.SIGHUP, self.reload)
+        if self.conf.trace:
+            tracing.enable(self.conf.trace, self.conf.trace_size)
+            self.loop.add_signal_handler(signal.SIGUSR2, tracing.TRACER.flush)
+        if self.ambient_light_events is not None:
+            self.loop.add_reader(
+                self.ambient_light_events.fileno(), self.on_ambient_light_events
+            )
+        if self.ambient_light_buffer is not None:
+            self.loop.add_reader(
+                self.ambient_light_buffer.fileno(), self.on_ambient_light_buffer
+            )
+
+        self.setup_lid_switch()
+        self.setup_outside_change_events()
+        self.setup_idle_backend()
+        self.setup_metrics_server()
+        self.setup_control_server()
+        self.setup_history()
+
+        self.schedule_event_detection()
+        self.ambient_light_sampling_now()
+        try:
+            self.loop.run_forever()
+        finally:
+            LOG.debug("Exiting...")
+            if self.metrics_server is not None:
+                self.metrics_server.close()
+            if self.control_server is not None:
+                self.control_server.close()
+            if self.history is not None:
+                self.history.close()
+            if self.uevent_monitor is not None:
+                self.uevent_monitor.close()
+            if self.sysfs_notifier is not None:
+                self.sysfs_notifier.close()
+            if self._event_detection_handle is not None:
+                self._event_detection_handle.cancel()
+            if self._ambient_light_sampling_handle is not None:
+                self._ambient_light_sampling_handle.cancel()
+            self.frame_clock.cancel()
+            if self.ambient_light_events is not None:
+                self.loop.remove_reader(self.ambient_light_events.fileno())
+            if self.ambient_light_buffer is not None:
+                self.loop.remove_reader(self.ambient_light_buffer.fileno())
+            if self.x_events_fd is not None:
+                self.loop.remove_reader(self.x_events_fd)
+                self.xscreensaver_querier.close()
+            if self.evdev_idle_monitor is not None:
+                self.evdev_idle_monitor.close()
+            if self.lid_switch is not None:
+                self.loop.remove_reader(self.lid_switch.fileno())
+                self.lid_switch.close()
+            for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGHUP):
+                self.loop.remove_signal_handler(signum)
+            if tracing.TRACER is not None:
+                self.loop.remove_signal_handler(signal.SIGUSR2)
+                tracing.TRACER.flush()
+            self.notify("Disabled", "inactive.svg")
+            if self.notifier is not None:
+                self.notifier.flush()
+                self.notifier.close()
+            self.loop.close()
+
+        if self.ambient_light_events is not None:
+            self.ambient_light_events.close()
+        if self.ambient_light_buffer is not None:
+            self.ambient_light_buffer.close()
+        sysfs.POOL.close()
+
+    def stop(self):
+        self.loop.stop()
+
+    def setup_metrics_server(self):
+        if self.conf.metrics_socket is None and self.conf.metrics_port is None:
+            return
+        try:
+            self.metrics_server = metrics.MetricsServer(
+                self.loop,
+                lambda: metrics.render(self),
+                self.conf.metrics_socket,
+                self.conf.metrics_port,
+            )
+        except OSError as e:
+            LOG.error("Fail to setup the metrics server: %s", e)
+
+    def check_single_instance(self):
+        """Exit if another daemon answers on our sockets"""
+        for path in (self.conf.control_socket, self.conf.metrics_socket):
+            if path is None:
+                continue
+            try:
+                control.remove_stale_socket(path)
+            except control.AlreadyRunning as e:
+                LOG.error("%s, exiting", e.strerror)
+                sys.exit(1)
+            except OSError as e:
+                # Reported when setting up the server
+                LOG.debug("Fail to check %s: %s", path, e)
+
+    def setup_history(self):
+        if self.conf.history is None:
+            return
+        try:
+            self.history = history.History(self.conf.history, self.conf.history_size)
+        except (OSError, ValueError) as e:
+            LOG.error("Fail to open the history %s: %s", self.conf.history, e)
+
+    def record_history(self, kind, screen=0, keyboard=0):
+        if self.history is not None:
+            self.history.record(
+                kind,
+                self._state.value,
+                self.ambient_light_raw_last,
+                self.ambient_light_current,
+                screen,
+                keyboard,
+            )
+
+    def setup_control_server(self):
+        if self.conf.control_socket is None:
+            return
+        try:
+            self.control_server = control.ControlServer(
+                self.loop, self.conf.control_socket, self.on_control_request
+            )
+        except OSError as e:
+            LOG.error("Fail to setup the control socket: %s", e)
+
+    def on_control_request(self, command, args):
+        if command == "pause":
+            self.pause()
+        elif command == "resume":
+            self.resume()
+        elif command == "toggle":
+            if self.paused:
+                self.resume()
+            else:
+                self.pause()
+        elif command == "set-offset":
+            try:
+                (offset,) = args
+                offset = float(offset)
+            except ValueError:
+                raise ValueError("set-offset expects one percent value")
+            self.set_screen_brightness_offset(offset)
+        elif command == "reload":
+            if not self.reload():
+                raise ValueError("Invalid configuration, see the daemon logs")
+        elif command == "status":
+            return {"status": self.status()}
+
+    def notify(self, body, icon):
+        if not self.conf.show_notifications:
+            return
+        if self.notifier is None:
+            self.notifier = dbus.Notifier(self.loop, "solard")
+        self.notifier.notify(
+            "Ambient Light Sensor", body, os.path.join(_ROOT, icon), "device"
+        )
+
+    def pause(self):
+        if self.paused:
+            return
+        LOG.info("Paused")
+        self.notify("Paused", "inactive.svg")
+        self.paused = True
+        if self._ambient_light_sampling_handle is not None:
+            self._ambient_light_sampling_handle.cancel()
+            self._ambient_light_sampling_handle = None
+        self.frame_clock.cancel()
+
+    def resume(self):
+        if not self.paused:
+            return
+        LOG.info("Resumed")
+        self.notify("Enabled", "active.svg")
+        self.paused = False
+        # Brightnesses may have been changed while paused
+        self.screen_shadow.reset(self.get_screen_brightness())
+        self.keyboard_shadow.reset(self.get_keyboard_brightness())
+        if self.ambient_light_events is not None:
+            self.ambient_light_samples_pending = self.conf.ambient_light_measures_number
+        self._state = State.Used
+        self.apply_ambient_light()
+        self.ambient_light_sampling_now()
+        # Lid and idle states may have changed while paused
+        self.event_detection()
+
+    def set_screen_brightness_offset(self, offset):
+        LOG.info("Screen brightness offset set to %s%%", offset)
+        self.screen_brightness_offset = offset
+        if self._state == State.Used and not self.paused:
+            self.apply_ambient_light()
+
+    def status(self):
+        return {
+            "state": self._state.name,
+            "paused": self.paused,
+            "screen_brightness_offset": self.screen_brightness_offset,
+            "ambient_light": self.ambient_light_current,
+            "ambient_light_raw": self.ambient_light_raw_last,
+            "ambient_light_timestamp": self.ambient_light_timestamp,
+            "ambient_light_sampling_interval": self.ambient_light_sampling_interval,
+            "screen_brightness": (
+                self.screen_shadow.value * 100.0 / self.conf.screen_brightness_max
+            ),
+            "keyboard_brightness": self.keyboard_shadow.value,
+            "config": self.conf.config,
+            "power_profile": self.conf.profile,
+        }
+
+    def reload(self):
+        LOG.info("Reloading configuration")
+        try:
+            conf = parse_args(self.conf.argv)
+        except SystemExit:
+            LOG.error("Invalid configuration, keeping the current one")
+            return False
+
+        for option in RESTART_OPTIONS:
+            if getattr(conf, option) != getattr(self.conf, option):
+                LOG.warning(
+                    "Changing --%s requires a restart", option.replace("_", "-")
+                )
+                setattr(conf, option, getattr(self.conf, option))
+        conf.screen_brightness_max = self.conf.screen_brightness_max
+
+        old, self.conf = self.conf, conf
+        if conf.profile != old.profile:
+            LOG.info("Switching to the %s power profile", conf.profile)
+        if not conf.log:
+            logging.getLogger().setLevel(self.get_log_level())
+        if any(getattr(conf, o) != getattr(old, o) for o in FILTER_OPTIONS):
+            self.ambient_light_filter = filters.build(conf)
+        if any(getattr(conf, o) != getattr(old, o) for o in CURVE_OPTIONS):
+            self.ambient_light_curve = curve.build(
+                conf, self.load_ambient_light_calibration()
+            )
+        self.keyboard_curve = curve.build_keyboard(conf)
+        if (
+            conf.idle_dim > 0
+            and conf.idle_backend == "x11"
+            and self.xscreensaver_querier is None
+        ):
+            try:
+                self.xscreensaver_querier = self.get_xscreensaver_querier()
+            except Exception as e:
+                LOG.error("Fail to query the X server, idle dim disabled: %s", e)
+        self.setup_idle_backend()
+        self.schedule_event_detection()
+        if conf.screen_brightness_offset != old.screen_brightness_offset:
+            self.screen_brightness_offset = conf.screen_brightness_offset
+
+        if self._state == State.Used and not self.paused:
+            self.apply_ambient_light()
+            self.ambient_light_sampling_now()
+        return True
+
+    def event_detection_loop(self):
+        start = time.perf_counter()
+        try:
+            with tracing.span("event_detection"):
+                self.event_detection()
+        except Exception:
+            LOG.exception("Something wrong append, retrying later.")
+        self.metrics.cycles["event_detection"].observe(time.perf_counter() - start)
+        if self.event_detection_needs_polling():
+            self._event_detection_handle = self.loop.call_later(
+                self.conf.update_interval, self.event_detection_loop
+            )
+        else:
+            self._event_detection_handle = None
+            LOG.debug("Lid, idle and outside changes are notified, stop polling")
+
+    def event_detection_needs_polling(self):
+        querier = self.xscreensaver_querier
+        return (
+            self.lid_polled
+            or not self.screen_changes_notified
+            # brightness_hw_changed only reports the firmware changes
+            or self.keyboard_brightness_path is not None
+            or self.x_connection_lost
+            or (
+                self.conf.idle_dim > 0
+                and self.evdev_idle_monitor is None
+                and querier is not None
+                and querier.idle_alarms is None
+            )
+        )
+
+    def schedule_event_detection(self):
+        """Restart polling if something isn't notified anymore"""
+        if self._event_detection_handle is None:
+            self._event_detection_handle = self.loop.call_soon(
+                self.event_detection_loop
+            )
+
+    def event_detection(self):
+        if self.paused:
+            return
+        with tracing.span("lid"):
+            lid_closed = self.lid_is_closed()
+        if lid_closed:
             if self._state != State.Closed:
                 LOG.info("LID closed")
                 self.brightnesses_set(0, 0)
                 self._state = State.Closed
         elif self.idle():
             if self._state != State.Idle:
-                self.verify_if_something_changed_outside()
+                self.verify_if_something_changed_outside(polling=True)
                 LOG.info("User idle detected")
                 self.brightnesses_set(self.conf.screen_brightness_dim_min, 100)
                 self._state = State.Idle
-            self.update_ambient_light_tendency()
         elif self._state != State.Used:
             if self._state == State.Closed:
                 LOG.info("LID opened")
@@ -281,90 +780,251 @@ class Daemon(object):
                 LOG.info("User back detected")
             self._state = State.Used
 
-            self.update_ambient_light_tendency()
-            self.brightnesses_set(self.ambient_light_last, self.ambient_light_last)
+            self.apply_ambient_light()
+            self.ambient_light_sampling_now()
         else:
-            self.verify_if_something_changed_outside()
-            self.update_ambient_light_tendency()
-            changed_enough = (
-                abs(self.ambient_light_current - self.ambient_light_last)
-                > self.conf.ambient_light_delta_update
+            self.verify_if_something_changed_outside(polling=True)
+
+    def on_ambient_light_events(self):
+        count = self.ambient_light_events.drain()
+        LOG.trace("Got %d ambient light threshold events", count)
+        if count and not self.paused:
+            # Refill the whole window with fresh values
+            self.ambient_light_samples_pending = self.conf.ambient_light_measures_number
+            self.ambient_light_sampling_now()
+
+    def on_ambient_light_buffer(self):
+        try:
+            with tracing.span("ambient_light_buffer"):
+                samples = self.ambient_light_buffer.read()
+        except OSError as e:
+            LOG.error("Fail to read buffered ambient light samples: %s", e)
+            return
+        if not samples or self.paused:
+            return
+        for timestamp, value in samples:
+            self.ambient_light_current = self.ambient_light_filter.update(
+                self.normalize_ambient_light(self.scale_buffered_ambient_light(value))
             )
-            if changed_enough:
-                self.brightnesses_set(
-                    self.ambient_light_values[-1], self.ambient_light_values[-1]
-                )
-                self.ambient_light_last = self.ambient_light_values[-1]
+            self.record_history(history.SAMPLE)
+        self.ambient_light_timestamp = timestamp
+        LOG.trace(
+            "Got %d buffered ambient light samples, tendency: %s (last: %s)",
+            len(samples),
+            self.ambient_light_current,
+            self.ambient_light_filter.last,
+        )
+        if self._state == State.Used:
+            self.apply_ambient_light_tendency()
+
+    def ambient_light_sampling_loop(self):
+        self._ambient_light_sampling_handle = None
+        if self._state == State.Closed or self.paused:
+            # Restarted when the lid is opened or the daemon resumed
+            return
+
+        start = time.perf_counter()
+        try:
+            with tracing.span("ambient_light_sampling"):
+                moving = self.update_ambient_light_tendency()
+                if self._state == State.Used:
+                    self.apply_ambient_light_tendency()
+        except Exception:
+            LOG.exception("Something wrong append, retrying later.")
+            moving = False
+        self.metrics.cycles["ambient_light_sampling"].observe(
+            time.perf_counter() - start
+        )
+
+        interval = self.next_ambient_light_sampling_interval(moving)
+        if interval is not None:
+            self._ambient_light_sampling_handle = self.loop.call_later(
+                interval, self.ambient_light_sampling_loop
+            )
+
+    def ambient_light_sampling_now(self):
+        self.ambient_light_sampling_interval = self.conf.ambient_light_measures_interval
+        if self._ambient_light_sampling_handle is not None:
+            self._ambient_light_sampling_handle.cancel()
+        self._ambient_light_sampling_handle = self.loop.call_soon(
+            self.ambient_light_sampling_loop
+        )
+
+    def next_ambient_light_sampling_interval(self, moving):
+        if self.ambient_light_buffer is not None:
+            # Samples come from the buffer
+            return None
+        if self.ambient_light_events is not None:
+            # Sample until the window is refilled, then wait for the next
+            # threshold event
+            if self.ambient_light_samples_pending > 0:
+                return self.conf.ambient_light_measures_interval
+            return None
+
+        if moving:
+            interval = self.conf.ambient_light_measures_interval
+        else:
+            # Light is stable, back off, but not beyond the update interval
+            # so large changes are still caught as quickly as before, only
+            # threshold events or the buffer can cover longer periods
+            maximum = self.conf.update_interval
+            if self.conf.ambient_light_measures_interval_max is not None:
+                maximum = min(maximum, self.conf.ambient_light_measures_interval_max)
+            interval = min(
+                self.ambient_light_sampling_interval * 2,
+                max(maximum, self.conf.ambient_light_measures_interval),
+            )
+        if interval != self.ambient_light_sampling_interval:
+            LOG.debug("Ambient light sampling interval: %ss", interval)
+        self.ambient_light_sampling_interval = interval
+        return interval
 
     def update_ambient_light_tendency(self):
-        self.ambient_light_values.append(self.get_ambient_light())
-        # Perhaps do better than simple mean
-        values = list(self.ambient_light_values)
-        if len(values) >= 3:
-            values.remove(max(values))
-            values.remove(min(values))
-        self.ambient_light_current = sum(values) / len(values)
+        """Take a new sample and return True if the light is moving"""
+        if self.ambient_light_events is not None:
+            # Light didn't leave the thresholds band, nothing to sample
+            if self.ambient_light_samples_pending <= 0:
+                return False
+            self.ambient_light_samples_pending -= 1
+
+        previous = self.ambient_light_current
+        with tracing.span("get_ambient_light"):
+            sample = self.get_ambient_light()
+        with tracing.span("filter"):
+            self.ambient_light_current = self.ambient_light_filter.update(sample)
+        self.record_history(history.SAMPLE)
         LOG.trace(
-            "self.ambient_light_currents of %s: %s"
-            % (values, self.ambient_light_current)
+            "Ambient light tendency: %s (last: %s)", self.ambient_light_current, sample
+        )
+
+        if (
+            self.ambient_light_events is not None
+            and self.ambient_light_samples_pending <= 0
+            and self.ambient_light_raw_last is not None
+        ):
+            try:
+                self.ambient_light_events.arm(
+                    *self.ambient_light_curve.band(
+                        self.ambient_light_raw_last,
+                        self.conf.ambient_light_delta_update,
+                    )
+                )
+            except IOError:
+                LOG.error("Fail to arm ambient light sensor thresholds")
+                self.ambient_light_samples_pending = 1
+
+        stable_delta = self.conf.ambient_light_delta_update / 2.0
+        return (
+            abs(self.ambient_light_current - previous) > stable_delta
+            or abs(sample - self.ambient_light_current) > stable_delta
+        )
+
+    def apply_ambient_light_tendency(self):
+        changed_enough = (
+            abs(self.ambient_light_current - self.ambient_light_last)
+            > self.conf.ambient_light_delta_update
+        )
+        if changed_enough:
+            self.ambient_light_last = self.ambient_light_filter.last
+            self.apply_ambient_light()
+
+    def screen_brightness_target(self):
+        target = self.ambient_light_last + self.screen_brightness_offset
+        ceiling = max(
+            self.conf.screen_brightness_ceiling, self.conf.screen_brightness_min
         )
+        return max(self.conf.screen_brightness_min, min(target, ceiling))
+
+    def apply_ambient_light(self):
+        self.brightnesses_set(self.screen_brightness_target(), self.ambient_light_last)
 
     def brightnesses_set(self, scr, kbd):
-        self.brightnesses_to_set = (scr, kbd)
-        self.brightnesses_have_to_change.set()
-
-    def brightness_update_thread(self):
-        self.brightnesses_have_to_change.wait(timeout=self.conf.update_interval)
-        if self.brightnesses_have_to_change.is_set():
-            scr, kbd = self.brightnesses_to_set
-            LOG.info("Update scr:%s, kbd:%s", scr, kbd)
-            with futures.ThreadPoolExecutor(max_workers=20) as executor:
-                futs = [
-                    executor.submit(self.fade_keyboard_brightness, kbd),
-                    executor.submit(self.fade_screen_brightness, scr),
-                ]
-                futures.wait(futs)
-                for fut in futs:
-                    fut.result()
-            self.brightnesses_have_to_change.clear()
+        # Running fades are retargeted, the latest request always wins
+        LOG.info("Update scr:%s, kbd:%s", scr, kbd)
+        self.record_history(history.DECISION, scr, kbd)
+        with tracing.span("brightnesses_set"):
+            self.fade_keyboard_brightness(kbd)
+            self.fade_screen_brightness(scr)
+            self.fade_outputs(scr, kbd)
 
     @staticmethod
     def read_sys_value(path):
-        LOG.trace("cat %s" % path)
-        with open(path) as f:
-            return f.read().strip()
+        LOG.trace("cat %s", path)
+        return sysfs.read(path)
+
+    @staticmethod
+    def read_sys_int(path):
+        LOG.trace("cat %s", path)
+        return sysfs.read_int(path)
 
     @staticmethod
     def write_sys_value(path, value):
-        LOG.trace("echo %s > %s" % (value, path))
-        with open(path, "w") as f:
-            f.write(value)
+        LOG.trace("echo %s > %s", value, path)
+        sysfs.write(path, value)
+
+    def lid_is_closed(self):
+        if self.lid_switch is not None:
+            return self.lid_switch.closed
+        if not self.lid_polled:
+            return False
+        # eg: "state:      closed"
+        try:
+            value = self.read_sys_value(syspath(LID_SYSPATH))
+        except IOError:
+            return False
+        return value.split()[-1] == "closed"
+
+    def setup_lid_switch(self):
+        for path in evdev.lid_devices(syspath):
+            try:
+                self.lid_switch = evdev.LidSwitch(path)
+            except OSError as e:
+                LOG.debug("Fail to open the lid switch %s: %s", path, e)
+                continue
+            LOG.debug("Lid switch: %s", path)
+            self.loop.add_reader(self.lid_switch.fileno(), self.on_lid_events)
+            return
+        self.lid_polled = os.path.exists(syspath(LID_SYSPATH))
+        if self.lid_polled:
+            LOG.debug("No readable lid switch, fallback to polling %s", LID_SYSPATH)
+        else:
+            LOG.debug("No lid found, considered always open")
 
-    @classmethod
-    def lid_is_closed(cls):
-        value = cls.read_sys_value(LID_SYSPATH)
-        return value == "closed"
+    def on_lid_events(self):
+        try:
+            changed = self.lid_switch.update()
+        except (OSError, EOFError) as e:
+            LOG.error("Fail to read the lid switch: %s", e)
+            self.loop.remove_reader(self.lid_switch.fileno())
+            self.lid_switch.close()
+            self.lid_switch = None
+            self.setup_lid_switch()
+            self.schedule_event_detection()
+            return
+        if changed:
+            self.event_detection()
+
+    def get_log_level(self):
+        if self.conf.debug:
+            return TRACE
+        elif self.conf.verbose:
+            return logging.DEBUG
+        elif self.conf.quiet:
+            return logging.ERROR
+        return logging.INFO
 
     def setup_logging(self):
         if self.conf.log:
             logging.basicConfig(filename=self.conf.log, level=logging.DEBUG)
             LOG.debug("Log level set to DEBUG")
         else:
-            if self.conf.debug:
-                level = TRACE
-            elif self.conf.verbose:
-                level = logging.DEBUG
-            elif self.conf.quiet:
-                level = logging.ERROR
-            else:
-                level = logging.INFO
-            logging.basicConfig(level=level)
+            logging.basicConfig(level=self.get_log_level())
 
     def enable_ambient_light(self):
         if self.conf.ambient_light_sensor != "als":
             return
         LOG.debug("Enable als ambient light")
-        path = os.path.join(ALS_SYSPATH, "enable") % "als"
+        path = syspath(os.path.join(ALS_SYSPATH, "enable") % "als")
         try:
             self.write_sys_value(path, "1")
         except IOError:
@@ -373,51 +1033,154 @@ class Daemon(object):
                 "are udev rules configured correctly ?"
             )
 
-        if self.conf.show_notifications:
-            notify_enabled = [
-                "notify-send",
-                "-c",
-                "device",
-                "-i",
-                _ROOT + "/active.svg",
-                "Ambient Light Sensor",
-                "Enabled",
-            ]
-            LOG.trace(list2cmdline(notify_enabled))
-            check_call(notify_enabled)
+        # Sent once the loop runs
+        self.notify("Enabled", "active.svg")
 
         # Ensure next read value will be up to date
         time.sleep(0.2)
 
+    def enable_ambient_light_buffer(self):
+        if not self.conf.ambient_light_buffered:
+            return
+        if self.ambient_light_iio is None:
+            LOG.info(
+                "Ambient light sensor buffer not supported by %s, "
+                "fallback to polling",
+                self.conf.ambient_light_sensor,
+            )
+            return
+        device_syspath, channel = self.ambient_light_iio
+        watermark = self.conf.ambient_light_measures_number
+        try:
+            self.ambient_light_buffer = iio.IIOBuffer(
+                device_syspath,
+                channel,
+                length=max(4 * watermark, 16),
+                watermark=watermark,
+                triggers_syspath=syspath(discovery.IIO_SYSPATH),
+            )
+        except (IOError, OSError) as e:
+            LOG.error(
+                "Fail to setup ambient light sensor buffer (%s), "
+                "fallback to polling",
+                e,
+            )
+
+    def enable_ambient_light_events(self):
+        if not self.conf.ambient_light_events:
+            return
+        if self.ambient_light_buffer is not None:
+            LOG.info("Ambient light sensor buffer enabled, events not needed")
+            return
+        if self.ambient_light_iio is None:
+            LOG.info(
+                "Ambient light sensor events not supported by %s, "
+                "fallback to polling",
+                self.conf.ambient_light_sensor,
+            )
+            return
+        device_syspath, channel = self.ambient_light_iio
+        try:
+            self.ambient_light_events = iio.IIOThresholdEvents(
+                device_syspath,
+                channel,
+                self.ambient_light_scale or 1.0,
+                self.ambient_light_offset,
+            )
+        except (IOError, OSError) as e:
+            LOG.error(
+                "Fail to setup ambient light sensor events (%s), "
+                "fallback to polling",
+                e,
+            )
+            return
+        self.ambient_light_samples_pending = self.conf.ambient_light_measures_number
+
+    def load_ambient_light_calibration(self):
+        path = self.conf.ambient_light_calibration_file
+        if not path or not os.path.exists(path):
+            return None
+        try:
+            with open(path) as f:
+                points = curve.parse_points(f.read())
+        except (IOError, ValueError) as e:
+            LOG.error("Fail to load ambient light calibration %s: %s", path, e)
+            return None
+        LOG.debug("Ambient light calibration loaded from %s", path)
+        return points
+
+    def save_ambient_light_calibration(self):
+        path = self.conf.ambient_light_calibration_file
+        if not path:
+            return
+        try:
+            with open(path, "w") as f:
+                f.write(curve.format_points(self.ambient_light_curve.points) + "\n")
+        except IOError as e:
+            LOG.error("Fail to save ambient light calibration %s: %s", path, e)
+
+    def calibrate_ambient_light(self, screen_brightness):
+        if self.ambient_light_raw_last is None:
+            return
+        percent = screen_brightness * 100.0 / self.conf.screen_brightness_max
+        # The curve gives the brightness without the user offset
+        percent = max(0.0, min(percent - self.screen_brightness_offset, 100.0))
+        LOG.info(
+            "Record ambient light calibration point %s:%s",
+            self.ambient_light_raw_last,
+            percent,
+        )
+        self.ambient_light_curve.add_point(self.ambient_light_raw_last, percent)
+        self.save_ambient_light_calibration()
+        self.ambient_light_last = percent
+
     def get_ambient_light(self):
-        # This mapping have been done for Asus Zenbook UX303UA, but according
+        # The default mapping have been done for Asus Zenbook UX303UA, but
+        # according
         # https://github.com/danieleds/Asus-Zenbook-Ambient-Light-Sensor-Controller/blob/master/service/main.cpp
         # previous/other Zenbook can report only 5 raws
-        path = ALS_INPUT_SYSPATH_MAP[self.conf.ambient_light_sensor]
         try:
-            raw = int(self.read_sys_value(path))
-        except IOError:
+            if self.ambient_light_scale is None:
+                raw = self.read_sys_int(self.ambient_light_path)
+            else:
+                # IIO processed values may have decimals
+                raw = self.scale_ambient_light(
+                    float(self.read_sys_value(self.ambient_light_path))
+                )
+        except (IOError, ValueError):
             LOG.error(
                 "Fail to read ambient light sensor value, "
                 "are udev rules configured correctly ?"
             )
-            raw, normalized = None, 100
-        else:
-            LOG.trace("Get ambient light (raw): %s)" % raw)
-            if raw > 0:
-                normalized = min(
-                    math.log10(raw) / self.conf.ambient_light_factor * 100.0, 100
-                )
-            else:
-                normalized = 0
-            LOG.debug("Get ambient light: %s (%s)", (normalized, raw))
+            return max(100, self.conf.screen_brightness_min)
+        return self.normalize_ambient_light(raw)
+
+    def scale_ambient_light(self, value):
+        if self.ambient_light_scale is None:
+            return int(value)
+        return int(
+            round((value + self.ambient_light_offset) * self.ambient_light_scale)
+        )
+
+    def scale_buffered_ambient_light(self, value):
+        return int(
+            round(
+                (value + self.ambient_light_raw_offset) * self.ambient_light_raw_scale
+            )
+        )
+
+    def normalize_ambient_light(self, raw):
+        self.ambient_light_raw_last = raw
+        LOG.trace("Get ambient light (raw): %s", raw)
+        normalized = self.ambient_light_curve.lookup(raw)
+        LOG.debug("Get ambient light: %s (%s)", normalized, raw)
         if normalized < self.conf.screen_brightness_min:
             normalized = self.conf.screen_brightness_min
         return normalized
 
     def get_screen_brightness_max(self):
-        value = int(
-            self.read_sys_value(
+        value = self.read_sys_int(
+            syspath(
                 os.path.join(
                     SCREEN_BACKLIGHT_SYSPATH,
                     self.conf.screen_backlight,
@@ -430,15 +1193,7 @@ class Daemon(object):
 
     def get_screen_brightness(self):
         try:
-            value = int(
-                self.read_sys_value(
-                    os.path.join(
-                        SCREEN_BACKLIGHT_SYSPATH,
-                        self.conf.screen_backlight,
-                        "brightness",
-                    )
-                )
-            )
+            value = self.read_sys_int(self.screen_brightness_path)
         except IOError:
             LOG.error(
                 "Fail to get screen brightness, "
@@ -447,100 +1202,162 @@ class Daemon(object):
         LOG.debug("Current screen backlight: %s", value)
         return value
 
-    def verify_if_something_changed_outside(self):
+    def setup_outside_change_events(self):
+        try:
+            self.uevent_monitor = uevent.UeventMonitor(self.loop)
+        except OSError as e:
+            LOG.error("Fail to listen kernel uevents (%s), fallback to polling", e)
+        else:
+            # The backlight class emits a change uevent for each brightness
+            # update, including hotkeys ones
+            self.uevent_monitor.subscribe("backlight", self.on_backlight_uevents)
+            self.screen_changes_notified = True
+            for subsystem in ("backlight", "leds", "iio"):
+                self.uevent_monitor.subscribe(subsystem, self.on_device_uevents)
+            self.uevent_monitor.subscribe("power_supply", self.on_power_supply_uevents)
+
+        if self.keyboard_brightness_path is None:
+            return
+        self.sysfs_notifier = sysfs.Notifier(self.loop)
+        path = os.path.join(
+            os.path.dirname(self.keyboard_brightness_path), "brightness_hw_changed"
+        )
+        if not os.path.exists(path):
+            LOG.debug("%s not available, fallback to polling", path)
+            return
+        try:
+            self.sysfs_notifier.watch(
+                path, self.verify_if_something_keyboard_changed_outside
+            )
+        except OSError as e:
+            LOG.error("Fail to watch %s (%s), fallback to polling", path, e)
+
+    def on_power_supply_uevents(self, uevents):
+        profile = power.select(self.conf.power_profile, syspath)
+        if profile != self.conf.profile:
+            self.reload()
+
+    def on_backlight_uevents(self, uevents):
+        if self.screen_fader.running:
+            # Sent for our own fade frames, the fader overwrites any outside
+            # change anyway, the uevent of its last frame is still checked
+            return
+        if any(u.name == self.conf.screen_backlight for u in uevents):
+            self.verify_if_something_screen_changed_outside()
+
+    def verify_if_something_changed_outside(self, polling=False):
+        # The keyboard is always polled, brightness_hw_changed only reports
+        # the firmware changes, not the writes of other programs
         self.verify_if_something_keyboard_changed_outside()
-        self.verify_if_something_screen_changed_outside()
+        if not (polling and self.screen_changes_notified):
+            self.verify_if_something_screen_changed_outside()
 
-    def something_have_changed_outside(self):
-        if self.conf.stop_on_outside_change:
+    def something_have_changed_outside(self, screen_brightness=None):
+        if self.paused:
+            return
+        elif self.conf.stop_on_outside_change:
             LOG.info("Brightness changed outside, exiting")
-            self._shutdown.set()
+            self.stop()
+        elif self.conf.ambient_light_calibrate and screen_brightness is not None:
+            LOG.info("Brightness changed outside, calibrating")
+            # Its next frame would overwrite the user brightness
+            self.screen_fader.cancel()
+            self.calibrate_ambient_light(screen_brightness)
         else:
             LOG.info("Brightness changed outside, restarting")
-            self.brightnesses_set(self.ambient_light_last, self.ambient_light_last)
+            self.apply_ambient_light()
 
     def verify_if_something_keyboard_changed_outside(self):
         keyboard_brightness = self.get_keyboard_brightness()
-        changed_outside = keyboard_brightness != self.last_keyboard_brightness
-        if changed_outside:
-            self.last_keyboard_brightness = keyboard_brightness
+        if self.keyboard_shadow.is_outside_change(keyboard_brightness):
+            self.keyboard_shadow.reset(keyboard_brightness)
+            self.metrics.outside_changes["keyboard"] += 1
             self.something_have_changed_outside()
 
     def verify_if_something_screen_changed_outside(self):
         screen_brightness = self.get_screen_brightness()
-        changed_outside = screen_brightness != self.last_screen_brightness
-        if changed_outside:
-            self.last_screen_brightness = screen_brightness
-            self.something_have_changed_outside()
+        if self.screen_shadow.is_outside_change(screen_brightness):
+            self.screen_shadow.reset(screen_brightness)
+            self.metrics.outside_changes["screen"] += 1
+            self.something_have_changed_outside(screen_brightness)
 
     def fade_screen_brightness(self, target):
         raw_target = int(self.conf.screen_brightness_max * float(target) / 100.0)
-        LOG.debug("Set screen backlight to %d%% (%d%%)", target, raw_target)
-        screen_brightness = self.get_screen_brightness()
+        LOG.debug("Set screen backlight to %d%% (%d)", target, raw_target)
+        self.fade_screen_output(
+            self.screen_fader, raw_target, self.conf.screen_brightness_max
+        )
 
-        diff = raw_target - screen_brightness
-        if diff == 0:
-            return
-        elif diff > 0:
-            step = 1
-            op = operator.ge
-        else:
-            step = -1
-            op = operator.le
-
-        interval = abs(self.conf.screen_brightness_time / diff)
-        # Sleeping less than 5ms doesn't looks good
-        while interval < 0.005:
-            interval *= 2
-            step *= 2
-
-        LOG.debug(
-            "%s -> %s (step:%s, interval: %s)",
-            screen_brightness,
+    def fade_screen_output(self, fader, raw_target, maximum):
+        fader.set_perceptual_target(
             raw_target,
-            step,
-            interval,
+            maximum,
+            self.conf.screen_brightness_time,
+            self.conf.screen_fade_fps,
+            self.conf.screen_fade_curve,
+            self.conf.screen_fade_easing,
         )
 
-        def is_finished():
-            return op(screen_brightness, raw_target)
+    def fade_outputs(self, scr, kbd):
+        for output in self.outputs:
+            if output.role == "screen":
+                raw_target = int(output.max_brightness * float(scr) / 100.0)
+                self.fade_screen_output(output.fader, raw_target, output.max_brightness)
+            else:
+                self.fade_keyboard_output(
+                    output.fader,
+                    output.shadow.value,
+                    self.keyboard_level(kbd, output.max_brightness),
+                )
 
-        screen_brightness += step
-        while not is_finished():
-            self.set_screen_brightness(screen_brightness)
-            time.sleep(interval)
-            screen_brightness += step
-        self.set_screen_brightness(raw_target)
+    def keyboard_level(self, percent, maximum):
+        return int(round(maximum * self.keyboard_curve(percent) / 100.0))
+
+    def fade_keyboard_output(self, fader, current, target):
+        # One step per frame for small ranges, large ones skip levels to
+        # fade within --keyboard-brightness-time
+        diff = abs(target - current)
+        if diff == 0:
+            # Fader ignores targets already reached
+            fader.set_target(target, 0, fade.MIN_FRAME_INTERVAL)
+            return
+        step_duration = self.conf.keyboard_brightness_step_duration
+        duration = min(diff * step_duration, self.conf.keyboard_brightness_time)
+        fader.set_target(target, duration, max(duration / diff, step_duration))
+
+    def set_output_brightness(self, output, value):
+        try:
+            output.write(value)
+        except IOError as e:
+            LOG.error("Fail to set %s brightness: %s", output, e)
 
     def set_screen_brightness(self, value):
-        self.verify_if_something_screen_changed_outside()
         try:
-            self.write_sys_value(
-                os.path.join(
-                    SCREEN_BACKLIGHT_SYSPATH, self.conf.screen_backlight, "brightness"
-                ),
-                "%d" % value,
-            )
+            self.write_sys_value(self.screen_brightness_path, int(value))
         except IOError:
             LOG.error(
                 "Fail to set screen brightness, "
                 "are udev rules configured correctly ? "
             )
-        self.last_screen_brightness = value
+        self.screen_shadow.wrote(value)
+
+    def get_keyboard_brightness_max(self):
+        if self.keyboard_brightness_path is None:
+            return 0
+        value = self.read_sys_int(
+            os.path.join(
+                os.path.dirname(self.keyboard_brightness_path), "max_brightness"
+            )
+        )
+        LOG.debug("Get keyboard backlight maximum: %d", value)
+        return value
 
     def get_keyboard_brightness(self):
-        if self.conf.keyboard_backlight is None:
+        if self.keyboard_brightness_path is None:
             return 0
 
-        # reading a just written value returns previous value so we sleep a
-        # bit...
-        time.sleep(0.1)
         try:
-            value = int(
-                self.read_sys_value(
-                    KEYBOARD_BACKLIGHT_SYSPATH % self.conf.keyboard_backlight
-                )
-            )
+            value = self.read_sys_int(self.keyboard_brightness_path)
         except IOError:
             LOG.error(
                 "Fail to set keyboard backlight, "
@@ -550,59 +1367,147 @@ class Daemon(object):
         return value
 
     def fade_keyboard_brightness(self, percent):
-        if self.conf.keyboard_backlight is None:
-            return
-        # NOTE(sileht): we currently support only the asus one
-        # so we assume value 0 to 3 are the correct range
-        enabled = percent < self.conf.keyboard_backlight_threshold
-        targets = range(1, 4) if enabled else range(2, -1, -1)
-
-        if targets[-1] == self.last_keyboard_brightness:
+        if self.keyboard_brightness_path is None:
             return
-
-        LOG.debug("Set keyboard backlight to %s", targets[-1])
-        for target in targets:
-            self.set_keyboard_brightness(target)
-            time.sleep(self.conf.keyboard_brightness_step_duration)
+        target = self.keyboard_level(percent, self.keyboard_brightness_max)
+        LOG.debug("Set keyboard backlight to %s", target)
+        self.fade_keyboard_output(
+            self.keyboard_fader, self.keyboard_shadow.value, target
+        )
 
     def set_keyboard_brightness(self, value):
-        self.verify_if_something_keyboard_changed_outside()
         try:
-            self.write_sys_value(
-                KEYBOARD_BACKLIGHT_SYSPATH % self.conf.keyboard_backlight, "%s" % value
-            )
+            self.write_sys_value(self.keyboard_brightness_path, value)
         except IOError:
             LOG.error(
                 "Fail to set keyboard backlight, "
                 "are udev rules configured correctly ?"
             )
-        self.last_keyboard_brightness = value
+        self.keyboard_shadow.wrote(value)
 
 
-def main():
-    available_screen_backlight_modules = [
-        mod
-        for mod in SUPPORTED_SCREEN_BACKLIGHT_MODULES
-        if os.path.exists(os.path.join(SCREEN_BACKLIGHT_SYSPATH, mod))
-    ]
-    if not available_screen_backlight_modules:
-        LOG.error(
-            "No supported backlight found (%s)", SUPPORTED_SCREEN_BACKLIGHT_MODULES
-        )
+def add_metrics_arguments(parser):
+    group = parser.add_argument_group("metrics")
+    group.add_argument(
+        "--metrics-socket",
+        nargs="?",
+        const=metrics.default_socket_path(),
+        help=(
+            "Serve Prometheus metrics on this unix socket (default: %s)"
+            % metrics.default_socket_path()
+        ),
+    )
+    group.add_argument(
+        "--metrics-port",
+        type=int,
+        help="Serve Prometheus metrics on this localhost port",
+    )
+    group.add_argument(
+        "--stats",
+        action="store_true",
+        help="Print the metrics of the running daemon and exit",
+    )
+    return group
+
+
+def add_history_arguments(parser):
+    group = parser.add_argument_group("history")
+    group.add_argument(
+        "--history",
+        default=history.default_path(),
+        help=(
+            "Ring buffer file recording the ambient light samples and the "
+            "brightness decisions, read it with 'solard dump'"
+        ),
+    )
+    group.add_argument(
+        "--no-history",
+        dest="history",
+        action="store_const",
+        const=None,
+        help="Disable the history",
+    )
+    group.add_argument(
+        "--history-size",
+        default=65536,
+        type=positive_int,
+        help="Number of records kept in the history, %d bytes each"
+        % history.RECORD.size,
+    )
+    return group
+
+
+def select_devices(conf):
+    """Select the devices not given on the command line
+
+    The devices index is only loaded when something needs to be discovered.
+    """
+
+    def index():
+        return discovery.get_index(syspath, conf.device_cache or None)
+
+    if conf.screen_backlight is None:
+        backlights = index().find("backlight")
+        if not backlights:
+            LOG.error("No screen backlight found")
+            sys.exit(1)
+        conf.screen_backlight = backlights[0]["name"]
+    elif not os.path.exists(
+        syspath(os.path.join(SCREEN_BACKLIGHT_SYSPATH, conf.screen_backlight))
+    ):
+        LOG.error("The screen backlight %s is not available", conf.screen_backlight)
+        sys.exit(1)
+
+    if conf.keyboard_backlight is None:
+        leds = index().find("led")
+        conf.keyboard_backlight = leds[0]["name"] if leds else None
+    elif not os.path.exists(
+        syspath(KEYBOARD_BACKLIGHT_SYSPATH % conf.keyboard_backlight)
+    ):
+        LOG.error("The keyboard backlight %s is not available", conf.keyboard_backlight)
         sys.exit(1)
 
-    available_als_modules = [
-        mod for mod in SUPPORTED_ALS_MODULES if os.path.exists(ALS_SYSPATH % mod)
-    ]
-    if not available_als_modules:
-        LOG.error("No support ambient light sensor found (%s)", SUPPORTED_ALS_MODULES)
+    sensor = conf.ambient_light_sensor
+    if sensor is None:
+        sensors = index().find("als")
+        if sensors:
+            conf.ambient_light_sensor = sensors[0]["name"]
+        elif os.path.exists(syspath(ALS_SYSPATH % "als")):
+            conf.ambient_light_sensor = "als"
+        else:
+            LOG.error("No ambient light sensor found")
+            sys.exit(1)
+    elif sensor in ALS_INPUT_SYSPATH_MAP:
+        if not os.path.exists(syspath(ALS_SYSPATH % sensor)):
+            LOG.error("The ambient light sensor %s is not available", sensor)
+            sys.exit(1)
+    elif not os.path.exists(syspath(os.path.join(discovery.IIO_SYSPATH, sensor))):
+        LOG.error("The ambient light sensor %s is not available", sensor)
         sys.exit(1)
 
-    available_keyboard_backlight_modules = [
-        mod
-        for mod in SUPPORTED_KEYBOARD_BACKLIGHT_MODULES
-        if os.path.exists(KEYBOARD_BACKLIGHT_SYSPATH % mod)
-    ]
+
+def add_control_arguments(parser):
+    group = parser.add_argument_group("control")
+    group.add_argument(
+        "--control-socket",
+        default=control.default_socket_path(),
+        help="Unix socket to control the daemon with",
+    )
+    group.add_argument(
+        "--no-control-socket",
+        dest="control_socket",
+        action="store_const",
+        const=None,
+        help="Disable the control socket",
+    )
+    return group
+
+
+def parse_args(args=None):
+    args = sys.argv[1:] if args is None else list(args)
+    config_parser = argparse.ArgumentParser(add_help=False)
+    config_parser.add_argument("--config", default=default_config_path())
+    config = config_parser.parse_known_args(args)[0].config
 
     parser = argparse.ArgumentParser(
         description=(
@@ -615,6 +1520,20 @@ def main():
     parser.add_argument(
         "--log", help=("log file, disable stdout output and " "set log level to DEBUG")
     )
+    parser.add_argument(
+        "--trace",
+        metavar="FILE",
+        help=(
+            "Record the time spent in each cycle, fade frame and sysfs "
+            "access, written as Chrome trace events on exit and SIGUSR2"
+        ),
+    )
+    parser.add_argument(
+        "--trace-size",
+        default=65536,
+        type=positive_int,
+        help="Number of spans kept in memory when tracing",
+    )
     parser.add_argument(
         "--stop-on-outside-change",
         action="store_true",
@@ -627,10 +1546,18 @@ def main():
         type=float,
         help="Interval between brightness update",
     )
+    parser.add_argument(
+        "--config",
+        default=default_config_path(),
+        help=(
+            "File with one command line option per line, read on startup "
+            "and on SIGHUP, command line options take precedence"
+        ),
+    )
     parser.add_argument(
         "--show-notifications",
         action="store_true",
-        help=("Show notification on daemon startup and " "shutdown"),
+        help="Show notification on daemon startup, shutdown, pause and resume",
     )
 
     # Dim configuration
@@ -647,6 +1574,25 @@ def main():
         type=int,
         help=("Minimal percent of allowed brightness for " "idle dim"),
     )
+    group.add_argument(
+        "--idle-backend",
+        default="x11",
+        choices=["x11", "evdev"],
+        help=(
+            "Detect the user activity with the X server, or from the input "
+            "devices, the user must be allowed to read them"
+        ),
+    )
+    group.add_argument(
+        "--idle-input-device",
+        dest="idle_input_devices",
+        action="append",
+        default=[],
+        help=(
+            "Input device watched by the evdev idle backend, can be repeated "
+            "(default: all keyboards, pointers and touch devices)"
+        ),
+    )
 
     # Ambient light sensor configuration
     group = parser.add_argument_group("ambient light sensor adjustments")
@@ -657,6 +1603,28 @@ def main():
         type=float,
         help="Ambient Light to brightness factor",
     )
+    group.add_argument(
+        "--ambient-light-curve",
+        help=(
+            "Ambient light to brightness control points, as "
+            "'raw:percent,raw:percent,...', replaces --ambient-light-factor"
+        ),
+    )
+    group.add_argument(
+        "--ambient-light-calibrate",
+        action="store_true",
+        help=(
+            "Record brightness changed outside as new ambient light to "
+            "brightness control points"
+        ),
+    )
+    group.add_argument(
+        "--ambient-light-calibration-file",
+        help=(
+            "File to load the ambient light control points from and to save "
+            "calibration to"
+        ),
+    )
     group.add_argument(
         "--ambient-light-delta-update",
         "-u",
@@ -677,7 +1645,58 @@ def main():
         "--ambient-light-measures-interval",
         default=0.2,
         type=float,
-        help=("Interval between ambient light measures " "acquisiston."),
+        help=(
+            "Interval between ambient light measures acquisiston while the "
+            "light is changing."
+        ),
+    )
+    group.add_argument(
+        "--ambient-light-measures-interval-max",
+        type=float,
+        help=(
+            "Maximum interval between ambient light measures acquisiston, "
+            "the interval doubles up to this value while the light is stable "
+            "(default and upper bound: --update-interval, use "
+            "--ambient-light-events to sample less often)"
+        ),
+    )
+    group.add_argument(
+        "--ambient-light-filter",
+        default="trimmed-mean",
+        choices=filters.FILTERS,
+        help=(
+            "Filter used to smooth ambient light measures, trimmed-mean, ema "
+            "and median work on the last --ambient-light-measures-number "
+            "measures"
+        ),
+    )
+    group.add_argument(
+        "--ambient-light-kalman-process-noise",
+        default=0.1,
+        type=float,
+        help="Variance of the ambient light changes for the kalman filter",
+    )
+    group.add_argument(
+        "--ambient-light-kalman-measurement-noise",
+        default=4.0,
+        type=float,
+        help="Variance of the ambient light sensor noise for the kalman filter",
+    )
+    group.add_argument(
+        "--ambient-light-buffered",
+        action="store_true",
+        help=(
+            "Read timestamped ambient light samples in batches from the IIO "
+            "buffer instead of polling the sensor (IIO sensors only)"
+        ),
+    )
+    group.add_argument(
+        "--ambient-light-events",
+        action="store_true",
+        help=(
+            "Wait for ambient light sensor threshold events instead of "
+            "polling it (IIO sensors with threshold events only)"
+        ),
     )
     # Brightness update configuration
     group = parser.add_argument_group("brightness smooth update configuration")
@@ -688,6 +1707,18 @@ def main():
         type=int,
         help="Minimal percent of allowed brightness",
     )
+    group.add_argument(
+        "--screen-brightness-ceiling",
+        default=100,
+        type=int,
+        help="Maximal percent of brightness set from the ambient light",
+    )
+    group.add_argument(
+        "--screen-brightness-offset",
+        default=0,
+        type=float,
+        help="Percent added to the brightness computed from the ambient light",
+    )
     group.add_argument(
         "--screen-brightness-time",
         "-t",
@@ -695,17 +1726,55 @@ def main():
         type=float,
         help="Duration of screen brightness change in seconds",
     )
+    group.add_argument(
+        "--screen-fade-curve",
+        default="cie",
+        choices=fade.CURVES,
+        help=(
+            "Space in which screen fades are linear: raw values, gamma 2.2 "
+            "or CIE L* lightness"
+        ),
+    )
+    group.add_argument(
+        "--screen-fade-fps",
+        default=60,
+        type=positive_float,
+        help="Frames per second of screen fades, bounds the number of writes",
+    )
+    group.add_argument(
+        "--no-screen-fade-easing",
+        dest="screen_fade_easing",
+        action="store_false",
+        help="Don't ease in and out screen fades",
+    )
     group.add_argument(
         "--keyboard-backlight-threshold",
         default=10,
         type=float,
-        help="Keyboard backlight activation threshold (0-100)",
+        help=(
+            "Ambient light percent above which the keyboard backlight is "
+            "off, it fades out from half of it (0-100)"
+        ),
+    )
+    group.add_argument(
+        "--keyboard-backlight-curve",
+        help=(
+            "Ambient light percent to keyboard backlight percent control "
+            "points, as 'percent:percent,...', replaces "
+            "--keyboard-backlight-threshold"
+        ),
     )
     group.add_argument(
         "--keyboard-brightness-step-duration",
         default=0.005,
         type=float,
-        help="Duration between keyboard brightness step",
+        help="Minimal duration between keyboard brightness step",
+    )
+    group.add_argument(
+        "--keyboard-brightness-time",
+        default=0.5,
+        type=float,
+        help="Maximal duration of keyboard brightness change in seconds",
     )
 
     # Drivers config
@@ -713,33 +1782,191 @@ def main():
     group.add_argument(
         "--screen-backlight",
         "-s",
-        default=available_screen_backlight_modules[0],
-        choices=available_screen_backlight_modules,
-        help="Screen backlight kernel module",
+        help=(
+            "Screen backlight, a /sys/class/backlight device "
+            "(default: firmware, then platform, then raw ones)"
+        ),
     )
     group.add_argument(
         "--keyboard-backlight",
         "-k",
-        default=(
-            available_keyboard_backlight_modules[0]
-            if available_keyboard_backlight_modules
-            else 0
+        help=(
+            "Keyboard backlight, a /sys/class/leds/*kbd_backlight device "
+            "(default: the first one)"
+        ),
+    )
+    group.add_argument(
+        "--output",
+        dest="outputs",
+        action="append",
+        type=outputs.parse_spec,
+        metavar="KIND=NAME",
+        help=(
+            "Additional output faded along the screen or keyboard backlight, "
+            "KIND is backlight, led or an Output subclass import path "
+            "(eg: backlight=amdgpu_bl0, led=tpacpi::kbd_backlight)"
         ),
-        choices=available_keyboard_backlight_modules,
-        help="Keyboard backlight kernel module",
+    )
+    group.add_argument(
+        "--all-outputs",
+        action="store_true",
+        help="Fade all screen backlights and keyboard leds found",
     )
     group.add_argument(
         "--ambient-light-sensor",
         "-a",
-        default=available_als_modules[0],
-        choices=available_als_modules,
-        help="Ambient Light Sensor kernel module",
+        help=(
+            "Ambient Light Sensor, an IIO device with an illuminance channel "
+            "(eg: iio:device0), or the acpi_als or als kernel module "
+            "(default: the first IIO one)"
+        ),
+    )
+    group.add_argument(
+        "--device-cache",
+        default=discovery.default_cache_path(),
+        help="Devices discovery cache file, empty to disable it",
+    )
+
+    add_metrics_arguments(parser)
+    add_control_arguments(parser)
+    add_history_arguments(parser)
+
+    group = parser.add_argument_group("power profiles")
+    group.add_argument(
+        "--power-profile",
+        default="auto",
+        choices=["auto"] + power.PROFILES,
+        help=(
+            "Options profile to use, auto follows the power supplies and "
+            "switches when they are plugged or unplugged"
+        ),
+    )
+    group.add_argument(
+        "--ac-profile",
+        default="",
+        help="Options added when running on AC, eg: '--screen-brightness-time 1'",
+    )
+    group.add_argument(
+        "--battery-profile",
+        default=DEFAULT_BATTERY_PROFILE,
+        help=(
+            "Options added when running on battery, default: '%s'"
+            % DEFAULT_BATTERY_PROFILE
+        ),
+    )
+
+    conf = parser.parse_args(load_config(config) + args)
+    profile = power.select(conf.power_profile, syspath)
+    try:
+        profile_args = shlex.split(getattr(conf, "%s_profile" % profile))
+    except ValueError as e:
+        parser.error("invalid --%s-profile: %s" % (profile, e))
+    if profile_args:
+        conf = parser.parse_args(load_config(config) + args + profile_args)
+    # Kept to reload the configuration
+    conf.argv = args
+    conf.profile = profile
+
+    select_devices(conf)
+    return conf
+
+
+def print_stats(args=None):
+    parser = argparse.ArgumentParser(add_help=False)
+    add_metrics_arguments(parser)
+    conf, _ = parser.parse_known_args(args)
+    if conf.metrics_port is not None and conf.metrics_socket is None:
+        path = None
+    else:
+        path = conf.metrics_socket or metrics.default_socket_path()
+    try:
+        sys.stdout.write(metrics.fetch(path, conf.metrics_port))
+    except OSError as e:
+        LOG.error("Fail to get metrics, is solard running with metrics ? (%s)", e)
+        sys.exit(1)
+
+
+def send_control_command(args=None):
+    parser = argparse.ArgumentParser(add_help=False)
+    add_control_arguments(parser)
+    conf, words = parser.parse_known_args(args)
+    try:
+        response = control.send(
+            conf.control_socket or control.default_socket_path(), words[0], words[1:]
+        )
+    except (OSError, ValueError) as e:
+        LOG.error("Fail to contact solard, is it running ? (%s)", e)
+        return 1
+    if not response.get("ok"):
+        LOG.error("%s", response.get("error"))
+        return 1
+    for key, value in sorted(response.get("status", {}).items()):
+        print("%s: %s" % (key, value))
+    return 0
+
+
+def dump_history(args=None):
+    parser = argparse.ArgumentParser(add_help=False)
+    add_history_arguments(parser)
+    conf = parser.parse_known_args(args)[0]
+    if conf.history is None:
+        return 0
+    writer = csv.writer(sys.stdout)
+    writer.writerow(
+        ["timestamp", "kind", "state", "raw", "filtered", "screen", "keyboard"]
     )
+    try:
+        for record in history.read(conf.history):
+            writer.writerow(
+                [
+                    "%.6f" % (record.timestamp / 1e9),
+                    history.KINDS.get(record.kind, record.kind),
+                    State(record.state).name if record.state < len(State) else "",
+                    "" if record.raw < 0 else record.raw,
+                    "%g" % record.filtered,
+                    "%g" % record.screen,
+                    "%g" % record.keyboard,
+                ]
+            )
+    except (OSError, ValueError) as e:
+        LOG.error("Fail to read the history: %s", e)
+        return 1
+    return 0
 
-    conf = parser.parse_args()
+
+def is_dump_command(args):
+    parser = argparse.ArgumentParser(add_help=False)
+    add_history_arguments(parser)
+    words = parser.parse_known_args(args)[1]
+    return words[:1] == ["dump"]
+
+
+def is_control_command(args):
+    parser = argparse.ArgumentParser(add_help=False)
+    add_control_arguments(parser)
+    words = parser.parse_known_args(args)[1]
+    return bool(words) and words[0] in control.COMMANDS
+
+
+def main():
+    if is_control_command(sys.argv[1:]):
+        logging.basicConfig()
+        sys.exit(send_control_command(sys.argv[1:]))
+    if is_dump_command(sys.argv[1:]):
+        logging.basicConfig()
+        sys.exit(dump_history(sys.argv[1:]))
+    if "--stats" in sys.argv[1:]:
+        # Don't require the devices to query a running daemon
+        logging.basicConfig()
+        print_stats()
+        return
+    conf = parse_args()
     daemon = Daemon(conf)
     daemon.setup_logging()
+    daemon.check_single_instance()
     daemon.enable_ambient_light()
+    daemon.enable_ambient_light_buffer()
+    daemon.enable_ambient_light_events()
     daemon.run()
 
 
@@ -0,0 +1,480 @@
+#
+# Licensed under the Apache License, Version 4.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark the daemon against a fake sysfs tree and a scripted X server
+
+Usage: python -m solard.bench [--trace FILE] [--duration S] [-- DAEMON ARGS]
+
+The trace is a CSV file with a "time,lux[,idle[,lid]]" row per change: the
+time in seconds from the start, the raw ambient light sensor value, the
+user idle time in seconds at that time and the lid state (open/closed).
+Without trace, a random one is generated.
+"""
+
+import argparse
+import bisect
+import collections
+import json
+import logging
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import solard
+from solard import sysfs
+
+
+SCREEN_BACKLIGHT = "intel_backlight"
+SCREEN_BRIGHTNESS_MAX = 1000
+KEYBOARD_BACKLIGHT = "asus::kbd_backlight"
+# Only faded with --all-outputs
+EXTRA_SCREEN_BACKLIGHT = "acpi_video0"
+EXTRA_KEYBOARD_BACKLIGHT = "platform::kbd_backlight"
+ALS = "acpi_als"
+
+DAEMON_ARGS = [
+    "--screen-backlight",
+    SCREEN_BACKLIGHT,
+    "--keyboard-backlight",
+    KEYBOARD_BACKLIGHT,
+    "--ambient-light-sensor",
+    ALS,
+    # Don't interfere with the user daemon
+    "--config",
+    "",
+    "--device-cache",
+    "",
+    "--no-control-socket",
+    "--no-history",
+]
+
+# Measured in a fresh interpreter, the benchmark itself has loaded them
+IMPORT_SCRIPT = """
+import sys, time
+start = time.perf_counter()
+import solard
+elapsed = time.perf_counter() - start
+with open("/proc/self/statm") as f:
+    rss = int(f.read().split()[1]) * __import__("os").sysconf("SC_PAGE_SIZE")
+print(elapsed, rss, int("Xlib" in sys.modules))
+"""
+
+TracePoint = collections.namedtuple("TracePoint", ["time", "lux", "idle", "lid"])
+
+
+def load_trace(path):
+    points = []
+    with open(path) as f:
+        for line in f:
+            fields = [field.strip() for field in line.split(",")]
+            if not fields[0] or fields[0].startswith("#") or fields[0] == "time":
+                continue
+            points.append(
+                TracePoint(
+                    float(fields[0]),
+                    int(fields[1]),
+                    float(fields[2]) if len(fields) > 2 else 0.0,
+                    fields[3] if len(fields) > 3 else "open",
+                )
+            )
+    return sorted(points)
+
+
+def random_trace(duration, seed=None):
+    rand = random.Random(seed)
+    points = []
+    t = 0.0
+    lux = 100
+    while t < duration:
+        if rand.random() < 0.3:
+            # Noise around the current level
+            lux = max(0, lux + rand.randint(-5, 5))
+        else:
+            lux = rand.choice([0, 5, 30, 100, 300, 1000, 3000])
+        points.append(TracePoint(t, lux, 0.0, "open"))
+        t += rand.uniform(1, 5)
+    return points
+
+
+class FakeSysfs(object):
+    def __init__(self, root):
+        self.root = root
+        self.lid_path = self._create(solard.LID_SYSPATH, "state:      open")
+        backlight = os.path.join(solard.SCREEN_BACKLIGHT_SYSPATH, SCREEN_BACKLIGHT)
+        self._create(os.path.join(backlight, "max_brightness"), SCREEN_BRIGHTNESS_MAX)
+        self.screen_path = self._create(
+            os.path.join(backlight, "brightness"), SCREEN_BRIGHTNESS_MAX // 2
+        )
+        keyboard = solard.KEYBOARD_BACKLIGHT_SYSPATH % KEYBOARD_BACKLIGHT
+        self._create(os.path.join(os.path.dirname(keyboard), "max_brightness"), 3)
+        self._create(keyboard, 0)
+        extra = os.path.join(solard.SCREEN_BACKLIGHT_SYSPATH, EXTRA_SCREEN_BACKLIGHT)
+        self._create(os.path.join(extra, "max_brightness"), 100)
+        self._create(os.path.join(extra, "brightness"), 50)
+        extra = solard.KEYBOARD_BACKLIGHT_SYSPATH % EXTRA_KEYBOARD_BACKLIGHT
+        self._create(os.path.join(os.path.dirname(extra), "max_brightness"), 2)
+        self._create(extra, 0)
+        self.als_path = self._create(solard.ALS_INPUT_SYSPATH_MAP[ALS], 0)
+
+    def _create(self, path, value):
+        path = os.path.join(self.root, path.lstrip("/"))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.write(path, value)
+        return path
+
+    @staticmethod
+    def write(path, value):
+        with open(path, "w") as f:
+            f.write("%s\n" % value)
+
+    def apply(self, point):
+        self.write(self.als_path, point.lux)
+        self.write(self.lid_path, "state:      %s" % point.lid)
+
+
+class ScriptedIdle(object):
+    """XScreenSaverQuerier replaying the trace idle times"""
+
+    # Never raised, the trace doesn't lose its X server
+    ConnectionClosedError = ConnectionError
+
+    def __init__(self, trace, clock):
+        self.times = [point.time for point in trace]
+        self.trace = trace
+        self.clock = clock
+        self.start = None
+        self.round_trips = 0
+        # Idle times are always polled
+        self.idle_alarms = None
+
+    def get_idle(self):
+        self.round_trips += 1
+        if self.start is None or not self.trace:
+            return 0
+        now = self.clock() - self.start
+        index = bisect.bisect_right(self.times, now) - 1
+        if index < 0 or self.trace[index].idle <= 0:
+            return 0
+        point = self.trace[index]
+        return int((point.idle + now - point.time) * 1000)
+
+    def is_idle(self, timeout):
+        return self.get_idle() > timeout
+
+
+class SyscallCounter(object):
+    """os module proxy counting the syscalls done by solard.sysfs"""
+
+    # ftruncate is only there to emulate sysfs on regular files
+    COUNTED = ("open", "close", "preadv", "pread", "pwrite", "read", "write")
+
+    def __init__(self, module):
+        self._module = module
+        self.total = 0
+
+    def __getattr__(self, name):
+        attr = getattr(self._module, name)
+        if name not in self.COUNTED:
+            return attr
+
+        def counted(*args, **kwargs):
+            self.total += 1
+            return attr(*args, **kwargs)
+
+        return counted
+
+
+def percentile(values, percent):
+    if not values:
+        return None
+    values = sorted(values)
+    index = max(0, int(round(percent / 100.0 * len(values) + 0.5)) - 1)
+    return values[min(index, len(values) - 1)]
+
+
+def mean(values):
+    return sum(values) / len(values) if values else None
+
+
+class Bench(object):
+    def __init__(self, trace, duration, daemon_args):
+        self.trace = trace
+        self.duration = duration
+        self.daemon_args = daemon_args
+
+        self.root = tempfile.mkdtemp(prefix="solard-bench-")
+        self.fake = FakeSysfs(self.root)
+        self.syscalls = SyscallCounter(os)
+
+        self.decisions = []
+        self.fades = []
+        self._fade_syscalls_start = None
+        self.first_decision = None
+
+    def create_daemon(self):
+        bench = self
+
+        class BenchDaemon(solard.Daemon):
+            @staticmethod
+            def get_xscreensaver_querier():
+                return ScriptedIdle(bench.trace, time.monotonic)
+
+            def apply_ambient_light_tendency(self):
+                if bench.first_decision is None:
+                    bench.first_decision = time.perf_counter()
+                super(BenchDaemon, self).apply_ambient_light_tendency()
+
+            def brightnesses_set(self, scr, kbd):
+                bench.decisions.append(self.loop.time())
+                super(BenchDaemon, self).brightnesses_set(scr, kbd)
+
+            def fade_screen_brightness(self, target):
+                if not self.screen_fader.running:
+                    bench._fade_syscalls_start = bench.syscalls.total
+                super(BenchDaemon, self).fade_screen_brightness(target)
+
+        conf = solard.parse_args(DAEMON_ARGS + self.daemon_args)
+        daemon = BenchDaemon(conf)
+        daemon.screen_fader.on_finished = self.on_fade_finished
+        self.daemon = daemon
+        return daemon
+
+    def on_fade_finished(self, planned, elapsed):
+        syscalls = None
+        if self._fade_syscalls_start is not None:
+            syscalls = self.syscalls.total - self._fade_syscalls_start
+        self.fades.append((self.daemon.loop.time(), planned, elapsed, syscalls))
+
+    def run(self):
+        solard.SYSFS_ROOT = self.root
+        sysfs.POOL = sysfs.Pool(truncate=True)
+        sysfs.os = self.syscalls
+        try:
+            if self.trace:
+                self.fake.apply(self.trace[0])
+            startup = time.perf_counter()
+            daemon = self.create_daemon()
+            daemon.enable_ambient_light()
+            daemon.enable_ambient_light_buffer()
+            daemon.enable_ambient_light_events()
+
+            loop = daemon.loop
+            self.start = loop.time()
+            if daemon.xscreensaver_querier is not None:
+                daemon.xscreensaver_querier.start = time.monotonic()
+            for point in self.trace:
+                loop.call_at(self.start + point.time, self.fake.apply, point)
+            loop.call_at(self.start + self.duration, daemon.stop)
+
+            cpu = time.process_time()
+            daemon.run()
+            self.cpu = time.process_time() - cpu
+            self.wall = loop.time() - self.start
+            if self.first_decision is not None:
+                self.first_decision -= startup
+        finally:
+            sysfs.os = os
+            sysfs.POOL = sysfs.Pool()
+            solard.SYSFS_ROOT = "/"
+            shutil.rmtree(self.root, ignore_errors=True)
+        return self.report()
+
+    def report(self):
+        changes = [
+            self.start + point.time
+            for previous, point in zip(self.trace, self.trace[1:])
+            if point.lux != previous.lux and point.time < self.duration
+        ]
+        reactions = []
+        latencies = []
+        fade_ends = [end for end, _, _, _ in self.fades]
+        for index, change in enumerate(changes):
+            next_change = changes[index + 1] if index + 1 < len(changes) else None
+            i = bisect.bisect_left(self.decisions, change)
+            if i < len(self.decisions) and (
+                next_change is None or self.decisions[i] < next_change
+            ):
+                reactions.append(self.decisions[i] - change)
+            i = bisect.bisect_left(fade_ends, change)
+            if i < len(fade_ends) and (
+                next_change is None or fade_ends[i] < next_change
+            ):
+                latencies.append(fade_ends[i] - change)
+
+        errors = [elapsed - planned for _, planned, elapsed, _ in self.fades]
+        syscalls = [n for _, _, _, n in self.fades if n is not None]
+        querier = self.daemon.xscreensaver_querier
+        import_time, import_rss, x_loaded = measure_import()
+        return collections.OrderedDict(
+            [
+                ("duration", self.wall),
+                ("light_changes", len(changes)),
+                ("fades", len(self.fades)),
+                (
+                    "reaction_latency",
+                    {p: percentile(reactions, p) for p in (50, 90, 99)},
+                ),
+                (
+                    "applied_latency",
+                    {p: percentile(latencies, p) for p in (50, 90, 99)},
+                ),
+                ("syscalls_per_fade", mean(syscalls)),
+                ("cpu_seconds_per_hour", self.cpu / self.wall * 3600),
+                ("fade_duration_error_mean", mean(errors)),
+                ("fade_duration_error_max", max(errors) if errors else None),
+                (
+                    "screen_frames",
+                    {
+                        "planned": self.daemon.screen_fader.frames_planned,
+                        "written": self.daemon.screen_fader.frames_written,
+                        "dropped": self.daemon.screen_fader.frames_dropped,
+                    },
+                ),
+                ("frame_clock_ticks", self.daemon.frame_clock.ticks),
+                ("idle_round_trips", querier.round_trips if querier else 0),
+                (
+                    "startup",
+                    {
+                        "import": import_time,
+                        "first_decision": self.first_decision,
+                        "total": (
+                            import_time + self.first_decision
+                            if self.first_decision is not None
+                            else None
+                        ),
+                        "rss": import_rss,
+                        "x_loaded": x_loaded,
+                    },
+                ),
+            ]
+        )
+
+
+def measure_import():
+    """Import time, RSS and whether X libraries are loaded after import"""
+    root = os.path.dirname(os.path.dirname(os.path.abspath(solard.__file__)))
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        filter(None, [root, os.environ.get("PYTHONPATH")])
+    )
+    output = subprocess.check_output([sys.executable, "-c", IMPORT_SCRIPT], env=env)
+    elapsed, rss, x_loaded = output.split()
+    return float(elapsed), int(rss), bool(int(x_loaded))
+
+
+def format_seconds(value):
+    if value is None:
+        return "n/a"
+    return "%.1fms" % (value * 1000)
+
+
+def print_report(report):
+    print("Runtime: %.1fs" % report["duration"])
+    print("Light changes: %d, fades: %d" % (report["light_changes"], report["fades"]))
+    for name in ("reaction_latency", "applied_latency"):
+        print(
+            "%s: %s"
+            % (
+                name.replace("_", " ").capitalize(),
+                ", ".join(
+                    "p%d=%s" % (p, format_seconds(v))
+                    for p, v in sorted(report[name].items())
+                ),
+            )
+        )
+    if report["syscalls_per_fade"] is not None:
+        print("Sysfs syscalls per fade: %.1f" % report["syscalls_per_fade"])
+    print("CPU time per hour: %.2fs" % report["cpu_seconds_per_hour"])
+    print(
+        "Fade duration error: mean=%s, max=%s"
+        % (
+            format_seconds(report["fade_duration_error_mean"]),
+            format_seconds(report["fade_duration_error_max"]),
+        )
+    )
+    print(
+        "Screen frames: planned=%(planned)d, written=%(written)d, "
+        "dropped=%(dropped)d" % report["screen_frames"]
+    )
+    print("Frame clock wakeups: %d" % report["frame_clock_ticks"])
+    print("Idle queries: %d" % report["idle_round_trips"])
+    startup = report["startup"]
+    print(
+        "Startup: import=%s, first decision=%s, total=%s, RSS=%.1fMiB, X loaded: %s"
+        % (
+            format_seconds(startup["import"]),
+            format_seconds(startup["first_decision"]),
+            format_seconds(startup["total"]),
+            startup["rss"] / 1024.0 / 1024.0,
+            "yes" if startup["x_loaded"] else "no",
+        )
+    )
+
+
+def main(args=None):
+    args = sys.argv[1:] if args is None else args
+    if "--" in args:
+        index = args.index("--")
+        args, daemon_args = args[:index], args[index + 1 :]
+    else:
+        daemon_args = []
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark solard against a fake sysfs tree"
+    )
+    parser.add_argument("--trace", help="CSV trace file: time,lux[,idle[,lid]]")
+    parser.add_argument("--duration", type=float, help="Benchmark duration in seconds")
+    parser.add_argument("--seed", type=int, help="Random trace seed")
+    parser.add_argument("--json", action="store_true", help="Output JSON")
+    parser.add_argument(
+        "--startup-budget",
+        type=float,
+        help="Fail if the import and first brightness decision take longer (s)",
+    )
+    parser.add_argument("--verbose", "-v", action="store_true")
+    conf = parser.parse_args(args)
+
+    logging.basicConfig(level=logging.DEBUG if conf.verbose else logging.WARNING)
+
+    if conf.trace:
+        trace = load_trace(conf.trace)
+        duration = conf.duration or (trace[-1].time + 5 if trace else 0)
+    else:
+        duration = conf.duration or 30
+        trace = random_trace(duration, conf.seed)
+
+    report = Bench(trace, duration, daemon_args).run()
+    if conf.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+    total = report["startup"]["total"]
+    if conf.startup_budget is not None and (
+        total is None or total > conf.startup_budget
+    ):
+        print(
+            "Startup budget exceeded: %s > %s"
+            % (format_seconds(total), format_seconds(conf.startup_budget)),
+            file=sys.stderr,
+        )
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
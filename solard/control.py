@@ -0,0 +1,143 @@
+#
+# Licensed under the Apache License, Version 4.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Control the running daemon through a unix socket
+
+A client sends one "command [argument...]" line and gets back one JSON
+object line: {"ok": true, ...} or {"ok": false, "error": "..."}.
+"""
+
+import asyncio
+import errno
+import json
+import os
+import socket
+import tempfile
+
+from solard.log import LOG
+
+
+COMMANDS = ["pause", "resume", "toggle", "set-offset", "reload", "status"]
+
+REQUEST_TIMEOUT = 5
+MAX_REQUEST_SIZE = 4096
+
+
+def default_socket_path():
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR") or tempfile.gettempdir()
+    return os.path.join(runtime_dir, "solard.control")
+
+
+class AlreadyRunning(OSError):
+    pass
+
+
+def remove_stale_socket(path):
+    """Remove a socket left by a previous instance
+
+    Raise AlreadyRunning if a running instance still listens on it.
+    """
+    if not os.path.exists(path):
+        return
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(REQUEST_TIMEOUT)
+        try:
+            sock.connect(path)
+        except (ConnectionRefusedError, FileNotFoundError):
+            pass
+        else:
+            raise AlreadyRunning(
+                errno.EADDRINUSE, "Another solard is listening on %s" % path
+            )
+    os.unlink(path)
+
+
+class ControlServer(object):
+    """Dispatch the requests to handler(command, args)
+
+    The handler returns a dict merged in the response, or raises ValueError
+    for invalid requests.
+    """
+
+    def __init__(self, loop, path, handler):
+        self.loop = loop
+        self.path = path
+        self.handler = handler
+        remove_stale_socket(path)
+        # Only the user running the daemon can control it, from the bind, the
+        # path may be in the shared temporary directory
+        umask = os.umask(0o077)
+        try:
+            self.server = self.loop.run_until_complete(
+                asyncio.start_unix_server(self._handle, path)
+            )
+        finally:
+            os.umask(umask)
+        os.chmod(path, 0o600)
+        LOG.debug("Listening control requests on %s", path)
+
+    def _process(self, line):
+        words = line.decode(errors="replace").split()
+        if not words:
+            raise ValueError("Empty request")
+        command, args = words[0], words[1:]
+        if command not in COMMANDS:
+            raise ValueError("Unknown command: %s" % command)
+        LOG.debug("Control request: %s", " ".join(words))
+        response = {"ok": True}
+        response.update(self.handler(command, args) or {})
+        return response
+
+    async def _handle(self, reader, writer):
+        try:
+            line = await asyncio.wait_for(reader.readline(), REQUEST_TIMEOUT)
+            if len(line) > MAX_REQUEST_SIZE:
+                raise ValueError("Request too long")
+            response = self._process(line)
+        except ValueError as e:
+            response = {"ok": False, "error": str(e)}
+        except (asyncio.TimeoutError, IOError) as e:
+            LOG.debug("Control request failed: %s", e)
+            writer.close()
+            return
+        except Exception as e:
+            LOG.exception("Fail to process control request")
+            response = {"ok": False, "error": "Internal error: %s" % e}
+        try:
+            writer.write(json.dumps(response).encode() + b"\n")
+            await writer.drain()
+        except IOError as e:
+            LOG.debug("Control response failed: %s", e)
+        finally:
+            writer.close()
+
+    def close(self):
+        self.server.close()
+        self.loop.run_until_complete(self.server.wait_closed())
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+def send(path, command, args=()):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(REQUEST_TIMEOUT)
+        sock.connect(path)
+        sock.sendall((" ".join([command] + list(args)) + "\n").encode())
+        chunks = []
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    return json.loads(b"".join(chunks).decode())
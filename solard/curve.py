@@ -0,0 +1,245 @@
+#
+# Licensed under the Apache License, Version 4.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Ambient light sensor raw value to brightness percent mapping
+
+The curve is compiled into a dense lookup table indexed by the raw value,
+so mapping a sample is a single index operation.
+"""
+
+import array
+import bisect
+import math
+
+from solard.log import LOG
+
+
+# The table stores hundredths of percent
+SCALE = 100
+RAW_MAX = 65535
+
+
+def parse_points(text, x_type=int):
+    """Parse "lux:percent,lux:percent,..." control points"""
+    points = []
+    for item in text.replace("\n", ",").split(","):
+        item = item.strip()
+        if not item or item.startswith("#"):
+            continue
+        lux, percent = item.split(":")
+        points.append((x_type(lux), float(percent)))
+    return points
+
+
+def format_points(points):
+    return ",".join("%d:%g" % point for point in points)
+
+
+def _x(lux):
+    # Interpolate in log space, as the eye perceives light
+    return math.log10(1 + lux)
+
+
+class Curve(object):
+    def __init__(self, table):
+        self.table = table
+        self._last = len(table) - 1
+
+    def lookup(self, raw):
+        if raw <= 0:
+            return self.table[0] / SCALE
+        if raw >= self._last:
+            return self.table[self._last] / SCALE
+        return self.table[raw] / SCALE
+
+    def band(self, raw, delta):
+        """Raw values range around `raw` where the percent moves by less
+        than `delta`"""
+        value = self.table[max(0, min(raw, self._last))]
+        low = bisect.bisect_right(self.table, value - int(delta * SCALE)) - 1
+        high = bisect.bisect_left(self.table, value + int(delta * SCALE))
+        # Past the end of the table the curve is saturated, only a brighter
+        # light than the current one must fire
+        return max(low, 0), max(high, raw + 1)
+
+    @classmethod
+    def from_log(cls, factor):
+        """The historical log10(raw) / factor mapping"""
+        size = min(int(math.ceil(10**factor)), RAW_MAX) + 1
+        table = array.array("H", [0]) * size
+        for raw in range(1, size):
+            table[raw] = int(round(min(math.log10(raw) / factor * 100.0, 100) * SCALE))
+        return cls(table)
+
+
+class PiecewiseCurve(Curve):
+    """Monotone cubic (Fritsch-Carlson) interpolation of control points"""
+
+    def __init__(self, points):
+        self.points = []
+        for lux, percent in sorted(points):
+            self._insert(lux, percent)
+        if not self.points:
+            raise ValueError("At least one ambient light curve point is needed")
+        super(PiecewiseCurve, self).__init__(array.array("H"))
+        self._compute_slopes()
+        self._fill(0, len(self.points) - 1)
+
+    # Control points of from_log(): every raw value up to LOG_DENSE, where
+    # log10(raw) bends the most, then raw values LOG_RATIO apart
+    LOG_DENSE = 8
+    LOG_RATIO = 1.5
+
+    @classmethod
+    def from_log(cls, factor):
+        """Control points approximating the log10(raw) / factor mapping
+
+        Close enough for the table to match Curve.from_log() within a
+        fraction of percent, enabling calibration doesn't change the mapping.
+        """
+        saturation = 10**factor
+        points = [(0, 0.0)]
+        lux = 1
+        while lux < saturation:
+            points.append((lux, math.log10(lux) / factor * 100.0))
+            if lux < cls.LOG_DENSE:
+                lux += 1
+            else:
+                lux = int(math.ceil(lux * cls.LOG_RATIO))
+        points.append((int(math.ceil(saturation)), 100.0))
+        return cls(points)
+
+    def _insert(self, lux, percent):
+        """Insert a point, dropping the ones that break the monotony
+
+        Return the index of the point.
+        """
+        lux = max(0, min(int(lux), RAW_MAX))
+        percent = max(0.0, min(float(percent), 100.0))
+        self.points = [
+            (x, y)
+            for x, y in self.points
+            if (x < lux and y <= percent) or (x > lux and y >= percent)
+        ]
+        index = bisect.bisect(self.points, (lux, percent))
+        self.points.insert(index, (lux, percent))
+        return index
+
+    def _compute_slopes(self):
+        xs = [_x(lux) for lux, _ in self.points]
+        ys = [percent for _, percent in self.points]
+        n = len(xs)
+        if n == 1:
+            self._slopes = [0.0]
+            return
+        hs = [xs[k + 1] - xs[k] for k in range(n - 1)]
+        ds = [(ys[k + 1] - ys[k]) / hs[k] for k in range(n - 1)]
+        slopes = [ds[0]] + [0.0] * (n - 2) + [ds[-1]]
+        for k in range(1, n - 1):
+            if ds[k - 1] * ds[k] <= 0:
+                continue
+            w1 = 2 * hs[k] + hs[k - 1]
+            w2 = hs[k] + 2 * hs[k - 1]
+            slopes[k] = (w1 + w2) / (w1 / ds[k - 1] + w2 / ds[k])
+        self._slopes = slopes
+
+    def _fill(self, first, last):
+        """Recompute the table between the points `first` and `last`"""
+        size = self.points[-1][0] + 1
+        if len(self.table) < size:
+            self.table.extend([0] * (size - len(self.table)))
+        elif len(self.table) > size:
+            del self.table[size:]
+        self._last = size - 1
+
+        if first == 0:
+            lux, percent = self.points[0]
+            for raw in range(0, lux + 1):
+                self.table[raw] = int(round(percent * SCALE))
+        for k in range(first, min(last, len(self.points) - 1)):
+            (x0, y0), (x1, y1) = self.points[k], self.points[k + 1]
+            m0, m1 = self._slopes[k], self._slopes[k + 1]
+            lx0, h = _x(x0), _x(x1) - _x(x0)
+            for raw in range(x0, x1 + 1):
+                t = (_x(raw) - lx0) / h
+                t2 = t * t
+                t3 = t2 * t
+                value = (
+                    (2 * t3 - 3 * t2 + 1) * y0
+                    + (t3 - 2 * t2 + t) * h * m0
+                    + (-2 * t3 + 3 * t2) * y1
+                    + (t3 - t2) * h * m1
+                )
+                self.table[raw] = int(round(max(0.0, min(value, 100.0)) * SCALE))
+
+    def add_point(self, lux, percent):
+        """Add a calibration point and rebuild the affected part of the table"""
+        count = len(self.points)
+        if any(x == lux for x, _ in self.points):
+            count -= 1
+        index = self._insert(lux, percent)
+        self._compute_slopes()
+        if len(self.points) == count + 1:
+            # Slopes of the two neighbours change with the new point
+            self._fill(max(0, index - 2), min(len(self.points) - 1, index + 2))
+        else:
+            # Some points have been dropped to keep the curve monotone
+            self._fill(0, len(self.points) - 1)
+        LOG.debug(
+            "Ambient light curve updated with %s:%s: %s",
+            lux,
+            percent,
+            format_points(self.points),
+        )
+
+
+class LinearCurve(object):
+    """Piecewise linear mapping between two percents"""
+
+    def __init__(self, points):
+        points = sorted(points)
+        if not points:
+            raise ValueError("At least one curve point is needed")
+        self.xs = [float(x) for x, _ in points]
+        self.ys = [float(y) for _, y in points]
+
+    def __call__(self, x):
+        index = bisect.bisect_right(self.xs, x)
+        if index == 0:
+            return self.ys[0]
+        if index == len(self.xs):
+            return self.ys[-1]
+        x0, x1 = self.xs[index - 1], self.xs[index]
+        y0, y1 = self.ys[index - 1], self.ys[index]
+        return y0 + (y1 - y0) * (x - x0) / (x1 - x0)
+
+
+def build_keyboard(conf):
+    """Ambient light percent to keyboard backlight percent"""
+    if conf.keyboard_backlight_curve:
+        return LinearCurve(parse_points(conf.keyboard_backlight_curve, float))
+    # Fully lit in the dark, fading out up to the threshold
+    threshold = conf.keyboard_backlight_threshold
+    return LinearCurve([(0, 100.0), (threshold / 2.0, 100.0), (threshold, 0.0)])
+
+
+def build(conf, points=None):
+    if points:
+        return PiecewiseCurve(points)
+    elif conf.ambient_light_curve:
+        return PiecewiseCurve(parse_points(conf.ambient_light_curve))
+    elif conf.ambient_light_calibrate:
+        # Calibration needs control points to adjust
+        return PiecewiseCurve.from_log(conf.ambient_light_factor)
+    return Curve.from_log(conf.ambient_light_factor)
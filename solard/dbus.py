@@ -0,0 +1,344 @@
+#
+# Licensed under the Apache License, Version 4.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Minimal asyncio D-Bus client, only what desktop notifications need
+
+Connects to the session bus with the EXTERNAL authentication, marshals the
+basic, array, struct, dict entry and variant types, and makes method calls.
+"""
+
+import asyncio
+import os
+import struct
+import urllib.parse
+
+from solard.log import LOG
+
+
+METHOD_CALL = 1
+METHOD_RETURN = 2
+ERROR = 3
+
+# Header fields
+PATH = 1
+INTERFACE = 2
+MEMBER = 3
+ERROR_NAME = 4
+REPLY_SERIAL = 5
+DESTINATION = 6
+SENDER = 7
+SIGNATURE = 8
+
+FIXED_TYPES = {
+    "y": "B",
+    "b": "I",
+    "n": "h",
+    "q": "H",
+    "i": "i",
+    "u": "I",
+    "x": "q",
+    "t": "Q",
+    "d": "d",
+}
+ALIGNMENTS = {"s": 4, "o": 4, "g": 1, "v": 1, "a": 4, "(": 8, "{": 8}
+ALIGNMENTS.update((t, struct.calcsize(f)) for t, f in FIXED_TYPES.items())
+
+BUS = ("org.freedesktop.DBus", "/org/freedesktop/DBus", "org.freedesktop.DBus")
+NOTIFICATIONS = (
+    "org.freedesktop.Notifications",
+    "/org/freedesktop/Notifications",
+    "org.freedesktop.Notifications",
+)
+
+
+class DBusError(Exception):
+    pass
+
+
+def split_signature(signature):
+    """Split a signature in single complete types"""
+    types = []
+    start = 0
+    while start < len(signature):
+        end = _type_end(signature, start)
+        types.append(signature[start:end])
+        start = end
+    return types
+
+
+def _type_end(signature, index):
+    code = signature[index]
+    if code == "a":
+        return _type_end(signature, index + 1)
+    if code in "({":
+        close = ")" if code == "(" else "}"
+        index += 1
+        while signature[index] != close:
+            index = _type_end(signature, index)
+    return index + 1
+
+
+class Writer(object):
+    def __init__(self):
+        self.buf = bytearray()
+
+    def align(self, alignment):
+        self.buf += b"\0" * (-len(self.buf) % alignment)
+
+    def write(self, signature, value):
+        code = signature[0]
+        if code in FIXED_TYPES:
+            self.align(ALIGNMENTS[code])
+            self.buf += struct.pack("<" + FIXED_TYPES[code], value)
+        elif code in "so":
+            data = value.encode()
+            self.write("u", len(data))
+            self.buf += data + b"\0"
+        elif code == "g":
+            data = value.encode()
+            self.buf += struct.pack("<B", len(data)) + data + b"\0"
+        elif code == "v":
+            inner, value = value
+            self.write("g", inner)
+            self.write(inner, value)
+        elif code == "a":
+            self.write("u", 0)
+            length_offset = len(self.buf) - 4
+            element = signature[1:]
+            # Padding to the first element isn't part of the length
+            self.align(ALIGNMENTS[element[0]])
+            start = len(self.buf)
+            for item in value.items() if element[0] == "{" else value:
+                self.write(element, item)
+            struct.pack_into("<I", self.buf, length_offset, len(self.buf) - start)
+        elif code in "({":
+            self.align(8)
+            for inner, item in zip(split_signature(signature[1:-1]), value):
+                self.write(inner, item)
+        else:
+            raise ValueError("Unsupported D-Bus type: %s" % signature)
+
+
+class Reader(object):
+    def __init__(self, data, endianness="<", offset=0):
+        self.data = data
+        self.endianness = endianness
+        self.offset = offset
+
+    def align(self, alignment):
+        self.offset += -self.offset % alignment
+
+    def read(self, signature):
+        code = signature[0]
+        if code in FIXED_TYPES:
+            self.align(ALIGNMENTS[code])
+            fmt = self.endianness + FIXED_TYPES[code]
+            (value,) = struct.unpack_from(fmt, self.data, self.offset)
+            self.offset += struct.calcsize(fmt)
+            return bool(value) if code == "b" else value
+        elif code in "sog":
+            length = self.read("y" if code == "g" else "u")
+            value = self.data[self.offset : self.offset + length].decode(
+                errors="replace"
+            )
+            self.offset += length + 1
+            return value
+        elif code == "v":
+            return self.read(self.read("g"))
+        elif code == "a":
+            length = self.read("u")
+            self.align(ALIGNMENTS[signature[1]])
+            end = self.offset + length
+            items = []
+            while self.offset < end:
+                items.append(self.read(signature[1:]))
+            return dict(items) if signature[1] == "{" else items
+        elif code in "({":
+            self.align(8)
+            return tuple(self.read(t) for t in split_signature(signature[1:-1]))
+        raise ValueError("Unsupported D-Bus type: %s" % signature)
+
+    def read_all(self, signature):
+        return [self.read(t) for t in split_signature(signature)]
+
+
+def session_bus_path(address=None):
+    """Unix socket path of the session bus, abstract ones start with a NUL"""
+    address = address or os.environ.get("DBUS_SESSION_BUS_ADDRESS")
+    if not address:
+        runtime_dir = os.environ.get("XDG_RUNTIME_DIR") or "/run/user/%d" % (
+            os.getuid()
+        )
+        return os.path.join(runtime_dir, "bus")
+    for entry in address.split(";"):
+        transport, _, params = entry.partition(":")
+        if transport != "unix":
+            continue
+        params = dict(p.partition("=")[::2] for p in params.split(","))
+        if "path" in params:
+            return urllib.parse.unquote(params["path"])
+        if "abstract" in params:
+            return "\0" + urllib.parse.unquote(params["abstract"])
+    raise DBusError("Unsupported D-Bus address: %s" % address)
+
+
+class Connection(object):
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.serial = 0
+        self.unique_name = None
+
+    @classmethod
+    async def connect(cls, address=None):
+        reader, writer = await asyncio.open_unix_connection(session_bus_path(address))
+        uid = str(os.getuid()).encode().hex()
+        writer.write(b"\0AUTH EXTERNAL " + uid.encode() + b"\r\n")
+        line = await reader.readline()
+        if not line.startswith(b"OK "):
+            writer.close()
+            raise DBusError("D-Bus authentication failed: %r" % line)
+        writer.write(b"BEGIN\r\n")
+        connection = cls(reader, writer)
+        (connection.unique_name,) = await connection.call(*BUS, "Hello")
+        LOG.debug("Connected to the session bus as %s", connection.unique_name)
+        return connection
+
+    def _message(self, destination, path, interface, member, signature, args):
+        self.serial += 1
+        body = Writer()
+        for inner, value in zip(split_signature(signature), args):
+            body.write(inner, value)
+        fields = [
+            (PATH, ("o", path)),
+            (INTERFACE, ("s", interface)),
+            (MEMBER, ("s", member)),
+            (DESTINATION, ("s", destination)),
+        ]
+        if signature:
+            fields.append((SIGNATURE, ("g", signature)))
+        header = Writer()
+        header.write("y", ord("l"))
+        header.write("y", METHOD_CALL)
+        header.write("y", 0)
+        header.write("y", 1)
+        header.write("u", len(body.buf))
+        header.write("u", self.serial)
+        header.write("a(yv)", fields)
+        header.align(8)
+        return bytes(header.buf + body.buf)
+
+    async def _receive(self):
+        fixed = await self.reader.readexactly(16)
+        endianness = "<" if fixed[0:1] == b"l" else ">"
+        body_length, serial, fields_length = struct.unpack_from(
+            endianness + "III", fixed, 4
+        )
+        size = 16 + fields_length
+        size += -size % 8
+        data = fixed + await self.reader.readexactly(size - 16 + body_length)
+        header = Reader(data, endianness, 12)
+        fields = dict(header.read("a(yv)"))
+        header.align(8)
+        body = header.read_all(fields.get(SIGNATURE, ""))
+        return fixed[1], serial, fields, body
+
+    async def call(self, destination, path, interface, member, signature="", args=()):
+        self.writer.write(
+            self._message(destination, path, interface, member, signature, args)
+        )
+        serial = self.serial
+        while True:
+            kind, _, fields, body = await self._receive()
+            # Signals like NameAcquired are ignored
+            if fields.get(REPLY_SERIAL) != serial:
+                continue
+            if kind == ERROR:
+                raise DBusError(
+                    "%s: %s" % (fields.get(ERROR_NAME), body[0] if body else "")
+                )
+            return body
+
+    def close(self):
+        self.writer.close()
+
+
+class Notifier(object):
+    """Desktop notifications sent in the background
+
+    The session bus connection is opened on the first notification. Each
+    notification replaces the previous one, they are sent in order and
+    given up after `timeout` seconds.
+    """
+
+    def __init__(self, loop, app_name, timeout=1.0, address=None):
+        self.loop = loop
+        self.app_name = app_name
+        self.timeout = timeout
+        self.address = address
+        self.connection = None
+        self.notification_id = 0
+        self.tasks = set()
+        self._lock = None
+
+    def notify(self, summary, body="", icon="", category=None):
+        task = self.loop.create_task(self._notify(summary, body, icon, category))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def _notify(self, summary, body, icon, category):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            try:
+                await asyncio.wait_for(
+                    self._send(summary, body, icon, category), self.timeout
+                )
+            except (OSError, EOFError, DBusError, asyncio.TimeoutError) as e:
+                LOG.error("Fail to send the notification %r: %s", summary, e)
+                # A timed out call may have left a partial reply
+                self.close()
+
+    async def _send(self, summary, body, icon, category):
+        if self.connection is None:
+            self.connection = await Connection.connect(self.address)
+        hints = {"category": ("s", category)} if category else {}
+        (self.notification_id,) = await self.connection.call(
+            *NOTIFICATIONS,
+            "Notify",
+            "susssasa{sv}i",
+            (
+                self.app_name,
+                self.notification_id,
+                icon,
+                summary,
+                body,
+                [],
+                hints,
+                -1,
+            ),
+        )
+        LOG.trace("Notification %d: %s %s", self.notification_id, summary, body)
+
+    def flush(self):
+        """Wait for the pending notifications, the loop must not be running"""
+        if self.tasks:
+            self.loop.run_until_complete(asyncio.wait(list(self.tasks)))
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
@@ -0,0 +1,265 @@
+#
+# Licensed under the Apache License, Version 4.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Backlights, keyboard leds and ambient light sensors discovery
+
+Scanning reads a few attributes of each device, the result is cached in a
+small JSON index. Next startups only check it with a stat of the class
+directories and of each device, and a read of the boot id.
+"""
+
+import json
+import os
+
+from solard import sysfs
+from solard.log import LOG
+
+
+INDEX_VERSION = 1
+
+BACKLIGHT_SYSPATH = "/sys/class/backlight"
+LEDS_SYSPATH = "/sys/class/leds"
+IIO_SYSPATH = "/sys/bus/iio/devices"
+CLASS_SYSPATHS = (BACKLIGHT_SYSPATH, LEDS_SYSPATH, IIO_SYSPATH)
+BOOT_ID_PATH = "/proc/sys/kernel/random/boot_id"
+
+# Firmware interfaces are preferred over platform and raw ones, see
+# Documentation/ABI/stable/sysfs-class-backlight
+BACKLIGHT_TYPES = ["firmware", "platform", "raw"]
+
+# Processed values first, raw ones need the scale and offset
+ILLUMINANCE_INPUTS = [
+    "in_illuminance_input",
+    "in_illuminance0_input",
+    "in_illuminance_raw",
+    "in_illuminance0_raw",
+]
+
+
+def default_cache_path():
+    cache_dir = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(cache_dir, "solard", "devices.json")
+
+
+def _read_number(path, default=None, cast=int):
+    value = sysfs.read_once(path)
+    try:
+        return cast(value) if value is not None else default
+    except ValueError:
+        return default
+
+
+def _listdir(path):
+    try:
+        return sorted(os.listdir(path))
+    except OSError:
+        return []
+
+
+def _modalias(path):
+    return sysfs.read_once(os.path.join(path, "device", "modalias")) or sysfs.read_once(
+        os.path.join(os.path.realpath(path), "..", "modalias")
+    )
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def scan_backlights(syspath):
+    devices = []
+    for name in _listdir(syspath(BACKLIGHT_SYSPATH)):
+        path = os.path.join(BACKLIGHT_SYSPATH, name)
+        devices.append(
+            {
+                "kind": "backlight",
+                "name": name,
+                "path": path,
+                "modalias": _modalias(syspath(path)),
+                "type": sysfs.read_once(os.path.join(syspath(path), "type")),
+                "max_brightness": _read_number(
+                    os.path.join(syspath(path), "max_brightness")
+                ),
+            }
+        )
+    return devices
+
+
+def scan_keyboard_leds(syspath):
+    devices = []
+    for name in _listdir(syspath(LEDS_SYSPATH)):
+        if "kbd_backlight" not in name:
+            # Capslock, wifi... leds
+            continue
+        path = os.path.join(LEDS_SYSPATH, name)
+        devices.append(
+            {
+                "kind": "led",
+                "name": name,
+                "path": path,
+                "modalias": _modalias(syspath(path)),
+                "max_brightness": _read_number(
+                    os.path.join(syspath(path), "max_brightness")
+                ),
+            }
+        )
+    return devices
+
+
+def scan_light_sensors(syspath):
+    devices = []
+    for name in _listdir(syspath(IIO_SYSPATH)):
+        path = os.path.join(IIO_SYSPATH, name)
+        attributes = _listdir(syspath(path))
+        inputs = [attr for attr in ILLUMINANCE_INPUTS if attr in attributes]
+        if not inputs:
+            continue
+        channel = inputs[0].rsplit("_", 1)[0]
+
+        def attr(suffix, default=None, cast=float):
+            # Channel attribute, or the shared one
+            for prefix in (channel, "in_illuminance"):
+                value = _read_number(
+                    os.path.join(syspath(path), "%s_%s" % (prefix, suffix)), cast=cast
+                )
+                if value is not None:
+                    return value
+            return default
+
+        frequencies = sysfs.read_once(
+            os.path.join(syspath(path), "%s_sampling_frequency_available" % channel)
+        ) or sysfs.read_once(
+            os.path.join(syspath(path), "sampling_frequency_available")
+        )
+        devices.append(
+            {
+                "kind": "als",
+                "name": name,
+                "path": path,
+                "modalias": _modalias(syspath(path)),
+                "driver": sysfs.read_once(os.path.join(syspath(path), "name")),
+                "channel": channel,
+                "input": inputs[0],
+                "scale": attr("scale", 1.0),
+                "offset": attr("offset", 0.0),
+                "sampling_frequencies": [
+                    float(f) for f in (frequencies or "").split() if f
+                ],
+            }
+        )
+    return devices
+
+
+class Index(object):
+    def __init__(self, syspath, cache_path=None):
+        self.syspath = syspath
+        self.cache_path = cache_path
+        self.devices = []
+        self.stamps = {}
+        if not self._load():
+            self.rescan()
+
+    def _boot_id(self):
+        return sysfs.read_once(self.syspath(BOOT_ID_PATH))
+
+    def _stamps(self):
+        return {path: _mtime(self.syspath(path)) for path in CLASS_SYSPATHS}
+
+    def _load(self):
+        if not self.cache_path:
+            return False
+        try:
+            with open(self.cache_path) as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError):
+            return False
+        if (
+            data.get("version") != INDEX_VERSION
+            or data.get("root") != self.syspath("/")
+            or data.get("boot_id") != self._boot_id()
+            or data.get("stamps") != self._stamps()
+        ):
+            return False
+        devices = data.get("devices", [])
+        if not all(os.path.exists(self.syspath(d["path"])) for d in devices):
+            return False
+        self.devices = devices
+        self.stamps = data["stamps"]
+        LOG.debug("Devices index loaded from %s", self.cache_path)
+        return True
+
+    def save(self):
+        if not self.cache_path:
+            return
+        data = {
+            "version": INDEX_VERSION,
+            "root": self.syspath("/"),
+            "boot_id": self._boot_id(),
+            "stamps": self.stamps,
+            "devices": self.devices,
+        }
+        try:
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+            tmp = self.cache_path + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump(data, f, indent=1, sort_keys=True)
+            os.rename(tmp, self.cache_path)
+        except (IOError, OSError) as e:
+            LOG.debug("Fail to save the devices index %s: %s", self.cache_path, e)
+
+    def rescan(self):
+        self.stamps = self._stamps()
+        self.devices = (
+            scan_backlights(self.syspath)
+            + scan_keyboard_leds(self.syspath)
+            + scan_light_sensors(self.syspath)
+        )
+        LOG.debug(
+            "Devices found: %s",
+            ", ".join("%s %s" % (d["kind"], d["name"]) for d in self.devices),
+        )
+        self.save()
+
+    def find(self, kind, name=None):
+        devices = [d for d in self.devices if d["kind"] == kind]
+        if name is not None:
+            devices = [d for d in devices if d["name"] == name]
+        if kind == "backlight":
+            devices.sort(
+                key=lambda d: (
+                    BACKLIGHT_TYPES.index(d["type"])
+                    if d["type"] in BACKLIGHT_TYPES
+                    else len(BACKLIGHT_TYPES)
+                )
+            )
+        return devices
+
+    def get(self, kind, name):
+        devices = self.find(kind, name)
+        return devices[0] if devices else None
+
+
+# (root, cache path) -> Index
+_INDEXES = {}
+
+
+def get_index(syspath, cache_path=None):
+    """The devices index, built once per process"""
+    key = (syspath("/"), cache_path)
+    if key not in _INDEXES:
+        _INDEXES[key] = Index(syspath, cache_path)
+    return _INDEXES[key]
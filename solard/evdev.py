@@ -0,0 +1,309 @@
+#
+# Licensed under the Apache License, Version 4.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Linux input devices
+
+Input events are read in batches from non-blocking /dev/input/event*
+devices watched by the event loop. The devices are selected from their
+capabilities in /sys/class/input.
+"""
+
+import fcntl
+import os
+import struct
+
+from solard import sysfs
+from solard.log import LOG
+
+
+INPUT_SYSPATH = "/sys/class/input"
+DEV_INPUT_PATH = "/dev/input"
+
+# struct input_event { struct timeval time; __u16 type; __u16 code; __s32 value; }
+EVENT = struct.Struct("@llHHi")
+# Events read per syscall
+BATCH_SIZE = 64
+
+EV_KEY = 0x01
+EV_REL = 0x02
+EV_ABS = 0x03
+EV_SW = 0x05
+SW_LID = 0x00
+INPUT_PROP_ACCELEROMETER = 0x06
+
+# Keyboards, pointers and touch devices
+ACTIVITY_EVENTS = (1 << EV_KEY) | (1 << EV_REL) | (1 << EV_ABS)
+
+BITS_PER_LONG = struct.calcsize("l") * 8
+
+
+def EVIOCGSW(length):
+    # _IOC(_IOC_READ, 'E', 0x1b, length)
+    return (2 << 30) | (length << 16) | (ord("E") << 8) | 0x1B
+
+
+def parse_bitmap(text):
+    """Parse a sysfs capabilities bitmap, longs in hex, most significant first"""
+    value = 0
+    for word in (text or "").split():
+        value = (value << BITS_PER_LONG) | int(word, 16)
+    return value
+
+
+def scan(syspath):
+    """Input event devices as dicts of their capabilities bitmaps"""
+    root = syspath(INPUT_SYSPATH)
+    try:
+        names = sorted(n for n in os.listdir(root) if n.startswith("event"))
+    except OSError:
+        return []
+    devices = []
+    for name in names:
+        device = os.path.join(root, name, "device")
+        devices.append(
+            {
+                "name": sysfs.read_once(os.path.join(device, "name")),
+                "path": os.path.join(DEV_INPUT_PATH, name),
+                "ev": parse_bitmap(
+                    sysfs.read_once(os.path.join(device, "capabilities", "ev"))
+                ),
+                "sw": parse_bitmap(
+                    sysfs.read_once(os.path.join(device, "capabilities", "sw"))
+                ),
+                "properties": parse_bitmap(
+                    sysfs.read_once(os.path.join(device, "properties"))
+                ),
+            }
+        )
+    return devices
+
+
+def activity_devices(syspath):
+    """Device paths of the keyboards, pointers and touch devices"""
+    return [
+        d["path"]
+        for d in scan(syspath)
+        if d["ev"] & ACTIVITY_EVENTS
+        # Always moving
+        and not d["properties"] & (1 << INPUT_PROP_ACCELEROMETER)
+    ]
+
+
+def lid_devices(syspath):
+    """Device paths of the lid switches"""
+    return [d["path"] for d in scan(syspath) if d["sw"] & (1 << SW_LID)]
+
+
+class InputDevice(object):
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+        self.open_device()
+        self._buf = bytearray(EVENT.size * BATCH_SIZE)
+
+    def open_device(self):
+        self.fd = os.open(self.path, os.O_RDONLY | os.O_NONBLOCK | os.O_CLOEXEC)
+
+    def fileno(self):
+        return self.fd
+
+    def read(self):
+        """Read the pending events, return their size in bytes"""
+        total = 0
+        while True:
+            try:
+                n = os.readv(self.fd, [self._buf])
+            except BlockingIOError:
+                break
+            if n == 0:
+                raise EOFError("%s closed" % self.path)
+            total += n
+            if n < len(self._buf):
+                break
+        return total
+
+    def read_events(self):
+        """Yield the pending events as (type, code, value)"""
+        while True:
+            try:
+                n = os.readv(self.fd, [self._buf])
+            except BlockingIOError:
+                return
+            if n == 0:
+                raise EOFError("%s closed" % self.path)
+            for _, _, type_, code, value in EVENT.iter_unpack(
+                memoryview(self._buf)[: n - n % EVENT.size]
+            ):
+                yield type_, code, value
+            if n < len(self._buf):
+                return
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class LidSwitch(InputDevice):
+    def __init__(self, path):
+        super(LidSwitch, self).__init__(path)
+        try:
+            self.closed = self.query()
+        except OSError:
+            self.close()
+            raise
+
+    def query(self):
+        state = bytearray(8)
+        fcntl.ioctl(self.fd, EVIOCGSW(len(state)), state, True)
+        return bool(state[SW_LID // 8] & (1 << (SW_LID % 8)))
+
+    def update(self):
+        """Read the pending events, return True if the lid state changed"""
+        closed = self.closed
+        for type_, code, value in self.read_events():
+            if type_ == EV_SW and code == SW_LID:
+                self.closed = bool(value)
+        return closed != self.closed
+
+
+class IdleMonitor(object):
+    """User idle state from the input devices activity
+
+    Events only update the last activity time, a single timer expires at
+    the end of the idle timeout and is re-armed from the last activity if
+    the user did something meanwhile. `on_change` is called when the user
+    becomes idle or is back. Without any readable device the user is never
+    idle.
+
+    Input devices are also replaced by FIFOs to test it, they are reopened
+    when their writer closes them.
+    """
+
+    def __init__(self, loop, paths, timeout, on_change):
+        self.loop = loop
+        self.timeout = timeout
+        self.on_change = on_change
+        self.devices = []
+        self.idle = False
+        self.last_activity = loop.time()
+        self._handle = None
+        self.add_devices(paths)
+
+    def add_devices(self, paths):
+        for path in paths:
+            if any(d.path == path for d in self.devices):
+                continue
+            try:
+                device = InputDevice(path)
+            except OSError as e:
+                LOG.warning("Fail to open %s: %s", path, e)
+                continue
+            self.devices.append(device)
+            self.loop.add_reader(device.fileno(), self._on_events, device)
+        if not self.devices:
+            LOG.error("No input device readable, is the user in the input group ?")
+            return
+        LOG.debug(
+            "Watching input activity of %s", ", ".join(d.path for d in self.devices)
+        )
+        if self._handle is None:
+            self._schedule()
+
+    def _close(self, device):
+        self.loop.remove_reader(device.fileno())
+        device.close()
+        self._remove(device)
+
+    def _remove(self, device):
+        self.devices.remove(device)
+        if not self.devices:
+            LOG.error("No input device left, idle detection disabled")
+            if self._handle is not None:
+                self._handle.cancel()
+                self._handle = None
+            if self.idle:
+                self.idle = False
+                self.on_change()
+
+    def rescan(self, paths):
+        for device in list(self.devices):
+            if device.path not in paths:
+                self._close(device)
+        self.add_devices(paths)
+
+    def _on_events(self, device):
+        try:
+            size = device.read()
+        except EOFError:
+            LOG.debug("%s writer closed, reopening it", device.path)
+            self.loop.remove_reader(device.fileno())
+            device.close()
+            try:
+                device.open_device()
+            except OSError as e:
+                LOG.warning("Fail to reopen %s: %s", device.path, e)
+                self._remove(device)
+                return
+            self.loop.add_reader(device.fileno(), self._on_events, device)
+            return
+        except OSError as e:
+            # ENODEV, unplugged
+            LOG.debug("Fail to read %s: %s", device.path, e)
+            self._close(device)
+            return
+        if size:
+            self.last_activity = self.loop.time()
+            if self.idle:
+                self.idle = False
+                self._schedule()
+                self.on_change()
+
+    def _schedule(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        if not self.idle and self.devices:
+            self._handle = self.loop.call_at(
+                self.last_activity + self.timeout / 1000.0, self._expire
+            )
+
+    def _expire(self):
+        self._handle = None
+        remaining = self.last_activity + self.timeout / 1000.0 - self.loop.time()
+        # Timers can run a bit early
+        if remaining < 0.001:
+            self.idle = True
+            self.on_change()
+        else:
+            self._schedule()
+
+    def is_idle(self, timeout):
+        if not self.devices:
+            return False
+        if timeout != self.timeout:
+            self.timeout = timeout
+            self.idle = self.loop.time() - self.last_activity >= timeout / 1000.0
+            self._schedule()
+        return self.idle
+
+    def close(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        for device in self.devices:
+            self.loop.remove_reader(device.fileno())
+            device.close()
+        self.devices = []
@@ -0,0 +1,291 @@
+#
+# Licensed under the Apache License, Version 4.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import bisect
+import math
+
+from solard import tracing
+from solard.log import LOG
+
+
+# Sleeping less than 5ms doesn't looks good
+MIN_FRAME_INTERVAL = 0.005
+
+CURVES = ["linear", "gamma", "cie"]
+GAMMA = 2.2
+
+
+def _cie_lightness(luminance):
+    """CIE 1976 L*, both normalized to 0-1"""
+    if luminance > 216.0 / 24389.0:
+        return 1.16 * math.pow(luminance, 1.0 / 3.0) - 0.16
+    return luminance * 24389.0 / 2700.0
+
+
+def _cie_luminance(lightness):
+    if lightness > 0.08:
+        return math.pow((lightness + 0.16) / 1.16, 3)
+    return lightness * 2700.0 / 24389.0
+
+
+# curve -> (raw ratio to perceived, perceived to raw ratio)
+_CURVES = {
+    "linear": (lambda x: x, lambda x: x),
+    "gamma": (lambda x: math.pow(x, 1.0 / GAMMA), lambda x: math.pow(x, GAMMA)),
+    "cie": (_cie_lightness, _cie_luminance),
+}
+
+
+def ease_in_out(progress):
+    return progress * progress * (3 - 2 * progress)
+
+
+def _dedup(offsets, values, start):
+    plan = []
+    last = start
+    for offset, value in zip(offsets, values):
+        if value != last:
+            plan.append((offset, value))
+            last = value
+    return plan
+
+
+def linear_plan(start, target, duration, interval):
+    """(time offset, value) frames of a linear fade, unchanged ones removed"""
+    interval = max(interval, MIN_FRAME_INTERVAL)
+    count = max(int(math.ceil(duration / interval)), 1)
+    offsets = [min(i * interval, duration) for i in range(1, count + 1)]
+    values = [
+        int(round(start + (target - start) * offset / duration)) if duration else target
+        for offset in offsets
+    ]
+    values[-1] = target
+    return _dedup(offsets, values, start)
+
+
+def perceptual_plan(start, target, maximum, duration, fps, curve="cie", easing=True):
+    """(time offset, value) frames of a fade at a fixed frame rate
+
+    The fade is linear in the perceived brightness space of `curve`,
+    eased at both ends. The number of writes is bounded by the frame
+    rate, whatever the raw range of the device; frames that would write
+    the same raw value are removed.
+    """
+    if fps <= 0:
+        raise ValueError("Fade frame rate must be positive: %s" % fps)
+    if maximum <= 0:
+        return linear_plan(start, target, duration, 1.0 / fps)
+    to_perceived, to_raw = _CURVES[curve]
+    begin = to_perceived(min(max(start, 0), maximum) / float(maximum))
+    end = to_perceived(min(max(target, 0), maximum) / float(maximum))
+    count = max(int(math.ceil(duration * fps)), 1)
+    offsets = [min(float(i) / fps, duration) for i in range(1, count + 1)]
+    values = []
+    for i in range(1, count + 1):
+        progress = float(i) / count
+        if easing:
+            progress = ease_in_out(progress)
+        values.append(int(round(maximum * to_raw(begin + (end - begin) * progress))))
+    values[-1] = target
+    return _dedup(offsets, values, start)
+
+
+class FrameClock(object):
+    """Drive all running fades from a single timer
+
+    Each tick handles all the faders having a frame due before the next
+    MIN_FRAME_INTERVAL, computes their values, then writes them in one
+    batch. Outputs fading together wake up the loop once per frame.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.faders = []
+        self.ticks = 0
+        self._handle = None
+        self._deadline = None
+
+    def add(self, fader):
+        if fader not in self.faders:
+            self.faders.append(fader)
+        self._schedule()
+
+    def remove(self, fader):
+        if fader in self.faders:
+            self.faders.remove(fader)
+        self._schedule()
+
+    def _schedule(self):
+        deadline = min((f.deadline for f in self.faders), default=None)
+        if self._handle is not None:
+            if deadline == self._deadline:
+                return
+            self._handle.cancel()
+            self._handle = None
+        self._deadline = deadline
+        if deadline is not None:
+            self._handle = self.loop.call_at(deadline, self._tick)
+
+    def _tick(self):
+        self._handle = None
+        self._deadline = None
+        self.ticks += 1
+        now = self.loop.time()
+        horizon = now + MIN_FRAME_INTERVAL
+
+        with tracing.span("frame_clock"):
+            batch = [
+                (fader, fader.generation, fader.frame(now))
+                for fader in list(self.faders)
+                if fader.deadline <= horizon
+            ]
+            for fader, generation, value in batch:
+                if value is not None and fader.generation == generation:
+                    with tracing.span("frame", fader.name):
+                        fader.write(value)
+                    fader.frames_written += 1
+        for fader, generation, _ in batch:
+            # Not retargeted while writing
+            if fader.generation == generation:
+                fader.finish_if_done()
+        self._schedule()
+
+    def cancel(self):
+        for fader in list(self.faders):
+            fader.cancel()
+
+
+class Fader(object):
+    """Fade an output towards its latest target
+
+    A fade is a precomputed plan of (time offset, value) frames. Frames
+    are scheduled on absolute deadlines from the start of the fade, late
+    frames are dropped in favor of the latest due one, so the fade doesn't
+    drift. Setting a new target retargets the running fade from the
+    current value.
+    """
+
+    def __init__(self, clock, name, current, write):
+        self.clock = clock
+        self.loop = clock.loop
+        self.name = name
+        self.current = current
+        self.write = write
+
+        self.target = None
+        self.deadline = None
+        # Bumped on each new target
+        self.generation = 0
+        self._start_time = None
+        self._duration = 0
+        self._offsets = []
+        self._values = []
+        # Index of the next frame
+        self._frame_index = 0
+        self._elapsed = 0
+        # Called with the planned and the real duration of finished fades
+        self.on_finished = None
+
+        self.frames_planned = 0
+        self.frames_written = 0
+        self.frames_dropped = 0
+
+    @property
+    def running(self):
+        return self.deadline is not None
+
+    def _is_current_target(self, target):
+        if self.running:
+            return target == self.target
+        return target == self.current()
+
+    def set_target(self, target, duration, interval):
+        """Fade linearly with a frame every `interval` seconds"""
+        if self._is_current_target(target):
+            return
+        self.set_plan(target, linear_plan(self.current(), target, duration, interval))
+
+    def set_perceptual_target(self, target, maximum, duration, fps, curve, easing):
+        if self._is_current_target(target):
+            return
+        self.set_plan(
+            target,
+            perceptual_plan(
+                self.current(), target, maximum, duration, fps, curve, easing
+            ),
+        )
+
+    def set_plan(self, target, plan):
+        if not plan:
+            # Already there
+            self.cancel()
+            return
+
+        self.target = target
+        self.generation += 1
+        self._start_time = self.loop.time()
+        # Frames reaching the target early are removed
+        self._duration = plan[-1][0]
+        self._offsets = [offset for offset, _ in plan]
+        self._values = [value for _, value in plan]
+        self._frame_index = 0
+        self.frames_planned += len(plan)
+        LOG.debug(
+            "Fade %s: %s -> %s (frames: %d, duration: %s)",
+            self.name,
+            self.current(),
+            target,
+            len(plan),
+            self._duration,
+        )
+
+        self.deadline = self._start_time + self._offsets[0]
+        self.clock.add(self)
+
+    def cancel(self):
+        if self.running:
+            self.generation += 1
+            self.deadline = None
+            self.clock.remove(self)
+        self.target = None
+
+    def frame(self, now):
+        """Return the value to write at `now`, None if unchanged
+
+        A frame due a bit later can be handled early to be batched with
+        other faders, the value of its deadline is used.
+        """
+        self._elapsed = max(now, self.deadline) - self._start_time
+        # Latest due frame, at least the scheduled one
+        index = max(
+            bisect.bisect_right(self._offsets, self._elapsed) - 1, self._frame_index
+        )
+        self.frames_dropped += index - self._frame_index
+        value = self._values[index]
+        self._frame_index = index + 1
+        if self._frame_index < len(self._offsets):
+            self.deadline = self._start_time + self._offsets[self._frame_index]
+
+        if value != self.current():
+            return value
+        return None
+
+    def finish_if_done(self):
+        if not self.running or self._frame_index < len(self._offsets):
+            return
+        self.deadline = None
+        self.target = None
+        self.clock.remove(self)
+        if self.on_finished is not None:
+            self.on_finished(self._duration, self._elapsed)
@@ -0,0 +1,214 @@
+#
+# Licensed under the Apache License, Version 4.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Streaming filters for ambient light samples
+
+All filters expose the same interface: update(sample) returns the new
+filtered value, `value` holds it and `last` the latest raw sample. Each
+update is O(1) (amortized) or O(log n) in the window size.
+"""
+
+import abc
+import collections
+import heapq
+
+
+class Filter(object, metaclass=abc.ABCMeta):
+    def __init__(self, initial=None):
+        self.value = initial
+        self.last = initial
+
+    @abc.abstractmethod
+    def update(self, sample):
+        """Add a sample and return the new filtered value"""
+
+
+class TrimmedMean(Filter):
+    """Mean of the window without its highest and lowest values
+
+    The sum is kept incrementally, the extremes with monotonic deques.
+    """
+
+    # Recompute the sum from scratch from time to time, so float rounding
+    # errors don't accumulate
+    RESYNC_EVERY = 10000
+
+    def __init__(self, window, initial=None):
+        super(TrimmedMean, self).__init__(initial)
+        self.window = window
+        self._values = collections.deque()
+        self._sum = 0.0
+        self._index = 0
+        # (index, value), values decreasing for _max, increasing for _min
+        self._max = collections.deque()
+        self._min = collections.deque()
+
+    def update(self, sample):
+        self.last = sample
+        self._values.append(sample)
+        self._sum += sample
+        if len(self._values) > self.window:
+            self._sum -= self._values.popleft()
+        self._index += 1
+        if self._index % self.RESYNC_EVERY == 0:
+            self._sum = float(sum(self._values))
+
+        index = self._index - 1
+        oldest = self._index - len(self._values)
+        while self._max and self._max[-1][1] <= sample:
+            self._max.pop()
+        self._max.append((index, sample))
+        while self._max[0][0] < oldest:
+            self._max.popleft()
+        while self._min and self._min[-1][1] >= sample:
+            self._min.pop()
+        self._min.append((index, sample))
+        while self._min[0][0] < oldest:
+            self._min.popleft()
+
+        count = len(self._values)
+        if count >= 3:
+            self.value = (self._sum - self._max[0][1] - self._min[0][1]) / (count - 2)
+        else:
+            self.value = self._sum / count
+        return self.value
+
+
+class ExponentialMovingAverage(Filter):
+    def __init__(self, window, initial=None):
+        super(ExponentialMovingAverage, self).__init__(initial)
+        # Same center of mass as a simple mean of `window` samples
+        self.alpha = 2.0 / (window + 1)
+
+    def update(self, sample):
+        self.last = sample
+        if self.value is None:
+            self.value = sample
+        else:
+            self.value += self.alpha * (sample - self.value)
+        return self.value
+
+
+class RunningMedian(Filter):
+    """Median of the window
+
+    Kept with two heaps, the lower half in a max-heap and the upper half in
+    a min-heap. Samples leaving the window are lazily removed when they
+    reach the top of a heap.
+    """
+
+    def __init__(self, window, initial=None):
+        super(RunningMedian, self).__init__(initial)
+        self.window = window
+        self._values = collections.deque()
+        self._low = []  # negated values
+        self._high = []
+        self._low_size = 0
+        self._high_size = 0
+        self._delayed = collections.Counter()
+
+    def _prune(self, heap, sign):
+        while heap:
+            value = sign * heap[0]
+            if not self._delayed[value]:
+                return
+            self._delayed[value] -= 1
+            heapq.heappop(heap)
+
+    def _rebalance(self):
+        if self._low_size > self._high_size + 1:
+            heapq.heappush(self._high, -heapq.heappop(self._low))
+            self._low_size -= 1
+            self._high_size += 1
+            self._prune(self._low, -1)
+        elif self._low_size < self._high_size:
+            heapq.heappush(self._low, -heapq.heappop(self._high))
+            self._high_size -= 1
+            self._low_size += 1
+            self._prune(self._high, 1)
+
+    def _add(self, sample):
+        if not self._low or sample <= -self._low[0]:
+            heapq.heappush(self._low, -sample)
+            self._low_size += 1
+        else:
+            heapq.heappush(self._high, sample)
+            self._high_size += 1
+        self._rebalance()
+
+    def _remove(self, sample):
+        self._delayed[sample] += 1
+        if sample <= -self._low[0]:
+            self._low_size -= 1
+            if sample == -self._low[0]:
+                self._prune(self._low, -1)
+        else:
+            self._high_size -= 1
+            if sample == self._high[0]:
+                self._prune(self._high, 1)
+        self._rebalance()
+
+    def update(self, sample):
+        self.last = sample
+        self._values.append(sample)
+        self._add(sample)
+        if len(self._values) > self.window:
+            self._remove(self._values.popleft())
+
+        if self._low_size > self._high_size:
+            self.value = -self._low[0]
+        else:
+            self.value = (self._high[0] - self._low[0]) / 2.0
+        return self.value
+
+
+class Kalman(Filter):
+    """1-D Kalman filter with a constant value model"""
+
+    def __init__(self, process_noise, measurement_noise, initial=None):
+        super(Kalman, self).__init__(initial)
+        self.process_noise = process_noise
+        self.measurement_noise = measurement_noise
+        self.error = measurement_noise
+
+    def update(self, sample):
+        self.last = sample
+        if self.value is None:
+            self.value = sample
+            return self.value
+        self.error += self.process_noise
+        gain = self.error / (self.error + self.measurement_noise)
+        self.value += gain * (sample - self.value)
+        self.error *= 1 - gain
+        return self.value
+
+
+FILTERS = ["trimmed-mean", "ema", "median", "kalman"]
+
+
+def build(conf):
+    name = conf.ambient_light_filter
+    window = conf.ambient_light_measures_number
+    if name == "trimmed-mean":
+        return TrimmedMean(window)
+    elif name == "ema":
+        return ExponentialMovingAverage(window)
+    elif name == "median":
+        return RunningMedian(window)
+    elif name == "kalman":
+        return Kalman(
+            conf.ambient_light_kalman_process_noise,
+            conf.ambient_light_kalman_measurement_noise,
+        )
+    raise ValueError("Unknown ambient light filter: %s" % name)
@@ -0,0 +1,114 @@
+#
+# Licensed under the Apache License, Version 4.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Fixed size history of the ambient light samples and brightness decisions
+
+The history is a memory mapped ring buffer file. Storing a record packs it
+in its slot and bumps the head counter, nothing is formatted or written
+with a syscall, the kernel writes the dirty pages back.
+"""
+
+import collections
+import mmap
+import os
+import struct
+import time
+
+from solard.log import LOG
+
+
+MAGIC = b"SOLARDH1"
+# magic, record size, capacity, records written
+HEADER = struct.Struct("<8sIIQ")
+HEAD_OFFSET = 16
+# monotonic timestamp in ns, kind, state, raw ambient light, filtered
+# ambient light, screen and keyboard targets
+RECORD = struct.Struct("<qBB2xifff4x")
+
+SAMPLE = 0
+DECISION = 1
+KINDS = {SAMPLE: "sample", DECISION: "decision"}
+
+Record = collections.namedtuple(
+    "Record", ["timestamp", "kind", "state", "raw", "filtered", "screen", "keyboard"]
+)
+
+
+def default_path():
+    state_dir = os.environ.get("XDG_STATE_HOME") or os.path.expanduser("~/.local/state")
+    return os.path.join(state_dir, "solard", "history")
+
+
+class History(object):
+    def __init__(self, path, capacity=65536):
+        if capacity < 1:
+            raise ValueError("History capacity must be positive: %s" % capacity)
+        self.path = path
+        self.capacity = capacity
+        size = HEADER.size + capacity * RECORD.size
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o600)
+        try:
+            header = os.pread(fd, HEADER.size, 0)
+            if (
+                len(header) != HEADER.size
+                or HEADER.unpack(header)[:3] != (MAGIC, RECORD.size, capacity)
+                or os.fstat(fd).st_size != size
+            ):
+                LOG.debug("Initializing history %s", path)
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, size)
+                os.pwrite(fd, HEADER.pack(MAGIC, RECORD.size, capacity, 0), 0)
+            self.map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self.head = HEADER.unpack_from(self.map)[3]
+
+    def record(self, kind, state, raw, filtered, screen, keyboard):
+        RECORD.pack_into(
+            self.map,
+            HEADER.size + (self.head % self.capacity) * RECORD.size,
+            time.monotonic_ns(),
+            kind,
+            state,
+            -1 if raw is None else raw,
+            filtered,
+            screen,
+            keyboard,
+        )
+        self.head += 1
+        struct.pack_into("<Q", self.map, HEAD_OFFSET, self.head)
+
+    def close(self):
+        self.map.close()
+
+
+def read(path):
+    """Yield the records of a history file, oldest first"""
+    with open(path, "rb") as f:
+        data = f.read()
+    if len(data) < HEADER.size:
+        raise ValueError("%s is not a solard history" % path)
+    magic, record_size, capacity, head = HEADER.unpack_from(data)
+    if magic != MAGIC or record_size != RECORD.size:
+        raise ValueError("%s is not a solard history" % path)
+    if len(data) != HEADER.size + capacity * RECORD.size:
+        raise ValueError("%s is truncated" % path)
+    for index in range(max(0, head - capacity), head):
+        offset = HEADER.size + (index % capacity) * RECORD.size
+        yield Record(*RECORD.unpack_from(data, offset))
@@ -0,0 +1,301 @@
+#
+# Licensed under the Apache License, Version 4.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import array
+import collections
+import errno
+import fcntl
+import os
+import re
+import struct
+
+from solard import sysfs
+from solard.log import LOG
+
+
+# _IOR('i', 0x90, int)
+IIO_GET_EVENT_FD_IOCTL = 0x80046990
+
+# struct iio_event_data { __u64 id; __s64 timestamp; }
+IIO_EVENT_DATA_SIZE = 16
+
+# eg: le:u32/32>>0
+SCAN_TYPE_RE = re.compile(r"^(be|le):(s|u)(\d+)/(\d+)(?:X(\d+))?>>(\d+)$")
+STORAGE_FORMATS = {8: "B", 16: "H", 32: "I", 64: "Q"}
+
+
+class IIOThresholdEvents(object):
+    """Rising/falling illuminance threshold events of an IIO device.
+
+    The thresholds are armed around a reading, the event fd becomes
+    readable when the light leaves that band. For channels only reporting
+    raw values, the thresholds are converted with the channel scale and
+    offset.
+    """
+
+    def __init__(self, device_syspath, channel="in_illuminance", scale=1.0, offset=0):
+        self.device_syspath = device_syspath
+        self.channel = channel
+        self.scale = scale
+        self.offset = offset
+        self.events_syspath = os.path.join(device_syspath, "events")
+        self.fd = None
+        self._buf = bytearray(IIO_EVENT_DATA_SIZE * 32)
+
+        for direction in ("rising", "falling"):
+            for suffix in ("value", "en"):
+                path = self._attr_path(direction, suffix)
+                if not os.path.exists(path):
+                    raise IOError(
+                        errno.ENOTSUP, "IIO threshold event not supported", path
+                    )
+
+        dev_path = os.path.join("/dev", os.path.basename(device_syspath))
+        dev_fd = os.open(dev_path, os.O_RDONLY)
+        try:
+            fd = array.array("i", [0])
+            fcntl.ioctl(dev_fd, IIO_GET_EVENT_FD_IOCTL, fd, True)
+        finally:
+            os.close(dev_fd)
+        self.fd = fd[0]
+        os.set_blocking(self.fd, False)
+        LOG.debug("IIO threshold events enabled on %s", dev_path)
+
+    def _attr_path(self, direction, suffix):
+        return os.path.join(
+            self.events_syspath,
+            "%s_thresh_%s_%s" % (self.channel, direction, suffix),
+        )
+
+    def _write(self, direction, suffix, value):
+        path = self._attr_path(direction, suffix)
+        LOG.trace("echo %s > %s", value, path)
+        sysfs.write(path, value)
+
+    def fileno(self):
+        return self.fd
+
+    def arm(self, low, high):
+        """Arm the thresholds, a falling one of 0 is disabled"""
+        if self.scale != 1.0 or self.offset:
+            low = max(0, int(low / self.scale - self.offset))
+            high = int(high / self.scale - self.offset) + 1
+        LOG.debug("Arm ambient light thresholds: %d < x < %d", low, high)
+        self._write("rising", "en", "0")
+        self._write("falling", "en", "0")
+        self._write("rising", "value", high)
+        self._write("rising", "en", "1")
+        if low > 0:
+            self._write("falling", "value", low)
+            self._write("falling", "en", "1")
+
+    def drain(self):
+        count = 0
+        while True:
+            try:
+                n = os.readv(self.fd, [self._buf])
+            except BlockingIOError:
+                break
+            if n <= 0:
+                break
+            count += n // IIO_EVENT_DATA_SIZE
+        return count
+
+    def close(self):
+        if self.fd is not None:
+            try:
+                self._write("rising", "en", "0")
+                self._write("falling", "en", "0")
+            except IOError:
+                pass
+            os.close(self.fd)
+            self.fd = None
+
+
+class ScanElement(
+    collections.namedtuple(
+        "ScanElement",
+        ["name", "index", "endianness", "signed", "bits", "storage", "shift"],
+    )
+):
+    @classmethod
+    def parse(cls, name, index, scan_type):
+        match = SCAN_TYPE_RE.match(scan_type)
+        if match is None or match.group(5) is not None:
+            raise IOError(errno.ENOTSUP, "Unsupported IIO scan type", scan_type)
+        endianness, sign, bits, storage, _, shift = match.groups()
+        if int(storage) not in STORAGE_FORMATS:
+            raise IOError(errno.ENOTSUP, "Unsupported IIO storage size", scan_type)
+        return cls(
+            name,
+            index,
+            "<" if endianness == "le" else ">",
+            sign == "s",
+            int(bits),
+            int(storage),
+            int(shift),
+        )
+
+    def decode(self, raw):
+        value = (raw >> self.shift) & ((1 << self.bits) - 1)
+        if self.signed and value & (1 << (self.bits - 1)):
+            value -= 1 << self.bits
+        return value
+
+
+class IIOBuffer(object):
+    """Buffered capture of an IIO channel along with its timestamp
+
+    The kernel stores the samples in a ring buffer, the character device
+    becomes readable once `watermark` samples are available. Records are
+    decoded in place from a preallocated buffer.
+    """
+
+    TIMESTAMP = "in_timestamp"
+
+    def __init__(
+        self,
+        device_syspath,
+        channel="in_illuminance",
+        length=32,
+        watermark=1,
+        triggers_syspath=None,
+    ):
+        self.device_syspath = device_syspath
+        self.scan_syspath = os.path.join(device_syspath, "scan_elements")
+        self.buffer_syspath = os.path.join(device_syspath, "buffer")
+        self.channel = channel
+        self.fd = None
+
+        for name in (channel, self.TIMESTAMP):
+            path = os.path.join(self.scan_syspath, "%s_en" % name)
+            if not os.path.exists(path):
+                raise IOError(errno.ENOTSUP, "IIO buffered capture not supported", path)
+
+        self._write(self.buffer_syspath, "enable", 0)
+        # Only our channels, others would change the records layout
+        for filename in os.listdir(self.scan_syspath):
+            if filename.endswith("_en"):
+                name = filename[: -len("_en")]
+                self._write(
+                    self.scan_syspath,
+                    filename,
+                    1 if name in (channel, self.TIMESTAMP) else 0,
+                )
+        elements = sorted(
+            (self._scan_element(name) for name in (channel, self.TIMESTAMP)),
+            key=lambda e: e.index,
+        )
+        self._setup_record(elements)
+        self._setup_trigger(triggers_syspath)
+
+        self._write(self.buffer_syspath, "length", max(length, watermark))
+        if os.path.exists(os.path.join(self.buffer_syspath, "watermark")):
+            self._write(self.buffer_syspath, "watermark", watermark)
+        self._write(self.buffer_syspath, "enable", 1)
+
+        self._buf = bytearray(self.record.size * max(length, watermark))
+        self._view = memoryview(self._buf)
+        dev_path = os.path.join("/dev", os.path.basename(device_syspath))
+        try:
+            self.fd = os.open(dev_path, os.O_RDONLY | os.O_NONBLOCK | os.O_CLOEXEC)
+        except OSError:
+            self._write(self.buffer_syspath, "enable", 0)
+            raise
+        LOG.debug(
+            "IIO buffered capture enabled on %s (%d bytes records)",
+            dev_path,
+            self.record.size,
+        )
+
+    @staticmethod
+    def _write(directory, name, value):
+        path = os.path.join(directory, name)
+        LOG.trace("echo %s > %s", value, path)
+        sysfs.write(path, value)
+
+    def _scan_element(self, name):
+        path = os.path.join(self.scan_syspath, name)
+        return ScanElement.parse(
+            name, sysfs.read_int(path + "_index"), sysfs.read(path + "_type")
+        )
+
+    def _setup_record(self, elements):
+        # Each element is aligned on its storage size, the record on the
+        # largest one
+        if len({e.endianness for e in elements}) != 1:
+            raise IOError(errno.ENOTSUP, "Mixed endianness IIO scan elements")
+        fmt = elements[0].endianness
+        offset = 0
+        for element in elements:
+            size = element.storage // 8
+            padding = -offset % size
+            fmt += "x" * padding + STORAGE_FORMATS[element.storage]
+            offset += padding + size
+        fmt += "x" * (-offset % max(e.storage // 8 for e in elements))
+        self.record = struct.Struct(fmt)
+        self._elements = elements
+        self._value_index = [e.name for e in elements].index(self.channel)
+        self._timestamp_index = [e.name for e in elements].index(self.TIMESTAMP)
+
+    def _setup_trigger(self, triggers_syspath):
+        path = os.path.join(self.device_syspath, "trigger", "current_trigger")
+        if not os.path.exists(path) or sysfs.read(path) or triggers_syspath is None:
+            return
+        # Use the trigger provided by the device driver, eg: acpi-als-dev0
+        device_name = sysfs.read(os.path.join(self.device_syspath, "name"))
+        for entry in sorted(os.listdir(triggers_syspath)):
+            name_path = os.path.join(triggers_syspath, entry, "name")
+            if entry.startswith("trigger") and os.path.exists(name_path):
+                trigger = sysfs.read(name_path)
+                if trigger.startswith(device_name):
+                    LOG.debug("Using IIO trigger %s", trigger)
+                    self._write(os.path.dirname(path), "current_trigger", trigger)
+                    return
+
+    def fileno(self):
+        return self.fd
+
+    def read(self):
+        """Return the pending (timestamp in ns, value) samples"""
+        samples = []
+        value_element = self._elements[self._value_index]
+        timestamp_element = self._elements[self._timestamp_index]
+        while True:
+            try:
+                n = os.readv(self.fd, [self._buf])
+            except BlockingIOError:
+                break
+            if n <= 0:
+                break
+            n -= n % self.record.size
+            for record in self.record.iter_unpack(self._view[:n]):
+                samples.append(
+                    (
+                        timestamp_element.decode(record[self._timestamp_index]),
+                        value_element.decode(record[self._value_index]),
+                    )
+                )
+        return samples
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+            try:
+                self._write(self.buffer_syspath, "enable", 0)
+                for name in (self.channel, self.TIMESTAMP):
+                    self._write(self.scan_syspath, "%s_en" % name, 0)
+            except IOError:
+                pass
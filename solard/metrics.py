@@ -0,0 +1,228 @@
+#
+# Licensed under the Apache License, Version 4.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Daemon metrics, in the Prometheus text format
+
+Counters and histograms are allocated once, updating them is a few integer
+additions. The text is only built when a client asks for it.
+"""
+
+import asyncio
+import bisect
+import os
+import socket
+import tempfile
+
+from solard import control
+from solard import sysfs
+from solard.log import LOG
+
+
+# Upper bounds in seconds, the last bucket is +Inf
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25)
+
+CYCLES = ("event_detection", "ambient_light_sampling")
+OUTPUTS = ("screen", "keyboard")
+
+CONTENT_TYPE = "text/plain; version=0.0.4"
+REQUEST_TIMEOUT = 5
+
+
+def default_socket_path():
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR") or tempfile.gettempdir()
+    return os.path.join(runtime_dir, "solard.metrics")
+
+
+class Histogram(object):
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, lines, name, labels):
+        cumulated = 0
+        for bound, count in zip(BUCKETS + ("+Inf",), self.counts):
+            cumulated += count
+            lines.append('%s_bucket{%s,le="%s"} %d' % (name, labels, bound, cumulated))
+        lines.append("%s_sum{%s} %.9f" % (name, labels, self.sum))
+        lines.append("%s_count{%s} %d" % (name, labels, self.count))
+
+
+class Metrics(object):
+    def __init__(self):
+        self.cycles = {cycle: Histogram() for cycle in CYCLES}
+        self.outside_changes = {output: 0 for output in OUTPUTS}
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _header(lines, name, kind, description):
+    lines.append("# HELP %s %s" % (name, description))
+    lines.append("# TYPE %s %s" % (name, kind))
+
+
+def _resident_memory():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (IOError, ValueError, IndexError):
+        return 0
+
+
+def render(daemon):
+    metrics = daemon.metrics
+    lines = []
+
+    name = "solard_cycle_duration_seconds"
+    _header(lines, name, "histogram", "Duration of the daemon periodic cycles")
+    for cycle, histogram in sorted(metrics.cycles.items()):
+        histogram.render(lines, name, 'cycle="%s"' % cycle)
+
+    attributes = sorted(sysfs.POOL, key=lambda attr: attr.path)
+    for name, kind, description, field in (
+        ("solard_sysfs_reads_total", "counter", "Sysfs attribute reads", "reads"),
+        (
+            "solard_sysfs_read_seconds_total",
+            "counter",
+            "Time spent reading sysfs attributes",
+            "read_seconds",
+        ),
+        ("solard_sysfs_writes_total", "counter", "Sysfs attribute writes", "writes"),
+        (
+            "solard_sysfs_write_seconds_total",
+            "counter",
+            "Time spent writing sysfs attributes",
+            "write_seconds",
+        ),
+    ):
+        _header(lines, name, kind, description)
+        for attr in attributes:
+            lines.append(
+                '%s{path="%s"} %s' % (name, _escape(attr.path), getattr(attr, field))
+            )
+
+    name = "solard_x_round_trips_total"
+    _header(lines, name, "counter", "X server round trips to get the idle time")
+    lines.append(
+        "%s %d" % (name, getattr(daemon.xscreensaver_querier, "round_trips", 0))
+    )
+
+    name = "solard_fade_frames_total"
+    _header(lines, name, "counter", "Fade frames planned, written and dropped")
+    for fader in daemon.faders:
+        for state, value in (
+            ("planned", fader.frames_planned),
+            ("written", fader.frames_written),
+            ("dropped", fader.frames_dropped),
+        ):
+            lines.append(
+                '%s{output="%s",state="%s"} %d'
+                % (name, _escape(fader.name), state, value)
+            )
+
+    name = "solard_frame_clock_ticks_total"
+    _header(lines, name, "counter", "Fade frame clock wakeups")
+    lines.append("%s %d" % (name, daemon.frame_clock.ticks))
+
+    name = "solard_outside_changes_total"
+    _header(lines, name, "counter", "Brightness changes done outside the daemon")
+    for output, value in sorted(metrics.outside_changes.items()):
+        lines.append('%s{output="%s"} %d' % (name, output, value))
+
+    times = os.times()
+    name = "solard_process_cpu_seconds_total"
+    _header(lines, name, "counter", "User and system CPU time")
+    lines.append("%s %.6f" % (name, times.user + times.system))
+    name = "solard_process_resident_memory_bytes"
+    _header(lines, name, "gauge", "Resident memory size")
+    lines.append("%s %d" % (name, _resident_memory()))
+
+    lines.append("")
+    return "\n".join(lines)
+
+
+class MetricsServer(object):
+    """Minimal HTTP server answering any request with the metrics"""
+
+    def __init__(self, loop, render, path=None, port=None):
+        self.loop = loop
+        self.render = render
+        self.path = path
+        if path is not None:
+            control.remove_stale_socket(path)
+            coro = asyncio.start_unix_server(self._handle, path)
+            LOG.debug("Metrics available on %s", path)
+        else:
+            coro = asyncio.start_server(self._handle, "127.0.0.1", port)
+            LOG.debug("Metrics available on http://127.0.0.1:%d/metrics", port)
+        self.server = self.loop.run_until_complete(coro)
+
+    async def _handle(self, reader, writer):
+        try:
+            # Skip the request line and the headers
+            while True:
+                line = await asyncio.wait_for(reader.readline(), REQUEST_TIMEOUT)
+                if not line.strip():
+                    break
+            body = self.render().encode()
+            writer.write(
+                b"HTTP/1.0 200 OK\r\n"
+                b"Content-Type: " + CONTENT_TYPE.encode() + b"\r\n"
+                b"Content-Length: " + str(len(body)).encode() + b"\r\n"
+                b"\r\n" + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, IOError) as e:
+            LOG.debug("Metrics request failed: %s", e)
+        except Exception:
+            LOG.exception("Fail to render metrics")
+        finally:
+            writer.close()
+
+    def close(self):
+        self.server.close()
+        self.loop.run_until_complete(self.server.wait_closed())
+        if self.path is not None and os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+def fetch(path=None, port=None):
+    if path is not None:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        address = path
+    else:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        address = ("127.0.0.1", port)
+    with sock:
+        sock.settimeout(REQUEST_TIMEOUT)
+        sock.connect(address)
+        sock.sendall(b"GET /metrics HTTP/1.0\r\n\r\n")
+        chunks = []
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    response = b"".join(chunks)
+    _, _, body = response.partition(b"\r\n\r\n")
+    return body.decode()
@@ -0,0 +1,109 @@
+#
+# Licensed under the Apache License, Version 4.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Brightness output devices
+
+Outputs with the "screen" role follow the brightness computed from the
+ambient light, the "keyboard" ones are lit when it's dark. User backends
+can subclass Output and be selected with "--output package.module.Class=NAME".
+"""
+
+import importlib
+import os
+
+from solard import sysfs
+
+
+class Output(object):
+    kind = None
+    role = None
+    # Directory of the devices of this kind, None if not sysfs based
+    SYSPATH = None
+    # Reading a just written value may return the previous one for a while
+    settle_delay = 0
+
+    def __init__(self, name, path):
+        self.name = name
+        self.path = path
+        self.max_brightness = self.read_max()
+        self.shadow = sysfs.Shadow(self.read(), self.settle_delay)
+        # Set by the daemon, all faders share the same frame clock
+        self.fader = None
+
+    def __repr__(self):
+        return "<%s %s>" % (self.kind, self.name)
+
+    def _attribute(self, name):
+        if self.path is None:
+            raise ValueError(
+                "%s has no SYSPATH, it must implement read_max(), read() and "
+                "write()" % type(self).__name__
+            )
+        return os.path.join(self.path, name)
+
+    def read_max(self):
+        return sysfs.read_int(self._attribute("max_brightness"))
+
+    def read(self):
+        return sysfs.read_int(self._attribute("brightness"))
+
+    def write(self, value):
+        sysfs.write(self._attribute("brightness"), int(value))
+        self.shadow.wrote(value)
+
+
+class Backlight(Output):
+    kind = "backlight"
+    role = "screen"
+    SYSPATH = "/sys/class/backlight"
+
+
+class Led(Output):
+    kind = "led"
+    role = "keyboard"
+    SYSPATH = "/sys/class/leds"
+    settle_delay = 0.1
+
+
+BACKENDS = {"backlight": Backlight, "led": Led}
+
+
+def get_backend(kind):
+    if kind in BACKENDS:
+        return BACKENDS[kind]
+    module, sep, name = kind.rpartition(".")
+    if not sep:
+        raise ValueError("Unknown output kind: %s" % kind)
+    try:
+        backend = getattr(importlib.import_module(module), name)
+    except (ImportError, AttributeError) as e:
+        raise ValueError("Fail to load output backend %s: %s" % (kind, e))
+    if not (isinstance(backend, type) and issubclass(backend, Output)):
+        raise ValueError("%s is not an Output subclass" % kind)
+    return backend
+
+
+def parse_spec(spec):
+    """Parse "kind=name" to (backend, name)"""
+    kind, sep, name = spec.partition("=")
+    if not sep or not name:
+        raise ValueError("Output must be KIND=NAME, got: %s" % spec)
+    return get_backend(kind), name
+
+
+def discover(index):
+    """All screen backlights and keyboard leds, as (backend, name)"""
+    return [(Backlight, d["name"]) for d in index.find("backlight")] + [
+        (Led, d["name"]) for d in index.find("led")
+    ]
@@ -0,0 +1,68 @@
+#
+# Licensed under the Apache License, Version 4.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""AC or battery power profile detection"""
+
+import os
+
+from solard import sysfs
+from solard.log import LOG
+
+
+POWER_SUPPLY_SYSPATH = "/sys/class/power_supply"
+
+PROFILES = ["ac", "battery"]
+
+# Supplies powering the system when online, see
+# Documentation/ABI/testing/sysfs-class-power
+EXTERNAL_TYPES = ["Mains", "USB", "Wireless"]
+
+
+def detect(syspath):
+    """Return "battery" when running on battery, "ac" otherwise
+
+    Machines without any power supply, like most desktops, are on AC.
+    """
+    root = syspath(POWER_SUPPLY_SYSPATH)
+    try:
+        names = sorted(os.listdir(root))
+    except OSError:
+        return "ac"
+
+    external = False
+    discharging = False
+    for name in names:
+        path = os.path.join(root, name)
+        if sysfs.read_once(os.path.join(path, "scope")) == "Device":
+            # Mouse, keyboard... batteries
+            continue
+        kind = sysfs.read_once(os.path.join(path, "type"))
+        if kind in EXTERNAL_TYPES:
+            if sysfs.read_once(os.path.join(path, "online")) == "1":
+                return "ac"
+            external = True
+        elif kind == "Battery":
+            if sysfs.read_once(os.path.join(path, "status")) == "Discharging":
+                discharging = True
+    profile = "battery" if external or discharging else "ac"
+    LOG.trace("Power supplies: %s, profile: %s", ", ".join(names), profile)
+    return profile
+
+
+def select(option, syspath):
+    """The profile to use for the --power-profile option"""
+    if option in PROFILES:
+        return option
+    return detect(syspath)
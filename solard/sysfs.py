@@ -0,0 +1,275 @@
+#
+# Licensed under the Apache License, Version 4.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import errno
+import os
+import select
+import time
+
+from solard import tracing
+from solard.log import LOG
+
+
+# Errors meaning the attribute behind our fd went away, but may be back
+# with the same path (eg: kernel module reloaded)
+REOPEN_ERRNOS = (errno.ENODEV, errno.ESTALE, errno.EBADF)
+
+BUFFER_SIZE = 4096
+
+_INT_BYTES = {}
+
+
+def int_to_bytes(value):
+    try:
+        return _INT_BYTES[value]
+    except KeyError:
+        data = _INT_BYTES[value] = b"%d" % value
+        return data
+
+
+class Attribute(object):
+    """A sysfs attribute opened once and accessed with pread/pwrite"""
+
+    __slots__ = (
+        "path",
+        "truncate",
+        "reads",
+        "read_seconds",
+        "writes",
+        "write_seconds",
+        "_rfd",
+        "_wfd",
+        "_buf",
+    )
+
+    def __init__(self, path, truncate=False):
+        self.path = path
+        self.truncate = truncate
+        self.reads = 0
+        self.read_seconds = 0.0
+        self.writes = 0
+        self.write_seconds = 0.0
+        self._rfd = None
+        self._wfd = None
+        self._buf = bytearray(BUFFER_SIZE)
+
+    def _open_read(self):
+        self._rfd = os.open(self.path, os.O_RDONLY | os.O_CLOEXEC)
+        return self._rfd
+
+    def fileno(self):
+        return self._rfd if self._rfd is not None else self._open_read()
+
+    def _open_write(self):
+        self._wfd = os.open(self.path, os.O_WRONLY | os.O_CLOEXEC)
+        return self._wfd
+
+    def _pread(self):
+        start = time.perf_counter_ns()
+        fd = self._rfd if self._rfd is not None else self._open_read()
+        try:
+            return os.preadv(fd, [self._buf], 0)
+        except OSError as e:
+            if e.errno not in REOPEN_ERRNOS:
+                raise
+            LOG.debug("Reopening %s (%s)", self.path, e)
+            self.close()
+            return os.preadv(self._open_read(), [self._buf], 0)
+        finally:
+            end = time.perf_counter_ns()
+            self.reads += 1
+            self.read_seconds += (end - start) / 1e9
+            if tracing.TRACER is not None:
+                tracing.TRACER.add("read", start, end, self.path)
+
+    def read(self):
+        return self._buf[: self._pread()].decode().strip()
+
+    def read_int(self):
+        # int() accepts bytes and ignores the trailing newline
+        return int(self._buf[: self._pread()])
+
+    def write_bytes(self, data):
+        start = time.perf_counter_ns()
+        fd = self._wfd if self._wfd is not None else self._open_write()
+        try:
+            os.pwrite(fd, data, 0)
+        except OSError as e:
+            if e.errno not in REOPEN_ERRNOS:
+                raise
+            LOG.debug("Reopening %s (%s)", self.path, e)
+            self.close()
+            fd = self._open_write()
+            os.pwrite(fd, data, 0)
+        finally:
+            end = time.perf_counter_ns()
+            self.writes += 1
+            self.write_seconds += (end - start) / 1e9
+            if tracing.TRACER is not None:
+                tracing.TRACER.add("write", start, end, self.path)
+        if self.truncate:
+            os.ftruncate(fd, len(data))
+
+    def write(self, value):
+        if isinstance(value, int):
+            self.write_bytes(int_to_bytes(value))
+        else:
+            self.write_bytes(value.encode())
+
+    def close(self):
+        for fd in (self._rfd, self._wfd):
+            if fd is not None:
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
+        self._rfd = self._wfd = None
+
+
+class Pool(object):
+    def __init__(self, truncate=False):
+        # Regular files don't get replaced on write like sysfs attributes,
+        # truncate them to emulate it
+        self.truncate = truncate
+        self._attributes = {}
+
+    def get(self, path):
+        try:
+            return self._attributes[path]
+        except KeyError:
+            attr = self._attributes[path] = Attribute(path, self.truncate)
+            return attr
+
+    def __iter__(self):
+        return iter(list(self._attributes.values()))
+
+    def close(self):
+        for attr in self._attributes.values():
+            attr.close()
+        self._attributes.clear()
+
+
+POOL = Pool()
+
+
+class Shadow(object):
+    """Values written by the daemon to an attribute
+
+    Each write bumps a sequence number, reading back one of our own
+    writes, or the previous value while the hardware didn't settle yet, is
+    not an outside change.
+    """
+
+    __slots__ = ("value", "previous", "seq", "written_at", "settle_delay")
+
+    def __init__(self, value, settle_delay=0):
+        self.value = value
+        self.previous = value
+        self.seq = 0
+        self.written_at = 0
+        self.settle_delay = settle_delay
+
+    def wrote(self, value):
+        self.previous = self.value
+        self.value = value
+        self.seq += 1
+        self.written_at = time.monotonic()
+
+    def reset(self, value):
+        self.value = self.previous = value
+
+    def is_outside_change(self, value):
+        if value == self.value:
+            return False
+        if (
+            value == self.previous
+            and time.monotonic() - self.written_at < self.settle_delay
+        ):
+            return False
+        return True
+
+
+class Notifier(object):
+    """Calls back when the kernel sysfs_notify() an attribute (POLLPRI)
+
+    sysfs attributes are always readable, so they can't be added to the
+    event loop as is. They are registered in a dedicated epoll with
+    EPOLLPRI only, and this epoll fd is watched by the event loop.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self._epoll = select.epoll()
+        self._watches = {}
+        self.loop.add_reader(self._epoll.fileno(), self._dispatch)
+
+    def watch(self, path, callback):
+        attr = POOL.get(path)
+        fd = attr.fileno()
+        # Reading the attribute acknowledges the previous notifications
+        self._acknowledge(attr)
+        self._epoll.register(fd, select.EPOLLPRI | select.EPOLLERR)
+        self._watches[fd] = (attr, callback)
+        LOG.debug("Watching %s changes", path)
+
+    @staticmethod
+    def _acknowledge(attr):
+        """Read the attribute, return False if it has no value yet"""
+        try:
+            attr.read()
+        except OSError as e:
+            # eg: brightness_hw_changed until the first hardware change
+            if e.errno != errno.ENODATA:
+                raise
+            return False
+        return True
+
+    def _dispatch(self):
+        for fd, _ in self._epoll.poll(0):
+            attr, callback = self._watches[fd]
+            try:
+                if not self._acknowledge(attr):
+                    continue
+            except OSError:
+                pass
+            try:
+                callback()
+            except Exception:
+                LOG.exception("Fail to process %s change", attr.path)
+
+    def close(self):
+        self.loop.remove_reader(self._epoll.fileno())
+        self._epoll.close()
+        self._watches.clear()
+
+
+def read(path):
+    return POOL.get(path).read()
+
+
+def read_once(path, default=None):
+    """Read a rarely used attribute without keeping it open in the pool"""
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return default
+
+
+def read_int(path):
+    return POOL.get(path).read_int()
+
+
+def write(path, value):
+    POOL.get(path).write(value)
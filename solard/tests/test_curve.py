@@ -0,0 +1,105 @@
+#
+# Licensed under the Apache License, Version 4.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import random
+
+import pytest
+
+from solard import curve
+
+
+def assert_monotone(c):
+    assert all(a <= b for a, b in zip(c.table, c.table[1:]))
+    xs = [x for x, _ in c.points]
+    ys = [y for _, y in c.points]
+    assert xs == sorted(set(xs))
+    assert ys == sorted(ys)
+
+
+@pytest.mark.parametrize("factor", [1.5, 2.5, 3.5, 4.8])
+def test_piecewise_from_log_matches_log(factor):
+    exact = curve.Curve.from_log(factor)
+    piecewise = curve.PiecewiseCurve.from_log(factor)
+    assert len(piecewise.table) == len(exact.table)
+    for raw in range(len(exact.table) + 10):
+        assert piecewise.lookup(raw) == pytest.approx(exact.lookup(raw), abs=0.5)
+    assert_monotone(piecewise)
+
+
+def test_log_low_values():
+    c = curve.PiecewiseCurve.from_log(3.5)
+    # log10(2) / 3.5
+    assert c.lookup(2) == pytest.approx(8.6, abs=0.01)
+    assert c.lookup(0) == c.lookup(1) == 0
+
+
+def test_parse_points():
+    assert curve.parse_points("0:0, 10:20\n# comment\n100:100") == [
+        (0, 0.0),
+        (10, 20.0),
+        (100, 100.0),
+    ]
+    assert curve.format_points([(0, 0.0), (10, 20.5)]) == "0:0,10:20.5"
+
+
+def test_piecewise_interpolates_points():
+    points = [(0, 5.0), (10, 20.0), (100, 60.0), (1000, 100.0)]
+    c = curve.PiecewiseCurve(points)
+    for lux, percent in points:
+        assert c.lookup(lux) == percent
+    assert c.lookup(5000) == 100
+    assert_monotone(c)
+
+
+def test_insert_drops_non_monotone_points():
+    c = curve.PiecewiseCurve([(0, 0.0), (10, 20.0), (100, 60.0), (1000, 100.0)])
+    assert c._insert(50, 10.0) == 1
+    assert c.points == [(0, 0.0), (50, 10.0), (100, 60.0), (1000, 100.0)]
+    assert c._insert(500, 70.0) == 3
+    assert c.points == [(0, 0.0), (50, 10.0), (100, 60.0), (500, 70.0), (1000, 100.0)]
+    # Replaces the point at the same raw value
+    c._insert(100, 65.0)
+    assert c.points == [(0, 0.0), (50, 10.0), (100, 65.0), (500, 70.0), (1000, 100.0)]
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_add_point_keeps_monotone(seed):
+    rand = random.Random(seed)
+    c = curve.PiecewiseCurve.from_log(3.5)
+    for _ in range(30):
+        lux, percent = rand.randint(0, 4000), rand.uniform(0, 100)
+        c.add_point(lux, percent)
+        assert c.lookup(lux) == pytest.approx(percent, abs=0.01)
+        assert_monotone(c)
+        # The partial refill gives the same table as a full rebuild
+        assert c.table == curve.PiecewiseCurve(c.points).table
+
+
+def test_band():
+    c = curve.Curve.from_log(3.5)
+    low, high = c.band(100, 3)
+    assert low < 100 < high
+    assert abs(c.lookup(low) - c.lookup(100)) >= 3 - 0.01
+    assert abs(c.lookup(low + 1) - c.lookup(100)) < 3
+    assert c.lookup(high) - c.lookup(100) >= 3 - 0.01
+    assert c.lookup(high - 1) - c.lookup(100) < 3
+
+
+def test_band_saturated():
+    c = curve.Curve.from_log(3.5)
+    low, high = c.band(10000, 3)
+    assert low < len(c.table)
+    assert high > 10000
+    low, high = c.band(len(c.table) - 1, 3)
+    assert high >= len(c.table)
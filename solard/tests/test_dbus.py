@@ -0,0 +1,159 @@
+#
+# Licensed under the Apache License, Version 4.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import shutil
+import subprocess
+
+import pytest
+
+from solard import dbus
+
+
+@pytest.fixture
+def bus():
+    if shutil.which("dbus-daemon") is None:
+        pytest.skip("dbus-daemon not installed")
+    daemon = subprocess.Popen(
+        ["dbus-daemon", "--session", "--nofork", "--print-address"],
+        stdout=subprocess.PIPE,
+    )
+    try:
+        address = daemon.stdout.readline().decode().strip()
+        if not address:
+            pytest.skip("dbus-daemon failed to start")
+        yield address
+    finally:
+        daemon.terminate()
+        daemon.wait()
+        daemon.stdout.close()
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+class NotificationsStub(object):
+    """org.freedesktop.Notifications recording the Notify arguments"""
+
+    FIRST_ID = 42
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.calls = []
+
+    @classmethod
+    async def start(cls, address):
+        connection = await dbus.Connection.connect(address)
+        # DBUS_NAME_FLAG_DO_NOT_QUEUE, 1 is DBUS_REQUEST_NAME_REPLY_PRIMARY_OWNER
+        reply = await connection.call(
+            *dbus.BUS, "RequestName", "su", (dbus.NOTIFICATIONS[0], 4)
+        )
+        assert reply == [1]
+        return cls(connection)
+
+    async def serve(self):
+        while True:
+            kind, serial, fields, body = await self.connection._receive()
+            if kind != dbus.METHOD_CALL or fields.get(dbus.MEMBER) != "Notify":
+                continue
+            self.calls.append(body)
+            notification_id = body[1] or self.FIRST_ID + len(self.calls) - 1
+            self.reply(serial, fields[dbus.SENDER], "u", notification_id)
+
+    def reply(self, serial, destination, signature, value):
+        body = dbus.Writer()
+        body.write(signature, value)
+        header = dbus.Writer()
+        for code, field in (
+            ("y", ord("l")),
+            ("y", dbus.METHOD_RETURN),
+            ("y", 0),
+            ("y", 1),
+            ("u", len(body.buf)),
+            ("u", serial + 1000),
+        ):
+            header.write(code, field)
+        header.write(
+            "a(yv)",
+            [
+                (dbus.REPLY_SERIAL, ("u", serial)),
+                (dbus.DESTINATION, ("s", destination)),
+                (dbus.SIGNATURE, ("g", signature)),
+            ],
+        )
+        header.align(8)
+        self.connection.writer.write(bytes(header.buf + body.buf))
+
+
+def test_notify(loop, bus):
+    async def scenario():
+        stub = await NotificationsStub.start(bus)
+        server = loop.create_task(stub.serve())
+        notifier = dbus.Notifier(loop, "solard", timeout=5, address=bus)
+        try:
+            await notifier.notify("Ambient Light Sensor", "Enabled", "active.svg")
+            assert notifier.notification_id == NotificationsStub.FIRST_ID
+            await notifier.notify(
+                "Ambient Light Sensor", "Paused", "inactive.svg", "device"
+            )
+            assert notifier.notification_id == NotificationsStub.FIRST_ID
+        finally:
+            notifier.close()
+            server.cancel()
+            stub.connection.close()
+        return stub.calls
+
+    calls = loop.run_until_complete(scenario())
+    assert calls == [
+        [
+            "solard",
+            0,
+            "active.svg",
+            "Ambient Light Sensor",
+            "Enabled",
+            [],
+            {},
+            -1,
+        ],
+        [
+            "solard",
+            NotificationsStub.FIRST_ID,
+            "inactive.svg",
+            "Ambient Light Sensor",
+            "Paused",
+            [],
+            {"category": "device"},
+            -1,
+        ],
+    ]
+
+
+def test_notify_without_server(loop, bus):
+    notifier = dbus.Notifier(loop, "solard", timeout=5, address=bus)
+    # The bus answers with a ServiceUnknown error, it is only logged
+    loop.run_until_complete(notifier.notify("Ambient Light Sensor", "Enabled"))
+    assert notifier.connection is None
+    assert notifier.notification_id == 0
+
+
+def test_notify_unreachable_bus(loop):
+    notifier = dbus.Notifier(
+        loop, "solard", timeout=0.1, address="unix:path=/nonexistent/bus"
+    )
+    loop.run_until_complete(notifier.notify("Ambient Light Sensor", "Enabled"))
+    assert notifier.connection is None
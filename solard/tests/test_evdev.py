@@ -0,0 +1,137 @@
+#
+# Licensed under the Apache License, Version 4.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import os
+
+import pytest
+
+from solard import evdev
+
+# Short enough to keep the tests fast, long enough for slow machines
+TIMEOUT = 200
+
+KEY_A = evdev.EVENT.pack(0, 0, evdev.EV_KEY, 30, 1)
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+@pytest.fixture
+def fifo(tmp_path):
+    path = str(tmp_path / "event0")
+    os.mkfifo(path)
+    return path
+
+
+class Recorder(object):
+    def __init__(self, loop):
+        self.loop = loop
+        self.start = loop.time()
+        self.monitor = None
+        self.changes = []
+
+    def __call__(self):
+        self.changes.append((self.loop.time() - self.start, self.monitor.idle))
+
+
+def run(loop, duration, actions):
+    for delay, action in actions:
+        loop.call_later(delay, action)
+    loop.call_later(duration, loop.stop)
+    loop.run_forever()
+
+
+def test_idle_and_back(loop, fifo):
+    recorder = Recorder(loop)
+    monitor = recorder.monitor = evdev.IdleMonitor(loop, [fifo], TIMEOUT, recorder)
+    writer = os.open(fifo, os.O_WRONLY | os.O_NONBLOCK)
+    try:
+        # Activity delays the idle state, then the user is back
+        run(
+            loop,
+            0.6,
+            [
+                (0.1, lambda: os.write(writer, KEY_A)),
+                (0.5, lambda: os.write(writer, KEY_A)),
+            ],
+        )
+    finally:
+        os.close(writer)
+        monitor.close()
+
+    assert [idle for _, idle in recorder.changes] == [True, False]
+    idle_at, back_at = (t for t, _ in recorder.changes)
+    assert 0.1 + TIMEOUT / 1000.0 <= idle_at + 0.001 < 0.5
+    assert back_at >= 0.5
+
+
+def test_batch_of_events(loop, fifo):
+    monitor = evdev.IdleMonitor(loop, [fifo], TIMEOUT, lambda: None)
+    writer = os.open(fifo, os.O_WRONLY | os.O_NONBLOCK)
+    try:
+        # More events than a single read
+        os.write(writer, KEY_A * (evdev.BATCH_SIZE * 2 + 3))
+        run(loop, 0.05, [])
+        assert monitor.devices
+        assert not monitor.is_idle(TIMEOUT)
+    finally:
+        os.close(writer)
+        monitor.close()
+
+
+def test_fifo_writer_sessions(loop, fifo):
+    recorder = Recorder(loop)
+    monitor = recorder.monitor = evdev.IdleMonitor(loop, [fifo], TIMEOUT, recorder)
+    try:
+        for _ in range(2):
+            writer = os.open(fifo, os.O_WRONLY | os.O_NONBLOCK)
+            run(loop, 0.3, [])
+            assert monitor.idle
+            os.write(writer, KEY_A)
+            os.close(writer)
+            run(loop, 0.05, [])
+            assert not monitor.idle
+            assert len(monitor.devices) == 1
+    finally:
+        monitor.close()
+
+    assert [idle for _, idle in recorder.changes] == [True, False, True, False]
+
+
+def test_timeout_change(loop, fifo):
+    monitor = evdev.IdleMonitor(loop, [fifo], TIMEOUT, lambda: None)
+    try:
+        run(loop, 0.1, [])
+        assert monitor.is_idle(50)
+        assert not monitor.is_idle(10000)
+    finally:
+        monitor.close()
+
+
+def test_no_device(loop, tmp_path):
+    recorder = Recorder(loop)
+    monitor = recorder.monitor = evdev.IdleMonitor(
+        loop, [str(tmp_path / "missing")], 10, recorder
+    )
+    run(loop, 0.1, [])
+    assert not monitor.devices
+    assert not monitor.is_idle(10)
+    assert not monitor.is_idle(20)
+    assert recorder.changes == []
+    monitor.close()
@@ -0,0 +1,140 @@
+#
+# Licensed under the Apache License, Version 4.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import random
+import statistics
+
+import pytest
+
+from solard import filters
+
+
+def samples(count, seed=0):
+    rand = random.Random(seed)
+    # Lux like values, with plateaus and duplicates
+    return [rand.choice((0, 5, 5, 120, rand.randint(0, 3000))) for _ in range(count)]
+
+
+def windows(values, window):
+    for i in range(len(values)):
+        yield values[max(0, i + 1 - window) : i + 1]
+
+
+def trimmed_mean(values):
+    if len(values) < 3:
+        return sum(values) / len(values)
+    return (sum(values) - max(values) - min(values)) / (len(values) - 2)
+
+
+def test_filter_is_abstract():
+    with pytest.raises(TypeError):
+        filters.Filter()
+
+
+@pytest.mark.parametrize("window", [1, 2, 3, 5, 16])
+def test_trimmed_mean(window):
+    values = samples(500)
+    f = filters.TrimmedMean(window)
+    for sample, expected in zip(values, windows(values, window)):
+        assert f.update(sample) == pytest.approx(trimmed_mean(expected))
+        assert f.last == sample
+
+
+def test_trimmed_mean_ignores_spikes():
+    f = filters.TrimmedMean(5)
+    for sample in (100, 100, 100, 100):
+        f.update(sample)
+    assert f.update(5000) == 100
+    assert f.update(0) == 100
+
+
+def test_trimmed_mean_resync():
+    f = filters.TrimmedMean(3)
+    f.RESYNC_EVERY = 7
+    values = [0.1 * i for i in range(100)]
+    for sample, expected in zip(values, windows(values, 3)):
+        assert f.update(sample) == pytest.approx(trimmed_mean(expected))
+
+
+def test_ema():
+    f = filters.ExponentialMovingAverage(3)
+    assert f.alpha == 0.5
+    assert f.update(100) == 100
+    assert f.update(0) == 50
+    assert f.update(0) == 25
+    assert f.update(100) == 62.5
+
+
+def test_ema_converges():
+    f = filters.ExponentialMovingAverage(5)
+    f.update(0)
+    for _ in range(50):
+        f.update(1000)
+    assert f.value == pytest.approx(1000, abs=0.01)
+
+
+@pytest.mark.parametrize("window", [1, 2, 3, 4, 5, 16])
+def test_median(window):
+    values = samples(500, seed=window)
+    f = filters.RunningMedian(window)
+    for sample, expected in zip(values, windows(values, window)):
+        assert f.update(sample) == statistics.median(expected)
+        assert f.last == sample
+
+
+def test_kalman_first_sample():
+    f = filters.Kalman(0.1, 4.0)
+    assert f.update(42) == 42
+
+
+def test_kalman_converges():
+    rand = random.Random(0)
+    f = filters.Kalman(0.1, 4.0)
+    f.update(0)
+    for _ in range(200):
+        f.update(rand.gauss(500, 2))
+    assert f.value == pytest.approx(500, abs=2)
+    # The steady state error only depends on the noises
+    assert f.error == pytest.approx(
+        (-0.1 + (0.1**2 + 4 * 0.1 * 4.0) ** 0.5) / 2, rel=1e-3
+    )
+
+
+def test_kalman_smooths_noise():
+    rand = random.Random(1)
+    f = filters.Kalman(0.01, 100.0)
+    noisy = [rand.gauss(300, 10) for _ in range(500)]
+    filtered = [f.update(sample) for sample in noisy]
+    assert statistics.pstdev(filtered[100:]) < statistics.pstdev(noisy[100:]) / 3
+
+
+@pytest.mark.parametrize(
+    "name, cls",
+    [
+        ("trimmed-mean", filters.TrimmedMean),
+        ("ema", filters.ExponentialMovingAverage),
+        ("median", filters.RunningMedian),
+        ("kalman", filters.Kalman),
+    ],
+)
+def test_build(name, cls):
+    conf = argparse.Namespace(
+        ambient_light_filter=name,
+        ambient_light_measures_number=5,
+        ambient_light_kalman_process_noise=0.1,
+        ambient_light_kalman_measurement_noise=4.0,
+    )
+    assert isinstance(filters.build(conf), cls)
+    assert name in filters.FILTERS
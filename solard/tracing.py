@@ -0,0 +1,135 @@
+#
+# Licensed under the Apache License, Version 4.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Spans of the daemon work, saved as Chrome trace events
+
+Spans are stored in preallocated arrays, overwriting the oldest ones when
+full, and written on exit or SIGUSR2. Open the file with
+https://ui.perfetto.dev or chrome://tracing. When tracing is disabled,
+span() returns a shared no-op context manager.
+"""
+
+import array
+import json
+import os
+import threading
+import time
+
+from solard.log import LOG
+
+
+# The enabled Tracer
+TRACER = None
+
+
+class _NoSpan(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NO_SPAN = _NoSpan()
+
+
+class Span(object):
+    __slots__ = ("tracer", "name", "label", "start")
+
+    def __init__(self, tracer, name, label):
+        self.tracer = tracer
+        self.name = name
+        self.label = label
+        self.start = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.tracer.add(self.name, self.start, time.perf_counter_ns(), self.label)
+        return False
+
+
+def span(name, label=None):
+    """Time a block, `label` tells which object it works on, eg: a path"""
+    if TRACER is None:
+        return NO_SPAN
+    return Span(TRACER, name, label)
+
+
+class Tracer(object):
+    def __init__(self, path, capacity=65536):
+        if capacity < 1:
+            raise ValueError("Trace capacity must be positive: %s" % capacity)
+        self.path = path
+        self.capacity = capacity
+        self.names = [None] * capacity
+        self.labels = [None] * capacity
+        self.starts = array.array("q", bytes(8 * capacity))
+        self.ends = array.array("q", bytes(8 * capacity))
+        # Spans recorded since the start
+        self.count = 0
+        self.origin = time.perf_counter_ns()
+
+    def add(self, name, start, end, label=None):
+        index = self.count % self.capacity
+        self.names[index] = name
+        self.labels[index] = label
+        self.starts[index] = start
+        self.ends[index] = end
+        self.count += 1
+
+    def events(self):
+        pid = os.getpid()
+        tid = threading.get_ident()
+        for i in range(max(0, self.count - self.capacity), self.count):
+            index = i % self.capacity
+            event = {
+                "name": self.names[index],
+                "ph": "X",
+                "ts": (self.starts[index] - self.origin) / 1000.0,
+                "dur": (self.ends[index] - self.starts[index]) / 1000.0,
+                "pid": pid,
+                "tid": tid,
+            }
+            if self.labels[index] is not None:
+                event["args"] = {"object": self.labels[index]}
+            yield event
+
+    def flush(self):
+        tmp = self.path + ".tmp"
+        try:
+            with open(tmp, "w") as f:
+                json.dump(
+                    {"traceEvents": list(self.events()), "displayTimeUnit": "ms"}, f
+                )
+            os.rename(tmp, self.path)
+        except (IOError, OSError) as e:
+            LOG.error("Fail to write the trace %s: %s", self.path, e)
+            return
+        LOG.info(
+            "Trace written to %s (%d spans)",
+            self.path,
+            min(self.count, self.capacity),
+        )
+
+
+def enable(path, capacity=65536):
+    global TRACER
+    TRACER = Tracer(path, capacity)
+    return TRACER
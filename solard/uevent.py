@@ -0,0 +1,116 @@
+#
+# Licensed under the Apache License, Version 4.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import os
+import socket
+
+from solard.log import LOG
+
+
+NETLINK_KOBJECT_UEVENT = 15
+# Kernel multicast group, udev rebroadcasts its own events on group 2
+UEVENT_KERNEL_GROUP = 1
+
+RECEIVE_BUFFER_SIZE = 1024 * 1024
+
+
+class Uevent(collections.namedtuple("Uevent", ["action", "devpath", "env"])):
+    @property
+    def subsystem(self):
+        return self.env.get("SUBSYSTEM")
+
+    @property
+    def name(self):
+        return os.path.basename(self.devpath)
+
+
+def parse(data):
+    fields = data.split(b"\0")
+    header = fields[0].decode(errors="replace")
+    if "@" not in header:
+        # Not a kernel message
+        return None
+    action, devpath = header.split("@", 1)
+    env = {}
+    for field in fields[1:]:
+        key, sep, value = field.partition(b"=")
+        if sep:
+            env[key.decode(errors="replace")] = value.decode(errors="replace")
+    return Uevent(action, devpath, env)
+
+
+class UeventMonitor(object):
+    """Kernel uevents listener
+
+    Callbacks are subscribed per subsystem and receive all the uevents of
+    that subsystem read in one batch.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.sock = socket.socket(
+            socket.AF_NETLINK,
+            socket.SOCK_RAW | socket.SOCK_NONBLOCK | socket.SOCK_CLOEXEC,
+            NETLINK_KOBJECT_UEVENT,
+        )
+        try:
+            self.sock.setsockopt(
+                socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER_SIZE
+            )
+            self.sock.bind((0, UEVENT_KERNEL_GROUP))
+        except OSError:
+            self.sock.close()
+            raise
+        self._callbacks = collections.defaultdict(list)
+        self.loop.add_reader(self.sock.fileno(), self._dispatch)
+        LOG.debug("Listening kernel uevents")
+
+    def subscribe(self, subsystem, callback):
+        self._callbacks[subsystem].append(callback)
+
+    def unsubscribe(self, subsystem, callback):
+        self._callbacks[subsystem].remove(callback)
+
+    def _receive(self):
+        while True:
+            try:
+                data = self.sock.recv(RECEIVE_BUFFER_SIZE)
+            except BlockingIOError:
+                return
+            except OSError as e:
+                # ENOBUFS, some events have been lost
+                LOG.error("Fail to receive uevents: %s", e)
+                return
+            uevent = parse(data)
+            if uevent is not None:
+                yield uevent
+
+    def _dispatch(self):
+        batches = collections.defaultdict(list)
+        for uevent in self._receive():
+            LOG.trace("uevent: %s %s", uevent.action, uevent.devpath)
+            if uevent.subsystem in self._callbacks:
+                batches[uevent.subsystem].append(uevent)
+
+        for subsystem, uevents in batches.items():
+            for callback in list(self._callbacks[subsystem]):
+                try:
+                    callback(uevents)
+                except Exception:
+                    LOG.exception("Fail to process %s uevents", subsystem)
+
+    def close(self):
+        self.loop.remove_reader(self.sock.fileno())
+        self.sock.close()
@@ -0,0 +1,159 @@
+#
+# Licensed under the Apache License, Version 4.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""User idle time from the X server MIT-SCREEN-SAVER extension
+
+When the server supports it, XSync alarms push the idle and return events
+instead, the idle time is then only queried when the timeout changes.
+
+python-xlib reads the whole socket on each round trip and queues the
+events it gets, they don't wake up the event loop anymore, so
+pending_events() must be checked after making requests.
+Only imported when idle dim is enabled, so python-xlib isn't loaded
+otherwise.
+"""
+
+import Xlib.X
+import Xlib.Xatom
+import Xlib.display
+import Xlib.error
+
+from solard.log import LOG
+
+
+class XScreenSaverQuerier(object):
+    # Raised by all the methods once the X server is gone
+    ConnectionClosedError = Xlib.error.ConnectionClosedError
+
+    def __init__(self):
+        self.dpy = Xlib.display.Display()
+        if not self.dpy.has_extension("MIT-SCREEN-SAVER"):
+            raise RuntimeError("X server doesn't support MIT-SCREEN-SAVER")
+        self.screen = self.dpy.screen()
+        self.root = self.screen.root
+        self.net_active_window = self.dpy.intern_atom("_NET_ACTIVE_WINDOW")
+
+        self.active_window = None
+        self.is_fullscreen = False
+        self.idle_alarms = None
+        self.round_trips = 0
+        self.root.change_attributes(event_mask=Xlib.X.PropertyChangeMask)
+        self.update_active_window()
+
+    def fileno(self):
+        return self.dpy.fileno()
+
+    def pending_events(self):
+        return self.dpy.pending_events()
+
+    def enable_idle_alarms(self, timeout):
+        from solard import xsync
+
+        self.idle_alarms = xsync.IdleAlarms(self.dpy, timeout)
+        # Initialize, ListSystemCounters and QueryCounter
+        self.round_trips += 3
+
+    def update_active_window(self):
+        prop = self.root.get_property(self.net_active_window, Xlib.Xatom.WINDOW, 0, 1)
+        self.round_trips += 1
+        window_id = prop.value[0] if prop is not None and prop.value else 0
+
+        if self.active_window is not None:
+            if self.active_window.id == window_id:
+                return
+            self.active_window.change_attributes(
+                event_mask=Xlib.X.NoEventMask,
+                onerror=Xlib.error.CatchError(Xlib.error.BadWindow),
+            )
+            self.active_window = None
+        self.is_fullscreen = False
+
+        if not window_id:
+            return
+
+        window = self.dpy.create_resource_object("window", window_id)
+        try:
+            window.change_attributes(event_mask=Xlib.X.StructureNotifyMask)
+            geometry = window.get_geometry()
+        except Xlib.error.BadWindow:
+            return
+        finally:
+            self.round_trips += 1
+        self.active_window = window
+        self.update_fullscreen(geometry.width, geometry.height)
+
+    def update_fullscreen(self, width, height):
+        is_fullscreen = (
+            width == self.screen.width_in_pixels
+            and height == self.screen.height_in_pixels
+        )
+        if is_fullscreen != self.is_fullscreen:
+            LOG.debug("Active window fullscreen: %s", is_fullscreen)
+        self.is_fullscreen = is_fullscreen
+
+    def process_events(self):
+        """Handle the pending events, return True if the idle state changed
+
+        Leaving fullscreen is a change too, the user may already be idle.
+        """
+        was_fullscreen = self.is_fullscreen
+        active_window_changed = False
+        idle_changed = False
+        while True:
+            while self.dpy.pending_events():
+                event = self.dpy.next_event()
+                if self.idle_alarms is not None and self.idle_alarms.process(event):
+                    idle_changed = True
+                elif event.type == Xlib.X.PropertyNotify:
+                    if event.atom == self.net_active_window:
+                        active_window_changed = True
+                elif self.active_window is None or (
+                    getattr(event, "window", None) != self.active_window
+                ):
+                    continue
+                elif event.type == Xlib.X.ConfigureNotify:
+                    self.update_fullscreen(event.width, event.height)
+                elif event.type == Xlib.X.DestroyNotify:
+                    self.active_window = None
+                    self.is_fullscreen = False
+            if not active_window_changed:
+                return idle_changed or was_fullscreen != self.is_fullscreen
+            active_window_changed = False
+            # Its round trips may have queued new events
+            self.update_active_window()
+
+    def get_idle(self):
+        self.process_events()
+        if self.is_fullscreen:
+            LOG.debug("Fullscreen App detected, no dim")
+            return 0
+        self.round_trips += 1
+        return self.root.screensaver_query_info().idle
+
+    def is_idle(self, timeout):
+        if self.idle_alarms is None:
+            return self.get_idle() > timeout
+        self.process_events()
+        if self.is_fullscreen:
+            LOG.debug("Fullscreen App detected, no dim")
+            return False
+        if self.idle_alarms.set_timeout(timeout):
+            # QueryCounter
+            self.round_trips += 1
+        return self.idle_alarms.idle
+
+    def close(self):
+        if self.idle_alarms is not None:
+            self.idle_alarms.close()
+        self.dpy.close()
@@ -0,0 +1,264 @@
+#
+# Licensed under the Apache License, Version 4.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""User idle and return events from the X server SYNC extension
+
+python-xlib doesn't implement SYNC, only the few requests needed to watch
+the IDLETIME system counter are defined here. Two alarms are set on it: a
+positive transition one at the idle timeout and a negative transition one
+just under it, fired when the user is back.
+"""
+
+import struct
+
+import Xlib.protocol.rq as rq
+
+from solard.log import LOG
+
+
+EXTNAME = "SYNC"
+
+# Value types
+ABSOLUTE = 0
+# Test types
+POSITIVE_TRANSITION = 0
+NEGATIVE_TRANSITION = 1
+# CreateAlarm and ChangeAlarm value mask: counter, value type, value, test
+# type, delta and events
+ALL_ALARM_VALUES = 0x3F
+
+# Event offsets
+ALARM_NOTIFY = 1
+
+# counter, resolution (hi, lo), name length
+SYSTEM_COUNTER = struct.Struct("=IiIH")
+
+
+class Initialize(rq.ReplyRequest):
+    _request = rq.Struct(
+        rq.Card8("opcode"),
+        rq.Opcode(0),
+        rq.RequestLength(),
+        rq.Card8("major_version"),
+        rq.Card8("minor_version"),
+        rq.Pad(2),
+    )
+    _reply = rq.Struct(
+        rq.ReplyCode(),
+        rq.Pad(1),
+        rq.Card16("sequence_number"),
+        rq.ReplyLength(),
+        rq.Card8("major_version"),
+        rq.Card8("minor_version"),
+        rq.Pad(22),
+    )
+
+
+class ListSystemCounters(rq.ReplyRequest):
+    _request = rq.Struct(
+        rq.Card8("opcode"),
+        rq.Opcode(1),
+        rq.RequestLength(),
+    )
+    _reply = rq.Struct(
+        rq.ReplyCode(),
+        rq.Pad(1),
+        rq.Card16("sequence_number"),
+        rq.ReplyLength(),
+        rq.Card32("counters_len"),
+        rq.Pad(20),
+        # Variable size records, see parse_system_counters()
+        rq.Binary("counters"),
+    )
+
+
+class QueryCounter(rq.ReplyRequest):
+    _request = rq.Struct(
+        rq.Card8("opcode"),
+        rq.Opcode(5),
+        rq.RequestLength(),
+        rq.Card32("counter"),
+    )
+    _reply = rq.Struct(
+        rq.ReplyCode(),
+        rq.Pad(1),
+        rq.Card16("sequence_number"),
+        rq.ReplyLength(),
+        rq.Int32("value_hi"),
+        rq.Card32("value_lo"),
+        rq.Pad(16),
+    )
+
+
+def _alarm_request(opcode):
+    # All the values are always given, in the value mask bits order
+    return rq.Struct(
+        rq.Card8("opcode"),
+        rq.Opcode(opcode),
+        rq.RequestLength(),
+        rq.Card32("alarm"),
+        rq.Card32("value_mask"),
+        rq.Card32("counter"),
+        rq.Card32("value_type"),
+        rq.Int32("value_hi"),
+        rq.Card32("value_lo"),
+        rq.Card32("test_type"),
+        rq.Int32("delta_hi"),
+        rq.Card32("delta_lo"),
+        rq.Card32("events"),
+    )
+
+
+class CreateAlarm(rq.Request):
+    _request = _alarm_request(8)
+
+
+class ChangeAlarm(rq.Request):
+    _request = _alarm_request(9)
+
+
+class DestroyAlarm(rq.Request):
+    _request = rq.Struct(
+        rq.Card8("opcode"),
+        rq.Opcode(11),
+        rq.RequestLength(),
+        rq.Card32("alarm"),
+    )
+
+
+class AlarmNotify(rq.Event):
+    _code = None
+    _fields = rq.Struct(
+        rq.Card8("type"),
+        rq.Card8("kind"),
+        rq.Card16("sequence_number"),
+        rq.Card32("alarm"),
+        rq.Int32("counter_value_hi"),
+        rq.Card32("counter_value_lo"),
+        rq.Int32("alarm_value_hi"),
+        rq.Card32("alarm_value_lo"),
+        rq.Card32("timestamp"),
+        rq.Card8("state"),
+        rq.Pad(3),
+    )
+
+
+def parse_system_counters(data, count):
+    """Return the {name: counter id} of a ListSystemCounters reply"""
+    counters = {}
+    offset = 0
+    for _ in range(count):
+        counter, _, _, length = SYSTEM_COUNTER.unpack_from(data, offset)
+        start = offset + SYSTEM_COUNTER.size
+        counters[data[start : start + length].decode(errors="replace")] = counter
+        size = SYSTEM_COUNTER.size + length
+        offset += size + (-size % 4)
+    return counters
+
+
+def _int64(value):
+    return value >> 32, value & 0xFFFFFFFF
+
+
+class IdleAlarms(object):
+    """Track if the user is idle for more than `timeout` ms"""
+
+    def __init__(self, dpy, timeout):
+        self.dpy = dpy
+        self.display = dpy.display
+        info = dpy.query_extension(EXTNAME)
+        if info is None:
+            raise RuntimeError("X server doesn't support %s" % EXTNAME)
+        self.opcode = info.major_opcode
+        self.display.set_extension_major(EXTNAME, self.opcode)
+        self.event_code = info.first_event + ALARM_NOTIFY
+        self.display.add_extension_event(
+            self.event_code,
+            type("AlarmNotify", (AlarmNotify,), {"_code": self.event_code}),
+        )
+
+        Initialize(
+            display=self.display, opcode=self.opcode, major_version=3, minor_version=1
+        )
+        reply = ListSystemCounters(display=self.display, opcode=self.opcode)
+        counters = parse_system_counters(reply.counters, reply.counters_len)
+        if "IDLETIME" not in counters:
+            raise RuntimeError("X server doesn't have an IDLETIME counter")
+        self.counter = counters["IDLETIME"]
+
+        self.timeout = timeout
+        self.idle_alarm = self.display.allocate_resource_id()
+        self.back_alarm = self.display.allocate_resource_id()
+        self._send_alarms(CreateAlarm)
+        self.idle = self._query_idle()
+        LOG.debug("XSync idle alarms set at %dms", timeout)
+
+    def _query_idle(self):
+        reply = QueryCounter(
+            display=self.display, opcode=self.opcode, counter=self.counter
+        )
+        return ((reply.value_hi << 32) | reply.value_lo) >= self.timeout
+
+    def _send_alarms(self, request):
+        for alarm, value, test_type in (
+            (self.idle_alarm, self.timeout, POSITIVE_TRANSITION),
+            (self.back_alarm, max(self.timeout - 1, 0), NEGATIVE_TRANSITION),
+        ):
+            value_hi, value_lo = _int64(value)
+            request(
+                display=self.display,
+                opcode=self.opcode,
+                alarm=alarm,
+                value_mask=ALL_ALARM_VALUES,
+                counter=self.counter,
+                value_type=ABSOLUTE,
+                value_hi=value_hi,
+                value_lo=value_lo,
+                test_type=test_type,
+                delta_hi=0,
+                delta_lo=0,
+                events=1,
+            )
+        self.dpy.flush()
+
+    def set_timeout(self, timeout):
+        """Move the alarms, return True if the idle time had to be queried"""
+        if timeout == self.timeout:
+            return False
+        self.timeout = timeout
+        self._send_alarms(ChangeAlarm)
+        # The alarms only fire on transitions, the user may already be on
+        # either side of the new timeout
+        self.idle = self._query_idle()
+        LOG.debug("XSync idle alarms moved to %dms", timeout)
+        return True
+
+    def process(self, event):
+        """Return True if the event is one of our alarms"""
+        if event.type != self.event_code:
+            return False
+        if event.alarm == self.idle_alarm:
+            self.idle = True
+        elif event.alarm == self.back_alarm:
+            self.idle = False
+        else:
+            return False
+        LOG.debug("XSync idle alarm: %s", "idle" if self.idle else "back")
+        return True
+
+    def close(self):
+        for alarm in (self.idle_alarm, self.back_alarm):
+            DestroyAlarm(display=self.display, opcode=self.opcode, alarm=alarm)
+        self.dpy.flush()